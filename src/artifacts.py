@@ -0,0 +1,269 @@
+#############################################################################
+#
+# Author: Milan Patel
+# Purpose: On-disk store for the outputs of the pipeline stages, streamed
+#          in and out record by record
+# Date: 06/05/2018
+#
+#############################################################################
+
+import os
+import gzip
+import json
+import time
+import zlib
+import hashlib
+import logging
+from functools import partial
+
+_DEFAULT_ARTIFACT_DIR = os.path.join(os.getcwd(), 'data_path', 'artifacts')
+_FORMAT = 'jsonl.gz'
+_COMPRESS_LEVEL = 6
+DEFAULT_CHECKPOINT = 64
+
+def _describe(obj):
+    # Stable stand-ins for things json can't dump (repr has addresses)
+
+    if isinstance(obj, partial):
+        return [_describe(obj.func), list(obj.args), obj.keywords]
+
+    if callable(obj):
+        return '{}.{}'.format(
+            getattr(obj, '__module__', ''),
+            getattr(obj, '__qualname__', type(obj).__name__)
+        )
+
+    if isinstance(obj, (set, frozenset)):
+        return sorted(obj, key=repr)
+
+    return repr(obj)
+
+def input_digest(inputs):
+    """
+    Content hash of whatever a stage was built from, anything json can
+    dump plus functions/partials
+    """
+    dumped = json.dumps(inputs, sort_keys=True, default=_describe)
+    return hashlib.sha1(dumped.encode('utf-8')).hexdigest()
+
+def _iter_records(path):
+    """
+    Records of one file, a torn tail (crash mid write) just ends it
+    """
+    try:
+        with gzip.open(path, 'rb') as f:
+            for line in f:
+
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    return
+
+    except (EOFError, zlib.error):
+        return
+
+class ArtifactWriter(object):
+    """
+    Appends records to a stage being built. Everything goes into a
+    `.part` file that only takes the artifact's name on close(), and
+    every `checkpoint_every` records the compressor is flushed and the
+    manifest updated, so whatever was written before a crash can be
+    read back as a partial result.
+    """
+
+    def __init__(self, store, name, digest, checkpoint_every=DEFAULT_CHECKPOINT):
+
+        self.store = store
+        self.name = name
+        self.digest = digest
+        self.checkpoint_every = checkpoint_every
+        self.count = 0
+
+        self._file = gzip.open(store.part_path(name), 'wb', _COMPRESS_LEVEL)
+        self.store._write_manifest(name, digest, False, 0)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc_info):
+        self.close(complete=exc_type is None)
+
+    def write(self, record):
+
+        self._file.write(
+            (json.dumps(record, separators=(',', ':')) + '\n').encode('utf-8'))
+        self.count += 1
+
+        if self.checkpoint_every and not self.count % self.checkpoint_every:
+            self.checkpoint()
+
+    def extend(self, records):
+
+        for record in records:
+            self.write(record)
+
+    def checkpoint(self):
+        self._file.flush(zlib.Z_SYNC_FLUSH)
+        self.store._write_manifest(self.name, self.digest, False, self.count)
+
+    def close(self, complete=True):
+        """
+        Without `complete` the records stay behind as a partial result
+        """
+        if self._file is None:
+            return
+
+        if not complete:
+            self.checkpoint()
+
+        self._file.close()
+        self._file = None
+
+        if complete:
+            os.replace(self.store.part_path(self.name), self.store.path(self.name))
+
+        self.store._write_manifest(self.name, self.digest, complete, self.count)
+
+class ArtifactStore(object):
+    """
+    Every stage output is a gzipped file of JSON lines next to a small
+    manifest:
+
+        {"name": ..., "inputs": <sha1>, "complete": true, "count": 123}
+
+    `inputs` is the input_digest of whatever the stage was built from,
+    so a stage is only reused while its inputs haven't changed. Reads
+    are generators over the file, a stage never has to fit in memory.
+    """
+
+    def __init__(self, directory=_DEFAULT_ARTIFACT_DIR):
+
+        self.directory = directory
+
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+    def path(self, name):
+        return os.path.join(self.directory, '{}.{}'.format(name, _FORMAT))
+
+    def part_path(self, name):
+        return self.path(name) + '.part'
+
+    def _manifest_path(self, name):
+        return os.path.join(self.directory, '{}.manifest.json'.format(name))
+
+    def _write_manifest(self, name, digest, complete, count):
+
+        path = self._manifest_path(name)
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+
+        with open(tmp_path, 'w') as f:
+            json.dump({
+                'name': name,
+                'format': _FORMAT,
+                'inputs': digest,
+                'complete': complete,
+                'count': count,
+                'updated': time.time()
+            }, f)
+
+        os.replace(tmp_path, path)
+
+    def manifest(self, name):
+
+        try:
+            with open(self._manifest_path(name), 'r') as f:
+                return json.load(f)
+
+        except (IOError, ValueError):
+            return None
+
+    def fresh(self, name, inputs):
+        """
+        Whether a complete artifact built from these inputs exists
+        """
+        manifest = self.manifest(name)
+
+        return manifest is not None \
+            and manifest['complete'] \
+            and manifest['inputs'] == input_digest(inputs) \
+            and os.path.exists(self.path(name))
+
+    def read(self, name):
+        """
+        Streams the records of a complete artifact
+        """
+        manifest = self.manifest(name)
+
+        if manifest is None or not manifest['complete']:
+            raise RuntimeError('No complete artifact named: {}'.format(name))
+
+        return _iter_records(self.path(name))
+
+    def partial(self, name, inputs):
+        """
+        Streams whatever an unfinished build from these same inputs got
+        written, nothing if there isn't one
+        """
+        manifest = self.manifest(name)
+
+        if manifest is None or manifest['complete'] \
+            or manifest['inputs'] != input_digest(inputs) \
+            or not os.path.exists(self.part_path(name)):
+
+            return iter(())
+
+        return _iter_records(self.part_path(name))
+
+    def writer(self, name, inputs, checkpoint_every=DEFAULT_CHECKPOINT):
+        return ArtifactWriter(self, name, input_digest(inputs), checkpoint_every)
+
+    def stage(self, name, inputs, produce, resume=False,
+        checkpoint_every=DEFAULT_CHECKPOINT):
+        """
+        Builds the artifact with produce(done) unless a fresh one is
+        already there, then hands back a lazy reader over it. `produce`
+        yields records as it goes. With `resume` the records a crashed
+        or failed build of the same inputs got written are kept, `done`
+        iterates over them and produce only has to yield the rest.
+        If produce raises, what it yielded so far is kept as a partial
+        result for the next resume
+        """
+        log = logging.getLogger(str(os.getpid()))
+
+        if self.fresh(name, inputs):
+            log.info('Stage {} is up to date'.format(name))
+            return self.read(name)
+
+        old_path = None
+
+        manifest = self.manifest(name) or {}
+
+        if resume and os.path.exists(self.part_path(name)) \
+            and manifest.get('inputs', None) == input_digest(inputs):
+
+            old_path = self.part_path(name) + '.old'
+            os.replace(self.part_path(name), old_path)
+
+        try:
+            with self.writer(name, inputs, checkpoint_every) as writer:
+
+                if old_path is not None:
+                    writer.extend(_iter_records(old_path))
+                    log.info('Stage {} resuming after {} records'.format(
+                        name, writer.count))
+
+                    done = _iter_records(old_path)
+
+                else:
+                    done = iter(())
+
+                writer.extend(produce(done))
+
+        finally:
+            if old_path is not None:
+                os.remove(old_path)
+
+        log.info('Stage {} built, {} records'.format(name, writer.count))
+
+        return self.read(name)
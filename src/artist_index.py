@@ -0,0 +1,176 @@
+#############################################################################
+#
+# Author: Milan Patel
+# Purpose: Persistent artist name -> genius id index so artists we have
+#          resolved before never go back out to the search API
+# Date: 06/05/2018
+#
+#############################################################################
+
+import os
+import re
+import json
+import logging
+import threading
+import unicodedata
+
+import database
+
+from database import (
+    get_collection
+)
+
+from journal import (
+    _ends_with_newline
+)
+
+INDEX_NAME = 'artist_index.jsonl'
+
+_featuring_matcher = re.compile(r'\s+(?:feat\.?|ft\.?|featuring)\s+.*$')
+_quote_matcher = re.compile(u'["\'‘’“”`]')
+_non_word_matcher = re.compile(r'[^0-9a-z$]+')
+
+def normalize_name(name):
+    """
+    Folds the ways the wikipedia tables write the same artist onto one
+    key: case, accents, quotes, '&' vs 'and', punctuation/whitespace
+    and any 'feat./ft./featuring' guests tacked onto the end. Names
+    with nothing latin left to fold on (say 방탄소년단) keep their
+    casefolded self instead of all ending up as ''
+    """
+    raw = name
+    name = unicodedata.normalize('NFKD', name)
+    name = ''.join(c for c in name if not unicodedata.combining(c)).lower()
+    name = _featuring_matcher.sub('', name)
+    name = _quote_matcher.sub('', name)
+    name = name.replace('&', ' and ')
+    name = ' '.join(_non_word_matcher.sub(' ', name).split())
+
+    return name or ' '.join(raw.casefold().split())
+
+class ArtistIndex(object):
+    """
+    In memory map of normalized name -> genius id, loaded from the
+    Artist collection and from an append-only JSON lines file that
+    every worker adds to as it resolves artists:
+
+        {"name": "kanye west", "id": 72}
+
+    The file is appended to with single writes on an O_APPEND
+    descriptor, same as the crawl journal, so the processes can share
+    it. Without a path the index only lives as long as the process
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self._ids = {}
+        self._fd = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __contains__(self, name):
+        return normalize_name(name) in self._ids
+
+    def load(self, identity=None):
+        """
+        Seeds the index from the Artist collection when given an alias,
+        then from the file, which wins on conflicts. Returns self
+        """
+        log = logging.getLogger(str(os.getpid()))
+
+        if identity is not None:
+
+            artists = get_collection(identity, database.Artist).find(
+                {'genius_id': {'$ne': None}, 'name': {'$ne': None}},
+                {'_id': 0, 'name': 1, 'genius_id': 1}
+            )
+
+            for artist in artists:
+
+                key = normalize_name(artist['name'])
+
+                if key:
+                    self._ids[key] = int(artist['genius_id'])
+
+        if self.path is not None and os.path.exists(self.path):
+
+            with open(self.path, 'rb') as f:
+                for line in f:
+
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+
+                    # Written before names could fall back on themselves
+                    if record['name']:
+                        self._ids[record['name']] = record['id']
+
+        log.info('Loaded {} artists into the name index'.format(len(self._ids)))
+        return self
+
+    def lookup(self, name):
+
+        key = normalize_name(name)
+        return self._ids.get(key, None) if key else None
+
+    def resolve(self, names):
+        """
+        Batch lookup, returns ({name: genius id}, [names that missed])
+        """
+        known = {}
+        missing = []
+
+        for name in names:
+
+            genius_id = self.lookup(name)
+
+            if genius_id is None:
+                missing.append(name)
+            else:
+                known[name] = genius_id
+
+        return known, missing
+
+    def add(self, name, genius_id):
+
+        key = normalize_name(name)
+        genius_id = int(genius_id)
+
+        if not key or self._ids.get(key, None) == genius_id:
+            return
+
+        self._ids[key] = genius_id
+
+        if self.path is None:
+            return
+
+        line = (json.dumps({'name': key, 'id': genius_id},
+            separators=(',', ':')) + '\n').encode('utf-8')
+
+        with self._lock:
+
+            if self._fd is None or self._pid != os.getpid():
+                self._fd = os.open(
+                    self.path,
+                    os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+                    0o644
+                )
+                self._pid = os.getpid()
+
+                if not _ends_with_newline(self.path):
+                    line = b'\n' + line
+
+            os.write(self._fd, line)
+
+    def close(self):
+
+        with self._lock:
+
+            if self._fd is not None and self._pid == os.getpid():
+                os.close(self._fd)
+
+            self._fd = None
@@ -0,0 +1,112 @@
+#############################################################################
+#
+# Author: Milan Patel
+# Purpose: Microbenchmark of the lyrics extraction on saved song pages
+# Date: 06/05/2018
+#
+# Usage: python bench_lyrics.py <directory of saved genius pages> [repeat]
+#
+#############################################################################
+
+import os
+import re
+import sys
+import glob
+import timeit
+import lxml.html as l_html
+
+from tools import (
+    lyrics_xpath
+)
+
+from lyrics import (
+    extract_lyrics_text,
+    clean_lyrics
+)
+
+_meta_matcher = re.compile(r'(\[.*?\])*')
+
+def tree_lyrics(content):
+    """
+    The original whole tree parse + multi pass cleanup, kept here as
+    the baseline
+    """
+    root = l_html.fromstring(content)
+    results = list(root.xpath(lyrics_xpath))
+
+    if not results:
+        return 'NO LYRICS'
+
+    final = [lyr.text_content().replace(u'\xa0', u' ') for lyr in results]
+
+    for i in range(len(final)):
+
+        final[i] = _meta_matcher.sub('', final[i])
+        final[i] = '\n'.join(
+            filter(
+                lambda string: bool(string.strip()),
+                final[i].split('\n')
+            )
+        )
+
+    return '\n\n'.join(final)
+
+def stream_lyrics(content):
+
+    text = extract_lyrics_text(content)
+
+    if text is None:
+        return 'NO LYRICS'
+
+    return clean_lyrics(text)
+
+def load_pages(directory):
+
+    pages = []
+
+    for path in sorted(glob.glob(os.path.join(directory, '*.htm*'))):
+        with open(path, 'rb') as f:
+            pages.append((os.path.basename(path), f.read()))
+
+    return pages
+
+def main(directory, repeat=5):
+
+    pages = load_pages(directory)
+
+    if not pages:
+        raise RuntimeError('No saved pages found in: {}'.format(directory))
+
+    mismatched = [
+        name for name, content in pages
+        if tree_lyrics(content) != stream_lyrics(content)
+    ]
+
+    for name in mismatched:
+        print('Output differs for: {}'.format(name))
+
+    total_bytes = sum(len(content) for _, content in pages)
+    print('{} pages, {:.1f} MB'.format(len(pages), total_bytes / 1024. ** 2))
+
+    results = {}
+    for label, f in [('tree', tree_lyrics), ('stream', stream_lyrics)]:
+
+        best = min(timeit.repeat(
+            lambda: [f(content) for _, content in pages],
+            number=1,
+            repeat=repeat
+        ))
+
+        results[label] = best
+        print('{:>8}: {:.4f}s total, {:.2f}ms/page'.format(
+            label, best, 1000. * best / len(pages)))
+
+    print('Speedup: {:.2f}x'.format(results['tree'] / results['stream']))
+
+if __name__ == '__main__':
+
+    if len(sys.argv) < 2:
+        print('Usage: python bench_lyrics.py <pages_dir> [repeat]')
+        sys.exit(1)
+
+    main(sys.argv[1], *map(int, sys.argv[2:3]))
@@ -0,0 +1,140 @@
+#############################################################################
+#
+# Author: Milan Patel
+# Purpose: Microbenchmark of the wikitable parsing on saved Wikipedia pages
+# Date: 06/05/2018
+#
+# Usage: python bench_tables.py <directory of saved wikipedia pages> [repeat]
+#
+#############################################################################
+
+import os
+import sys
+import glob
+import timeit
+import lxml.html as l_html
+from urllib.parse import urljoin
+from collections import defaultdict
+
+from tools import (
+    wikitable_xpath,
+    table_row_xpath,
+    table_data_xpath,
+    table_header_xpath,
+    descendant_xpath
+)
+
+from parse_html import (
+    _base_url,
+    replace_space,
+    parse_table
+)
+
+def dict_to_list(dict_table):
+    for i, row in sorted(dict_table.items()):
+        cols = []
+
+        for j, col in sorted(row.items()):
+            cols.append(col)
+
+        yield cols
+
+def dict_parse_table(etable, prefer_text):
+    """
+    The original nested defaultdict + per cell xpath version, kept here
+    as the baseline
+    """
+    dict_table = defaultdict(lambda: defaultdict(str))
+    for row_i, row in enumerate(etable.xpath(table_row_xpath)):
+
+        for col_i, col in enumerate(row.xpath('{}|{}'.format(
+            table_data_xpath, table_header_xpath))):
+
+            col_span = int(col.get('colspan', 1))
+            row_span = int(col.get('rowspan',1))
+            links = []
+            text = replace_space(col)
+            for info in col.xpath(descendant_xpath):
+                if 'href' in info.attrib:
+                    links.append(info.get('href'))
+
+            links = [l for l in links if 'wiki' in l]
+            links = list(map(lambda tail: urljoin(_base_url, tail), links))
+
+            while row_i in dict_table and col_i in dict_table[row_i]:
+                col_i += 1
+
+            for i in range(row_i, row_i + row_span):
+                for j in range(col_i, col_i + col_span):
+
+                    if prefer_text:
+                        dict_table[i][j] = text
+
+                    elif len(links) == 1:
+                        dict_table[i][j] = links[0]
+
+                    elif len(links):
+                        dict_table[i][j] = links
+
+                    else:
+                        dict_table[i][j] = text
+
+    return list(dict_to_list(dict_table))
+
+def load_tables(directory):
+
+    tables = []
+
+    for path in sorted(glob.glob(os.path.join(directory, '*.htm*'))):
+
+        with open(path, 'rb') as f:
+            root = l_html.fromstring(f.read())
+
+        tables.extend(
+            (os.path.basename(path), table)
+            for table in root.xpath(wikitable_xpath)
+        )
+
+    return tables
+
+def main(directory, repeat=5):
+
+    tables = load_tables(directory)
+
+    if not tables:
+        raise RuntimeError('No wikitables found in: {}'.format(directory))
+
+    print('{} tables'.format(len(tables)))
+
+    for prefer_text in (True, False):
+
+        mismatched = set(
+            name for name, table in tables
+            if dict_parse_table(table, prefer_text) != parse_table(table, prefer_text)
+        )
+
+        for name in sorted(mismatched):
+            print('Output differs for: {} (prefer_text={})'.format(name, prefer_text))
+
+        results = {}
+        for label, f in [('dict', dict_parse_table), ('grid', parse_table)]:
+
+            best = min(timeit.repeat(
+                lambda: [f(table, prefer_text) for _, table in tables],
+                number=1,
+                repeat=repeat
+            ))
+
+            results[label] = best
+            print('{:>8} (prefer_text={}): {:.4f}s total, {:.3f}ms/table'.format(
+                label, prefer_text, best, 1000. * best / len(tables)))
+
+        print('Speedup: {:.2f}x'.format(results['dict'] / results['grid']))
+
+if __name__ == '__main__':
+
+    if len(sys.argv) < 2:
+        print('Usage: python bench_tables.py <pages_dir> [repeat]')
+        sys.exit(1)
+
+    main(sys.argv[1], *map(int, sys.argv[2:3]))
@@ -0,0 +1,319 @@
+#############################################################################
+#
+# Author: Milan Patel
+# Purpose: Flat memory-mapped export of the lyrics for analysis jobs that
+#          shouldn't have to go through mongo
+# Date: 06/05/2018
+#
+# Usage: python corpus.py <export directory>
+#
+#############################################################################
+
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import tempfile
+import numpy as np
+
+import database
+
+from database import (
+    get_collection,
+    initialize_alias,
+    UNKNOWN_DATE
+)
+
+from tools import (
+    NO_LYRICS
+)
+
+BLOB_NAME = 'lyrics.bin'
+META_NAME = 'corpus.json'
+INDEX_NAMES = ('offsets', 'ids', 'dates', 'artist_ids', 'album_ids')
+DEFAULT_CHUNK_SIZE = 5000
+
+def _index_path(directory, name):
+    return os.path.join(directory, '{}.npy'.format(name))
+
+def _save(directory, name, array):
+    np.save(_index_path(directory, name), array)
+
+def _build_prefix(directory):
+    # Hidden and distinct from anything a user would name a directory
+    return '.{}-build-'.format(os.path.basename(directory))
+
+def _relink(link, target):
+
+    temporary = '{}.{}.link'.format(link, os.getpid())
+    os.symlink(os.path.basename(target), temporary)
+    os.replace(temporary, link)
+
+def _swap_in(directory, built):
+    """
+    `directory` is a symlink to the export, pointing it at a new one is
+    a single rename. The export it replaced is kept for readers that
+    are still opening it and remembered by a second link, the one that
+    link pointed at before goes. Nothing else in the parent directory
+    is touched, builds still in progress included
+    """
+    directory = os.path.abspath(directory)
+    parent = os.path.dirname(directory)
+    built = os.path.realpath(built)
+    kept = os.path.join(parent, '.{}.previous'.format(os.path.basename(directory)))
+    previous = None
+    retired = None
+
+    if os.path.islink(directory):
+        previous = os.path.realpath(directory)
+
+    elif os.path.isdir(directory):
+        # A plain directory from before exports were swapped in
+        previous = tempfile.mkdtemp(prefix=_build_prefix(directory), dir=parent)
+        os.rmdir(previous)
+        os.rename(directory, previous)
+        previous = os.path.realpath(previous)
+
+    if os.path.islink(kept):
+        retired = os.path.realpath(kept)
+
+    _relink(directory, built)
+
+    if previous is not None:
+        _relink(kept, previous)
+
+    if retired is not None and retired not in (built, previous) \
+        and os.path.isdir(retired):
+
+        shutil.rmtree(retired, ignore_errors=True)
+
+def _id_or_unknown(doc, field):
+
+    value = doc.get(field, None)
+    return -1 if value is None else value
+
+def export_corpus(identity, directory, query=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Writes the lyrics of every song matching `query` back to back into
+    one utf-8 blob, in genius_id order, along with the index arrays:
+
+        offsets     int64, n + 1, song i is blob[offsets[i]:offsets[i + 1]]
+        ids         int64, genius ids, sorted
+        dates       datetime64[D], NaT when unknown
+        artist_ids  int64, -1 when unknown
+        album_ids   int64, -1 when unknown
+
+    Songs without lyrics get an empty slice. The export is built in a
+    directory of its own next to `directory` and only then swapped in,
+    so a reader sees either the whole old export or the whole new one,
+    never a mix. Returns the number of songs
+    """
+    log = logging.getLogger(str(os.getpid()))
+    start = time.time()
+
+    parent = os.path.dirname(os.path.abspath(directory))
+
+    if not os.path.exists(parent):
+        os.makedirs(parent)
+
+    built = tempfile.mkdtemp(
+        prefix=_build_prefix(os.path.abspath(directory)), dir=parent)
+
+    cursor = get_collection(identity, database.Song).find(
+        query or {},
+        {
+            '_id': 0,
+            'genius_id': 1,
+            'lyrics': 1,
+            'release_date': 1,
+            'artist_id': 1,
+            'album_id': 1
+        }
+    ).sort('genius_id', 1).batch_size(chunk_size)
+
+    columns = {name: [] for name in INDEX_NAMES}
+    columns['offsets'].append(0)
+    position = 0
+
+    try:
+        with open(os.path.join(built, BLOB_NAME), 'wb') as blob:
+
+            for doc in cursor:
+
+                lyrics = doc.get('lyrics', None)
+
+                if lyrics and lyrics != NO_LYRICS:
+                    data = lyrics.encode('utf-8')
+                    blob.write(data)
+                    position += len(data)
+
+                release_date = doc.get('release_date', None)
+
+                if release_date is None or release_date <= UNKNOWN_DATE:
+                    release_date = None
+
+                columns['offsets'].append(position)
+                columns['ids'].append(doc['genius_id'])
+                columns['dates'].append(release_date)
+                columns['artist_ids'].append(_id_or_unknown(doc, 'artist_id'))
+                columns['album_ids'].append(_id_or_unknown(doc, 'album_id'))
+
+        _save(built, 'offsets', np.array(columns['offsets'], dtype=np.int64))
+        _save(built, 'ids', np.array(columns['ids'], dtype=np.int64))
+        _save(built, 'dates', np.array(
+            [d if d is None else d.date() for d in columns['dates']],
+            dtype='datetime64[D]'
+        ))
+        _save(built, 'artist_ids', np.array(columns['artist_ids'], dtype=np.int64))
+        _save(built, 'album_ids', np.array(columns['album_ids'], dtype=np.int64))
+
+        count = len(columns['ids'])
+
+        with open(os.path.join(built, META_NAME), 'w') as f:
+            json.dump({
+                'songs': count,
+                'bytes': position,
+                'query': repr(query),
+                'exported': time.time()
+            }, f)
+
+        # mkdtemp only lets the owner in
+        os.chmod(built, 0o755)
+        _swap_in(directory, built)
+
+    except:
+        shutil.rmtree(built, ignore_errors=True)
+        raise
+
+    log.info('Exported {} songs, {:.1f} MB of lyrics in {:.1f}s'.format(
+        count, position / 1024. ** 2, time.time() - start))
+
+    return count
+
+class Corpus(object):
+    """
+    Read side of export_corpus. The blob and the index arrays are memory
+    mapped, so opening is instant and every process that opens the same
+    export shares the pages through the OS instead of holding its own
+    copy. Pickling only carries the directory, hand a Corpus to a
+    worker process and it maps the files itself.
+
+        corpus = Corpus('data_path/corpus')
+        corpus.text(i)                  lyrics of the i-th song
+        corpus.lyrics(genius_id)        same, by genius id
+        for ids, texts in corpus.chunks(2000, start, stop): ...
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._open()
+
+    def _open(self):
+
+        # Once, so a swap halfway through can't mix two exports
+        directory = os.path.realpath(self.directory)
+
+        for name in INDEX_NAMES:
+            setattr(self, name, np.load(_index_path(directory, name), mmap_mode='r'))
+
+        # Can't map an empty file
+        blob_path = os.path.join(directory, BLOB_NAME)
+
+        if os.path.getsize(blob_path):
+            self.blob = np.memmap(blob_path, dtype=np.uint8, mode='r')
+        else:
+            self.blob = np.zeros(0, dtype=np.uint8)
+
+    def __getstate__(self):
+        return {'directory': self.directory}
+
+    def __setstate__(self, state):
+        self.directory = state['directory']
+        self._open()
+
+    def __len__(self):
+        return len(self.ids)
+
+    def raw(self, i):
+        """
+        The lyrics bytes of the i-th song as a view into the mapping
+        """
+        return self.blob[self.offsets[i]:self.offsets[i + 1]]
+
+    def text(self, i):
+        return self.raw(i).tobytes().decode('utf-8')
+
+    def position(self, genius_id):
+        """
+        Index of a song by genius id, -1 if it wasn't exported
+        """
+        i = int(np.searchsorted(self.ids, genius_id))
+
+        if i < len(self.ids) and self.ids[i] == genius_id:
+            return i
+
+        return -1
+
+    def lyrics(self, genius_id):
+
+        i = self.position(genius_id)
+
+        if i < 0:
+            raise KeyError(genius_id)
+
+        return self.text(i)
+
+    def texts(self, start=0, stop=None):
+        """
+        Decodes a contiguous run of songs with one slice of the blob
+        """
+        stop = len(self) if stop is None else stop
+        offsets = self.offsets[start:stop + 1]
+
+        if not len(offsets):
+            return []
+
+        data = self.blob[offsets[0]:offsets[-1]].tobytes()
+        bounds = (offsets - offsets[0]).tolist()
+
+        return [
+            data[bounds[j]:bounds[j + 1]].decode('utf-8')
+            for j in range(len(bounds) - 1)
+        ]
+
+    def chunks(self, chunk_size=DEFAULT_CHUNK_SIZE, start=0, stop=None):
+        """
+        (ids, texts) for consecutive runs of at most `chunk_size` songs
+        """
+        stop = len(self) if stop is None else min(stop, len(self))
+
+        for low in range(start, stop, chunk_size):
+
+            high = min(low + chunk_size, stop)
+            yield self.ids[low:high], self.texts(low, high)
+
+    def shards(self, count):
+        """
+        Splits the songs into `count` (start, stop) runs holding about the
+        same number of lyrics bytes each
+        """
+        targets = np.linspace(0, self.offsets[-1], count + 1)[1:-1]
+        cuts = np.searchsorted(self.offsets, targets).tolist()
+        bounds = [0] + cuts + [len(self)]
+
+        return [
+            (low, high) for low, high in zip(bounds[:-1], bounds[1:])
+            if high > low
+        ]
+
+if __name__ == '__main__':
+
+    if len(sys.argv) < 2:
+        print('Usage: python corpus.py <export directory>')
+        sys.exit(1)
+
+    logging.basicConfig(level=logging.INFO)
+    initialize_alias(str(os.getpid()))
+    export_corpus(str(os.getpid()), sys.argv[1])
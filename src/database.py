@@ -9,12 +9,17 @@
 
 import os
 import sys
+import time
 import logging
+import threading
 import subprocess as sp
+from contextlib import contextmanager
+from collections import OrderedDict
 from mongoengine import (
 	Document,
 	StringField,
 	IntField,
+	FloatField,
 	ListField,
 	DateTimeField,
 	connect
@@ -28,39 +33,151 @@ from mongoengine.context_managers import (
 	switch_db
 )
 
+from pymongo import (
+	UpdateOne
+)
+
+from pymongo.errors import (
+	BulkWriteError
+)
+
 from datetime import datetime
 
 from tools import (
 	popen
 )
 
+import metrics
+
 __all__ = (
 	'initialize_mongo_db',
 	'initialize_alias',
+	'set_db_name',
+	'drop_database',
+	'ensure_indexes',
+	'explain_hot_queries',
 	'query',
-	'insert'
+	'insert',
+	'db_find',
+	'db_exists',
+	'db_aggregate',
+	'db_unset_changed',
+	'BulkWriter',
+	'UNKNOWN_DATE'
 )
 
 logger = logging.getLogger(__name__)
 _DEFAULT_MONGO_PATH = os.path.join(os.getcwd(), 'data_dir')
 _DB_NAME = 'hippityhoppity'
+_DEFAULT_BATCH_SIZE = 500
+_DEFAULT_FLUSH_INTERVAL = 5.
+
+# What Song.release_date holds when the date isn't known, anything
+# after it is a real date
+UNKNOWN_DATE = datetime(1500, 1, 1)
+
+# Per process, per alias metadata. See check_collection/get_collection
+_COLLECTION_NAMES = {}
+_COLLECTION_HANDLES = {}
+_META_LOCK = threading.Lock()
+
+# switch_db swaps class level state on the Document, so only one thread
+# at a time gets to be inside one
+_SWITCH_LOCK = threading.Lock()
 
 class Artist(Document):
 	name = StringField(max_length=200)
 	genius_id = IntField(unique=True, min_value=0)
 	song_ids = ListField(field=IntField(min_value=0))
 
+	meta = {
+		# Resolving an artist by name before going out to search
+		'indexes': ['name']
+	}
+
 class Song(Document):
 	genius_id = IntField(required=True, unique=True, min_value=0)
-	release_date = DateTimeField(default=datetime(1500, 1, 1))
+	release_date = DateTimeField(default=UNKNOWN_DATE)
 	lyrics = StringField()
 	album_id = IntField(min_value=0)
+	artist_id = IntField(min_value=0)
+	sentiment = FloatField()
+	sentiment_comparative = FloatField()
+	sentiment_hits = IntField(min_value=0)
+	token_count = IntField(min_value=0)
+	lyrics_hash = StringField(max_length=40)
+	scorer_version = StringField()
+
+	meta = {
+		# Incremental scoring looks for songs not scored by the current
+		# scorer, storing lyrics clears the version. The rest back the
+		# per album/year/artist lookups and rollup rebuilds
+		'indexes': [
+			'scorer_version',
+			'album_id',
+			'release_date',
+			('artist_id', 'release_date')
+		]
+	}
 
 class Album(Document):
 	genius_id = IntField(unique=True, min_value=0)
 	release_date = DateTimeField()
 	song_ids = ListField(field=IntField(min_value=0))
 
+	meta = {
+		'indexes': ['release_date']
+	}
+
+class Rollup(Document):
+	"""
+	Running sentiment totals for one year/artist/album. Mean and
+	standard deviation fall out of count, total and total_sq, and all
+	three can be kept up to date with $inc
+	"""
+	key = IntField(required=True, unique=True)
+	count = IntField(default=0)
+	total = FloatField(default=0.)
+	total_sq = FloatField(default=0.)
+
+	meta = {
+		'abstract': True
+	}
+
+class YearRollup(Rollup):
+	pass
+
+class ArtistRollup(Rollup):
+	pass
+
+class AlbumRollup(Rollup):
+	pass
+
+MODELS = (
+	Artist,
+	Song,
+	Album,
+	YearRollup,
+	ArtistRollup,
+	AlbumRollup
+)
+
+# The lookups the scraper/scorer make over and over, (label, model, filter)
+HOT_QUERIES = (
+	('song by genius_id', Song, {'genius_id': 1}),
+	('album by genius_id', Album, {'genius_id': 1}),
+	('artist by genius_id', Artist, {'genius_id': 1}),
+	('artist by name', Artist, {'name': ''}),
+	('songs on album', Song, {'album_id': 1}),
+	('stale songs', Song, {'scorer_version': {'$ne': ''}}),
+	('songs by year', Song, {'release_date': {'$gt': UNKNOWN_DATE}}),
+	('artist songs by date', Song, {
+		'artist_id': 1,
+		'release_date': {'$gt': UNKNOWN_DATE}
+	}),
+	('rollup by key', YearRollup, {'key': 1}),
+)
+
 def initialize_mongo_db(directory=_DEFAULT_MONGO_PATH):
 	# Initialize the mongo db underneath for serving the database
 	if not os.path.exists(directory):
@@ -91,18 +208,199 @@ def initialize_alias(identity):
 		alias=identity
 	)
 
-def check_collection(identity, collection):
+def set_db_name(name):
+	"""
+	Points every alias connected after this at another database,
+	processes forked after this inherit it
+	"""
+	global _DB_NAME
+	_DB_NAME = name
+
+def drop_database(identity):
+	"""
+	Drops the whole database behind an alias
+	"""
+	db = get_db(str(identity))
+	db.client.drop_database(db.name)
+	invalidate_collection_cache(identity)
+
+def collection_name(collection):
 
-	if issubclass(collection, Document):
-		coll_name = collection._get_collection().name
-	elif isisntance(collection, str):
-		coll_name = collection
+	if isinstance(collection, type) and issubclass(collection, Document):
+		return collection._get_collection_name()
+	elif isinstance(collection, str):
+		return collection
 	else:
 		raise RuntimeError('Collection references must be string or Document type!')
 
-	db = get_db(identity)
+def _cache_key(identity):
+	# Connections (and anything hanging off of them) don't survive a fork
+	return (os.getpid(), str(identity))
+
+def invalidate_collection_cache(identity=None):
+	"""
+	Forget what we know about the collections under an alias (or every
+	alias). Call this after dropping collections out from under us
+	"""
+	with _META_LOCK:
+
+		if identity is None:
+			_COLLECTION_NAMES.clear()
+			_COLLECTION_HANDLES.clear()
+			return
+
+		key = _cache_key(identity)
+		_COLLECTION_NAMES.pop(key, None)
+
+		for handle_key in [k for k in _COLLECTION_HANDLES if k[0] == key]:
+			del _COLLECTION_HANDLES[handle_key]
+
+def mark_collection(identity, collection):
+	"""
+	Record that a collection exists now that we've written to it
+	"""
+	with _META_LOCK:
+		names = _COLLECTION_NAMES.get(_cache_key(identity), None)
+
+		if names is not None:
+			names.add(collection_name(collection))
+
+def check_collection(identity, collection):
+	"""
+	Collections only ever show up during a run, so a name we have seen
+	is trusted and only a miss goes back to the server for a listing
+	"""
+	coll_name = collection_name(collection)
+	key = _cache_key(identity)
+
+	with _META_LOCK:
+		names = _COLLECTION_NAMES.get(key, None)
+
+		if names is not None and coll_name in names:
+			return True
+
+	db = get_db(str(identity))
+
+	with metrics.timed('db_seconds', op='list_collections'):
+		names = set(db.list_collection_names())
+
+	with _META_LOCK:
+		_COLLECTION_NAMES[key] = names
+
+	return coll_name in names
+
+@contextmanager
+def _switched(collection, identity):
+	"""
+	switch_db that is safe to use from several threads, the threaded
+	scraper stages all end up in here
+	"""
+	with _SWITCH_LOCK:
+		with switch_db(collection, str(identity)) as interface:
+			yield interface
+
+def get_collection(identity, collection):
+	"""
+	Long lived pymongo collection handle for an alias, this skips the
+	switch_db dance for the raw/bulk paths
+	"""
+	key = (_cache_key(identity), collection_name(collection))
+
+	with _META_LOCK:
+		handle = _COLLECTION_HANDLES.get(key, None)
+
+	if handle is not None:
+		return handle
+
+	# Not under _META_LOCK, db_insert takes the locks the other way round
+	if isinstance(collection, str):
+		handle = get_db(str(identity))[key[1]]
+
+	else:
+		# Going through mongoengine once makes sure the declared
+		# indexes exist before anything writes around it
+		with _switched(collection, identity) as interface:
+			handle = interface._get_collection()
+
+	with _META_LOCK:
+		return _COLLECTION_HANDLES.setdefault(key, handle)
+
+def ensure_indexes(identity, rebuild=False):
+	"""
+	Builds every index declared in the model meta. With `rebuild` the
+	existing indexes (except _id) are dropped first, use that after
+	changing a declaration. Returns {collection: {'missing', 'extra'}}
+	as it stood before anything was built
+	"""
+	log = logging.getLogger(str(os.getpid()))
+	report = OrderedDict()
+
+	for model in MODELS:
+
+		with _switched(model, identity) as interface:
+
+			report[collection_name(model)] = interface.compare_indexes()
+
+			if rebuild:
+				interface._get_collection().drop_indexes()
+
+			interface.ensure_indexes()
+
+		log.info('Indexes on {}: {}'.format(
+			collection_name(model),
+			', '.join(sorted(get_collection(identity, model).index_information()))
+		))
+
+	invalidate_collection_cache(identity)
+	return report
+
+def _plan_stages(plan):
+
+	stages = []
+
+	if isinstance(plan, dict):
+
+		if 'stage' in plan:
+			stages.append(plan['stage'])
+
+		for value in plan.values():
+			stages.extend(_plan_stages(value))
 
-	return coll_name in db.collection_names()
+	elif isinstance(plan, list):
+
+		for value in plan:
+			stages.extend(_plan_stages(value))
+
+	return stages
+
+def explain_hot_queries(identity, queries=HOT_QUERIES):
+	"""
+	Runs explain() on the queries the scraper and scorer lean on and
+	reports which plan won. Anything that ends up scanning the whole
+	collection gets logged as a warning. Returns a list of
+	{label, collection, stages, collscan}
+	"""
+	log = logging.getLogger(str(os.getpid()))
+	results = []
+
+	for label, model, query in queries:
+
+		plan = get_collection(identity, model).find(query).limit(1).explain()
+		stages = _plan_stages(plan.get('queryPlanner', {}).get('winningPlan', {}))
+		collscan = 'COLLSCAN' in stages
+
+		results.append({
+			'label': label,
+			'collection': collection_name(model),
+			'stages': stages,
+			'collscan': collscan
+		})
+
+		if collscan:
+			log.warning('Collection scan for {} on {}: {}'.format(
+				label, collection_name(model), query))
+
+	return results
 
 def db_query(identity, collection, **query_args):
 	"""
@@ -111,44 +409,104 @@ def db_query(identity, collection, **query_args):
 	if not check_collection(identity, collection):
 		return []
 
-	with switch_db(collection, str(identity)) as interface:
+	with _switched(collection, identity) as interface:
 		try:
 			return interface.objects(**query_args)
 		except:
 			return []
 
+@metrics.timed('db_seconds', op='find')
+def db_find(identity, collection, fields=None, raw=True, limit=0, **query_args):
+	"""
+	Projected query that only loads `fields` (the _id always comes
+	along). With `raw` you get the pymongo dicts back, skipping the
+	Document construction entirely. Returns a list
+	"""
+	if not check_collection(identity, collection):
+		return []
+
+	with _switched(collection, identity) as interface:
+
+		results = interface.objects(**query_args)
+
+		if fields:
+			results = results.only(*fields)
+
+		if limit:
+			results = results.limit(limit)
+
+		if raw:
+			results = results.as_pymongo()
+
+		return list(results)
+
+@metrics.timed('db_seconds', op='exists')
+def db_exists(identity, collection, **query_args):
+	"""
+	Existence check that only asks for the _id of a single match
+	"""
+	if not check_collection(identity, collection):
+		return False
+
+	with _switched(collection, identity) as interface:
+		match = interface.objects(**query_args).only('id').as_pymongo().first()
+
+	return match is not None
+
+@metrics.timed('db_seconds', op='aggregate')
+def db_aggregate(identity, collection, pipeline, **kwargs):
+	"""
+	Runs an aggregation pipeline on the server, returns the result dicts
+	"""
+	return list(get_collection(identity, collection).aggregate(pipeline, **kwargs))
+
+@metrics.timed('db_seconds', op='update')
 def db_update(identity, collection, genius_id, **update_args):
 
 	if not check_collection(identity, collection):
 		return False
 
-	with switch_db(collection, str(identity)) as interface:
+	with _switched(collection, identity) as interface:
 		success = interface.objects(genius_id=genius_id).update_one(**update_args)
 
 	return success
 
+@metrics.timed('db_seconds', op='update')
+def db_unset_changed(identity, collection, genius_id, changed, value, unset):
+	"""
+	Removes the `unset` fields of a stored document unless its `changed`
+	field already holds `value`. Call it before writing the new value
+	"""
+	field = collection._fields[changed]
+
+	result = get_collection(identity, collection).update_one(
+		{'genius_id': genius_id, field.db_field: {'$ne': field.to_mongo(value)}},
+		{'$unset': {collection._fields[name].db_field: '' for name in unset}}
+	)
+
+	return result.modified_count
+
+@metrics.timed('db_seconds', op='insert')
 def db_insert(identity, collection: "Subclassed Document class", **query_args):
 	"""
 	Takes a collection class definition for selecting the appropriate
 	collection to do an insert
 	"""
 
-	with switch_db(collection, str(identity)) as interface:
+	with _switched(collection, identity) as interface:
 
-		# First check to see if query returns anything:
-		query_results = db_query(identity, collection, **query_args)
-		
-		# for key, value in query_args.items():
+		# First check to see if query returns anything. No need to list
+		# the collections first, a missing one just comes back empty
+		try:
+			query_results = list(interface.objects(**query_args).limit(2))
+		except:
+			query_results = []
 
-		# 	query_results.extend(
-		# 		db_query(identity, collection, **{key:value})
-		# 	
-		
 		if query_results:
 
 			if len(query_results) == 1:
 
-				query = list(query_results).pop()
+				query = query_results.pop()
 				return query.modify(query=None, **query_args)
 			else:
 				raise RuntimeError('Too many already existing records for args: {}'.format(
@@ -165,10 +523,314 @@ def db_insert(identity, collection: "Subclassed Document class", **query_args):
 			return False
 
 		else:
+			mark_collection(identity, collection)
 			return True
 
 
+class BulkWriter(object):
+	"""
+	Batched alternative to db_insert/db_update. Documents are buffered
+	per collection and flushed as unordered bulk upserts keyed on
+	genius_id, which is one round-trip per batch instead of three per
+	document. A flush happens once `batch_size` documents are waiting
+	or `flush_interval` seconds have passed since the last one, checked
+	whenever something is added. Always close() (or use it as a context
+	manager) so the tail of the buffer makes it in.
+
+	`on_flush(collection, genius_ids)` is called after every flush with
+	the ids that actually made it to the database.
+
+	Unsets can be made conditional on a field changing, say dropping
+	the scorer_version only when the lyrics_hash being written isn't
+	the one already stored. Those go out in their own bulk ahead of
+	the upserts, while the old value is still there to compare with.
+	"""
+
+	def __init__(self, identity, batch_size=_DEFAULT_BATCH_SIZE,
+		flush_interval=_DEFAULT_FLUSH_INTERVAL, on_flush=None):
+
+		self.identity = str(identity)
+		self.on_flush = on_flush
+		self.batch_size = batch_size
+		self.flush_interval = flush_interval
+
+		self._buffers = OrderedDict()
+		self._pending = 0
+		self._last_flush = time.monotonic()
+		self._lock = threading.RLock()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc_info):
+		self.close()
+
+	def _to_update(self, collection, fields):
+
+		# Validate the same way save() would
+		collection(**fields).validate()
+
+		to_set = {}
+		for name, value in fields.items():
+
+			if value is None:
+				continue
+
+			field = collection._fields[name]
+			to_set[field.db_field] = field.to_mongo(value)
+
+		# Defaults only for brand new documents, never clobber
+		on_insert = {}
+		for name, field in collection._fields.items():
+
+			if fields.get(name, None) is not None or name == 'id' \
+				or field.default is None:
+				continue
+
+			default = field.default() if callable(field.default) else field.default
+			on_insert[field.db_field] = field.to_mongo(default)
+
+		return to_set, on_insert
+
+	def add(self, collection, unset=(), changed=None, **fields):
+		"""
+		Queue an upsert, returns False if the document doesn't validate.
+		Fields named in `unset` are removed from the stored document,
+		only if the stored value of the field named `changed` differs
+		from the one being written when that's given
+		"""
+		genius_id = fields.get('genius_id', None)
+
+		if genius_id is None:
+			raise RuntimeError('Bulk writes are keyed on genius_id!')
+
+		try:
+			to_set, on_insert = self._to_update(collection, fields)
+			to_unset = set(collection._fields[name].db_field for name in unset)
+			guard = None
+
+			if changed is not None:
+				field = collection._fields[changed]
+				guard = (field.db_field, field.to_mongo(fields[changed]), to_unset)
+				to_unset = set()
+
+		except Exception:
+			log = logging.getLogger(str(os.getpid()))
+			log.exception('Failed to validate document: {}'.format(str(fields)))
+			return False
+
+		with self._lock:
+			buffered = self._buffers.setdefault(collection, OrderedDict())
+
+			if genius_id in buffered:
+				old_set, old_insert, old_unset, old_guard = buffered[genius_id]
+				old_set.update(to_set)
+				old_unset.update(to_unset)
+				buffered[genius_id] = (old_set, old_insert, old_unset,
+					guard or old_guard)
+			else:
+				buffered[genius_id] = (to_set, on_insert, to_unset, guard)
+				self._pending += 1
+
+			if self._pending >= self.batch_size or \
+				time.monotonic() - self._last_flush >= self.flush_interval:
+
+				self.flush()
+
+		return True
+
+	def flush(self):
+		"""
+		Writes everything buffered, returns the number of documents
+		that failed
+		"""
+		with self._lock:
+			buffers = self._buffers
+			self._buffers = OrderedDict()
+			self._pending = 0
+			self._last_flush = time.monotonic()
+
+		failed = 0
+		batches = list(buffers.items())
+
+		for done, (collection, buffered) in enumerate(batches):
+
+			try:
+				handle = get_collection(self.identity, collection)
+				unguarded = self._write_guards(handle, collection, buffered)
+
+			except Exception:
+				# Lost connection and the like, nothing from this batch
+				# on is known to be written so it all goes back
+				self._requeue(batches[done:])
+				raise
+
+			requests = []
+			failed_at = set()
+
+			for genius_id, (to_set, on_insert, to_unset, guard) in buffered.items():
+
+				# Couldn't tell if the field changed, unset to be safe
+				if genius_id in unguarded:
+					to_unset = to_unset.union(guard[2])
+
+				update = {'$set': to_set}
+				to_unset = to_unset.difference(to_set)
+				on_insert = {
+					k: v for k, v in on_insert.items()
+					if k not in to_set and k not in to_unset
+				}
+
+				if on_insert:
+					update['$setOnInsert'] = on_insert
+
+				if to_unset:
+					update['$unset'] = {k: '' for k in to_unset}
+
+				requests.append(UpdateOne(
+					{'genius_id': genius_id}, update, upsert=True))
+
+			try:
+				with metrics.timed('db_seconds', op='bulk_write'):
+					handle.bulk_write(requests, ordered=False)
+
+			except BulkWriteError as e:
+				errors = e.details.get('writeErrors', [])
+				failed += len(errors)
+				failed_at.update(error.get('index', -1) for error in errors)
+
+				log = logging.getLogger(str(os.getpid()))
+				log.error('{} of {} bulk writes to {} failed, first: {}'.format(
+					len(errors),
+					len(requests),
+					collection.__name__,
+					errors[0].get('errmsg', '') if errors else ''
+				))
+
+			except Exception:
+				self._requeue(batches[done:])
+				raise
+
+			mark_collection(self.identity, collection)
+
+			if self.on_flush is not None:
+				self.on_flush(collection, [
+					genius_id for i, genius_id in enumerate(buffered)
+					if i not in failed_at
+				])
+
+		return failed
+
+	def _write_guards(self, handle, collection, buffered):
+		"""
+		Sends the conditional unsets of a batch ahead of its upserts,
+		while the stored values are still there to compare with. Returns
+		the genius ids whose unset may not have gone through, their
+		upserts unset the fields outright instead
+		"""
+		guarded = []
+
+		for genius_id, (to_set, _, _, guard) in buffered.items():
+
+			if guard is None:
+				continue
+
+			field, value, fields = guard
+			fields = fields.difference(to_set)
+
+			if fields:
+				guarded.append((genius_id, UpdateOne(
+					{'genius_id': genius_id, field: {'$ne': value}},
+					{'$unset': {k: '' for k in fields}}
+				)))
+
+		if not guarded:
+			return set()
+
+		try:
+			with metrics.timed('db_seconds', op='bulk_write'):
+				handle.bulk_write([request for _, request in guarded], ordered=False)
+
+		except BulkWriteError as e:
+			log = logging.getLogger(str(os.getpid()))
+
+			# Without the write concern none of them can be trusted
+			if e.details.get('writeConcernErrors', []):
+				failed_at = range(len(guarded))
+			else:
+				failed_at = [
+					error.get('index', -1) for error in e.details.get('writeErrors', [])
+				]
+
+			log.warning('{} of {} conditional unsets on {} failed, unsetting '
+				'outright'.format(len(failed_at), len(guarded), collection.__name__))
+
+			return set(guarded[i][0] for i in failed_at if 0 <= i < len(guarded))
+
+		return set()
+
+	def _requeue(self, batches):
+
+		with self._lock:
+
+			for collection, buffered in batches:
+
+				current = self._buffers.setdefault(collection, OrderedDict())
+
+				for genius_id, (to_set, on_insert, to_unset, guard) in buffered.items():
+
+					newer = current.get(genius_id, None)
+
+					if newer is None:
+						current[genius_id] = (to_set, on_insert, to_unset, guard)
+						self._pending += 1
+						continue
+
+					# Whatever was added since the failed flush wins
+					merged_set = {
+						k: v for k, v in to_set.items() if k not in newer[2]
+					}
+					merged_set.update(newer[0])
+
+					current[genius_id] = (
+						merged_set,
+						on_insert,
+						to_unset.difference(newer[0]).union(newer[2]),
+						newer[3] or guard
+					)
+
+	def close(self):
+		return self.flush()
+
+
 if __name__ == '__main__':
 
-	initialize_alias(os.getpid())
-	record = Album(genius_id=354556)
+	# python database.py indexes [--rebuild] | explain
+	command = sys.argv[1] if len(sys.argv) > 1 else ''
+
+	if command not in ('indexes', 'explain'):
+		print('Usage: python database.py indexes [--rebuild] | explain')
+		sys.exit(1)
+
+	logging.basicConfig(level=logging.INFO)
+	identity = str(os.getpid())
+	initialize_alias(identity)
+
+	if command == 'indexes':
+
+		for name, diff in ensure_indexes(identity, '--rebuild' in sys.argv).items():
+			print('{:>14}: missing {} extra {}'.format(
+				name, diff['missing'], diff['extra']))
+
+	else:
+		results = explain_hot_queries(identity)
+
+		for result in results:
+			print('{:>5} {:<22} {:<14} {}'.format(
+				'SCAN' if result['collscan'] else 'ok',
+				result['label'],
+				result['collection'],
+				' <- '.join(result['stages'])
+			))
+
+		sys.exit(int(any(result['collscan'] for result in results)))
@@ -0,0 +1,247 @@
+#############################################################################
+#
+# Author: Milan Patel
+# Purpose: Asynchronous client for the genius API. One client holds one
+#          bounded connection pool so a single worker can keep many
+#          requests in flight over keep-alive connections
+# Date: 06/05/2018
+#
+#############################################################################
+
+import os
+import json
+import time
+import asyncio
+import aiohttp
+from urllib.parse import urljoin, urlsplit
+
+import metrics
+
+from rate_limit import (
+    RETRY_STATUSES
+)
+
+from http_cache import (
+    get_recorder,
+    conditional_headers
+)
+
+GENIUS_BASE = os.environ.get('GENIUS_BASE', 'http://api.genius.com')
+GENIUS_WEB_BASE = os.environ.get('GENIUS_WEB_BASE', 'http://genius.com')
+DEFAULT_CONNECTIONS = 32
+DEFAULT_TIMEOUT = 60
+MAX_RETRIES = 3
+
+class GeniusClient(object):
+    """
+    Async counterpart to the get_* functions in genius_scraper. Every
+    API method returns the unwrapped 'response' object (or None) just
+    like the synchronous versions do, so the parsing code is shared.
+
+    API calls draw from `limiter` (a rate_limit.TokenBucket) when one is
+    given and 429/5xx responses are retried after backing off. Passing an
+    http_cache.ResponseCache replays responses from disk.
+
+    Use it as an async context manager so the pool gets closed:
+
+        async with GeniusClient(token) as client:
+            response = await client.get_search('Kanye West')
+    """
+
+    def __init__(self, token, base=GENIUS_BASE, web_base=GENIUS_WEB_BASE,
+        max_connections=DEFAULT_CONNECTIONS, max_in_flight=None,
+        timeout=DEFAULT_TIMEOUT, limiter=None, retries=MAX_RETRIES,
+        cache=None):
+
+        self.base = base
+        self.web_base = web_base
+        self.max_connections = max_connections
+        self.max_in_flight = max_in_flight or max_connections
+        self.timeout = timeout
+        self.limiter = limiter
+        self.retries = retries
+        self.cache = cache
+        self.headers = {
+            'Authorization' : 'Bearer {}'.format(token)
+        }
+
+        self._session = None
+        self._in_flight = None
+
+    async def open(self):
+
+        if self._session is None:
+            connector = aiohttp.TCPConnector(
+                limit=self.max_connections,
+                limit_per_host=self.max_connections,
+                ttl_dns_cache=300
+            )
+
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=self.timeout)
+            )
+
+            self._in_flight = asyncio.Semaphore(self.max_in_flight)
+
+        return self
+
+    async def close(self):
+
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def __aenter__(self):
+        return await self.open()
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def _fetch(self, url, params=None, headers=None, limited=False,
+        api=False):
+        """
+        Returns (status, body). Goes through the response cache when the
+        client has one, `limited` requests draw from the rate limiter
+        and get retried on 429/5xx. `api` requests get timed per endpoint
+        """
+        if self._session is None:
+            raise RuntimeError('Client session is not open!')
+
+        entry = None
+
+        if self.cache is not None:
+            entry = await self._off_loop(self.cache.lookup, url, params)
+
+            if entry is not None and entry.fresh:
+                metrics.inc('http_cache_total', result='hit')
+                return self._recorded(url, params, 200, entry.content_type, entry.body)
+
+        request_headers = dict(headers or {})
+        request_headers.update(conditional_headers(entry))
+        retries = self.retries if limited else 0
+
+        for attempt in range(retries + 1):
+
+            if limited and self.limiter is not None:
+                with metrics.timed('rate_limit_wait_seconds'):
+                    await self.limiter.async_acquire()
+
+            async with self._in_flight:
+
+                start = time.perf_counter()
+
+                async with self._session.get(url, params=params,
+                    headers=request_headers) as r:
+
+                    elapsed = time.perf_counter() - start
+                    metrics.observe('http_request_seconds', elapsed,
+                        host=urlsplit(url).netloc)
+
+                    if api:
+                        metrics.observe('genius_api_seconds', elapsed,
+                            endpoint=metrics.endpoint(url))
+                        metrics.inc('genius_api_responses_total',
+                            endpoint=metrics.endpoint(url), status=r.status)
+
+                    if not limited:
+                        retry = False
+                    elif self.limiter is not None:
+                        retry = self.limiter.update(
+                            r.status, r.headers.get('Retry-After'))
+                    else:
+                        retry = r.status in RETRY_STATUSES
+
+                    if retry and attempt < retries:
+
+                        # The limiter already blocks everybody on a
+                        # penalty, without one back off on our own
+                        if self.limiter is None:
+                            await asyncio.sleep(2 ** attempt)
+
+                        continue
+
+                    body = await r.read()
+                    status = r.status
+                    response_headers = r.headers
+                    break
+
+        if status == 304 and entry is not None:
+            metrics.inc('http_cache_total', result='revalidated')
+            await self._off_loop(self.cache.revalidate, url, params)
+            return self._recorded(url, params, 200, entry.content_type, entry.body)
+
+        metrics.inc('http_cache_total',
+            result='miss' if self.cache is not None else 'off')
+
+        if status == 200 and self.cache is not None:
+            await self._off_loop(self.cache.store, url, params, body,
+                response_headers)
+
+        return self._recorded(url, params, status,
+            response_headers.get('Content-Type', None), body)
+
+    async def _off_loop(self, f, *args):
+
+        # The cache is sqlite plus files, keep that off the event loop
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, f, *args)
+
+    def _recorded(self, url, params, status, content_type, body):
+
+        recorder = get_recorder()
+
+        if recorder is not None:
+            recorder.record(url, params, status, content_type, body)
+
+        return status, body
+
+    async def _get_json(self, path, params):
+
+        url = urljoin(self.base, path)
+        _, body = await self._fetch(url, params, self.headers, limited=True,
+            api=True)
+        response = json.loads(body)
+
+        return response.get('response', None)
+
+    async def get_artist(self, artist_id):
+        return await self._get_json(
+            'artists/{}'.format(artist_id),
+            {'text_format': 'plain'}
+        )
+
+    async def get_artist_songs(self, artist_id, page, sort='title',
+        per_page=50):
+
+        return await self._get_json(
+            'artists/{}/songs'.format(artist_id),
+            {'sort': sort, 'per_page': per_page, 'page': page}
+        )
+
+    async def get_song(self, song_id):
+        return await self._get_json(
+            'songs/{}'.format(song_id),
+            {'text_format': 'plain'}
+        )
+
+    async def get_album(self, album_id):
+        return await self._get_json(
+            'albums/{}'.format(album_id),
+            {'text_format': 'plain'}
+        )
+
+    async def get_search(self, query):
+        return await self._get_json(
+            'search/',
+            {'text_format': 'plain', 'q': str(query)}
+        )
+
+    async def get_web_link(self, url):
+
+        status, body = await self._fetch(url)
+
+        if status == 200:
+            return body
+
+        return None
@@ -8,7 +8,6 @@
 
 
 import os
-import re
 import sys
 import json
 import time
@@ -16,32 +15,84 @@ import logging
 import logging.handlers
 import requests
 import database
+import metrics
 import traceback
 import signal
-import lxml.html as l_html
+import threading
+import asyncio
 from functools import partial
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from datetime import datetime
 from urllib.parse import urljoin
-from collections import defaultdict
-from multiprocessing import Process, Queue, Lock, cpu_count
+from collections import defaultdict, OrderedDict
+from multiprocessing import Process, Queue, Lock, Manager, cpu_count
 
 from tools import (
     counter,
+    TTLCache,
+    hash_lyrics,
     get_nonjson,
     parse_datetime,
-    lyrics_xpath
+    NO_LYRICS
 )
 
 from database import (
     initialize_mongo_db,
     initialize_alias,
-    db_query,
     db_insert,
-    db_update
+    db_update,
+    db_find,
+    db_exists,
+    db_unset_changed,
+    BulkWriter
+)
+
+from artist_index import (
+    ArtistIndex,
+    INDEX_NAME,
+    normalize_name
+)
+
+from journal import (
+    CrawlJournal
+)
+
+from metrics import (
+    MetricsServer,
+    SNAPSHOT_NAME
+)
+
+from scheduler import (
+    WorkStealingScheduler
+)
+
+from pipeline import (
+    Pipeline
+)
+
+from lyrics import (
+    extract_lyrics_text,
+    clean_lyrics
+)
+
+from rate_limit import (
+    TokenBucket,
+    DEFAULT_RATE,
+    DEFAULT_BURST,
+    RETRY_STATUSES
+)
+
+from http_cache import (
+    fetch,
+    get_cache
+)
+
+from genius_client import (
+    GeniusClient,
+    DEFAULT_CONNECTIONS
 )
 
 from parse_html import (
-    replace_space,
     replace_quotes
 )
 
@@ -52,10 +103,32 @@ RUNTIME_ARGS = {
     'token' : None,
 }
 
-GENIUS_BASE = 'http://api.genius.com'
-GENIUS_WEB_BASE = 'http://genius.com'
+# Overridable from the environment, say to point at a replay server
+GENIUS_BASE = os.environ.get('GENIUS_BASE', 'http://api.genius.com')
+GENIUS_WEB_BASE = os.environ.get('GENIUS_WEB_BASE', 'http://genius.com')
 DEFAULT_SLEEP = 2
+MAX_RETRIES = 3
 PIDS = set()
+UNKNOWN_DATE_TTL = 6 * 60 * 60
+JOURNAL_NAME = 'genius_journal.jsonl'
+PREFETCH_PAGES = 4
+SONG_BATCH = 8
+ALBUM_DATES = TTLCache(max_size=16384)
+_ALBUM_LOOKUPS = {}
+_SESSION_LOCK = threading.Lock()
+
+def set_bases(api=None, web=None):
+    """
+    Points the scraper at other API/web origins, workers forked after
+    this inherit them
+    """
+    global GENIUS_BASE, GENIUS_WEB_BASE
+
+    if api is not None:
+        GENIUS_BASE = api
+
+    if web is not None:
+        GENIUS_WEB_BASE = web
 
 def set_globals(access_token_path):
 
@@ -70,8 +143,11 @@ def set_globals(access_token_path):
 
     RUNTIME_ARGS['token'] = ACCESS_TOKEN
 
+    # Headers changed, so any existing session is stale
+    RUNTIME_ARGS['session'] = None
+
 def get_web_link(url):
-    r = requests.get(url)
+    r = fetch(requests, url)
 
     if r.status_code == 200:
         return r.content
@@ -79,80 +155,111 @@ def get_web_link(url):
     else:
         return None
 
-def get_artist(artist_id, sleep=DEFAULT_SLEEP):
-    time.sleep(sleep)
-    
-    url = urljoin(GENIUS_BASE, 'artists/{}'.format(artist_id))
-    session = RUNTIME_ARGS.get('session', None)
+def get_session():
+    """
+    One requests.Session per process so every API call reuses the same
+    keep-alive connection pool instead of handshaking each time
+    """
+    # The pipeline stages all come through here at once
+    with _SESSION_LOCK:
+        session = RUNTIME_ARGS.get('session', None)
+
+        if session is None:
+            session = requests.Session()
+            session.headers.update(RUNTIME_ARGS['headers'])
+            RUNTIME_ARGS['session'] = session
+
+    return session
+
+def throttle(sleep=DEFAULT_SLEEP):
+    """
+    Wait for our turn to hit the API. Workers started by main share
+    one token bucket, otherwise fall back on the fixed sleep
+    """
+    limiter = RUNTIME_ARGS.get('limiter', None)
+
+    if limiter is None:
+        time.sleep(sleep)
+
+    else:
+        limiter.acquire()
+
+def api_get(url, params, sleep=DEFAULT_SLEEP, retries=MAX_RETRIES):
+
+    session = get_session()
+    limiter = RUNTIME_ARGS.get('limiter', None)
+    name = metrics.endpoint(url)
+    sent = {}
+
+    def before_request():
+
+        with metrics.timed('rate_limit_wait_seconds'):
+            throttle(sleep)
 
-    if session is None:
-        raise RuntimeError('Session object is None!')
+        sent['at'] = time.perf_counter()
 
-    response = session.get(url, params={'text_format':'plain'}).json()
+    for attempt in range(retries + 1):
+
+        r = fetch(session, url, params, before_request=before_request)
+
+        # Replayed from disk, the API never saw this one
+        if r.from_cache:
+            break
+
+        metrics.observe('genius_api_seconds', time.perf_counter() - sent['at'],
+            endpoint=name)
+        metrics.inc('genius_api_responses_total', endpoint=name, status=r.status_code)
+
+        if limiter is not None:
+            retry = limiter.update(r.status_code, r.headers.get('Retry-After'))
+        else:
+            retry = r.status_code in RETRY_STATUSES
+
+        if not retry or attempt == retries:
+            break
+
+        log = logging.getLogger(str(os.getpid()))
+        log.info('Got status {} from genius, backing off'.format(r.status_code))
+
+    response = json.loads(r.content)
     
     return response.get('response', None)
 
+def get_artist(artist_id, sleep=DEFAULT_SLEEP):
+    url = urljoin(GENIUS_BASE, 'artists/{}'.format(artist_id))
+    return api_get(url, {'text_format':'plain'}, sleep=sleep)
+
 def get_artist_songs(artist_id, page, sort='title', per_page=50,
     sleep=DEFAULT_SLEEP):
 
-    time.sleep(sleep)
     url = urljoin(GENIUS_BASE, 'artists/{}/songs'.format(artist_id))
     params = {'sort': sort, 'per_page': per_page, 'page': page}
 
-    session = requests.Session()
-    session.headers.update(RUNTIME_ARGS['headers'])
-
-    response = session.get(url, params=params).json()
-    
-    return response.get('response', None)
+    return api_get(url, params, sleep=sleep)
 
 def get_song(song_id, sleep=DEFAULT_SLEEP):
-    time.sleep(sleep)
-    
-    url = urljoin(GENIUS_BASE, '/songs/{}'.format(song_id))
-    
-    session = requests.Session()
-    session.headers.update(RUNTIME_ARGS['headers'])
-
-    response = session.get(url, params={'text_format': 'plain'}).json()
-    
-    return response.get('response', None)
+    url = urljoin(GENIUS_BASE, 'songs/{}'.format(song_id))
+    return api_get(url, {'text_format': 'plain'}, sleep=sleep)
 
 def get_album(album_id, sleep=DEFAULT_SLEEP):
-    time.sleep(sleep)
-
     url = urljoin(GENIUS_BASE, 'albums/{}'.format(album_id))
-
-    session = requests.Session()
-    session.headers.update(RUNTIME_ARGS['headers'])
-
-    response = session.get(url, params={'text_format':'plain'}).json()
-
-    return response.get('response', None)
+    return api_get(url, {'text_format':'plain'}, sleep=sleep)
 
 def get_search(query, sleep=DEFAULT_SLEEP):
-    time.sleep(sleep)
     
     payload = {'text_format': 'plain'}
     payload.update({'q' : str(query)})
 
     search_url = urljoin(GENIUS_BASE, 'search/')
 
-    session = requests.Session()
-    session.headers.update(RUNTIME_ARGS['headers'])
-
-    response = session.get(search_url, params=payload).json()
-
-    return response.get('response', None)
-
-def consensus_artist(query):
+    return api_get(search_url, payload, sleep=sleep)
 
+def pick_artist(response, query):
+    """
+    Takes the unwrapped search response and returns the artist id that
+    the majority of the hits agree on
+    """
     log = logging.getLogger(str(os.getpid()))
-    log.info('POSTing search query to genius...')
-
-    response = get_search(query)
-
-    log.info('Got response from genius!')
 
     if 'hits' not in response:
         log.info('No hits found for query: {}'.format(query))
@@ -186,6 +293,18 @@ def consensus_artist(query):
     true_artist = max(counts, key=lambda k: counts[k])
     log.info('Found true artist {} for query {}'.format(true_artist, query))
 
+    return true_artist
+
+def store_artist(query, true_artist):
+
+    log = logging.getLogger(str(os.getpid()))
+
+    # Another spelling of an artist we already have
+    if db_exists(str(os.getpid()), database.Artist, genius_id=true_artist):
+        log.info('Artist {} is already in the database'.format(true_artist))
+        journal_event('artist_resolved', query, true_artist)
+        return true_artist
+
     log.info('Attemping to insert into database...')
 
     success = db_insert(
@@ -198,56 +317,96 @@ def consensus_artist(query):
 
     if success:
         log.info('Successfully inserted record into database!')
+        journal_event('artist_resolved', query, true_artist)
         return true_artist
 
     else:
         log.info('Failed to insert into database!')
         return None
 
-def get_songs(artist_id):
+def indexed_artist(query):
+    """
+    The genius id of an artist resolved on some earlier run or by
+    another worker, None when it has to be searched for
+    """
+    index = RUNTIME_ARGS.get('artists', None)
+
+    if index is None:
+        return None
+
+    artist_id = index.lookup(query)
+
+    if artist_id is not None:
+        log = logging.getLogger(str(os.getpid()))
+        log.info('Found artist {} for query {} in the index'.format(artist_id, query))
+        journal_event('artist_resolved', query, artist_id)
+
+    return artist_id
+
+def index_artist(query, artist_id):
+
+    index = RUNTIME_ARGS.get('artists', None)
+
+    if index is not None and artist_id is not None:
+        index.add(query, artist_id)
+
+def consensus_artist(query):
+
+    artist_id = indexed_artist(query)
+
+    if artist_id is not None:
+        return artist_id
 
     log = logging.getLogger(str(os.getpid()))
-    log.info('Attempting to get song info for artist: {}'.format(artist_id))
-    
-    next_page = 1
-    song_ids = set()
+    log.info('POSTing search query to genius...')
+
+    response = get_search(query)
 
-    while next_page:
+    log.info('Got response from genius!')
 
-        log.info('POSTing artist request to genius')
-        response = get_artist_songs(artist_id, str(next_page))
-        hits = response.get('songs', [])
+    true_artist = pick_artist(response, query)
 
-        if not hits:
-            log.info('No songs found!')
-            return None
+    if true_artist is None:
+        return None
+
+    artist_id = store_artist(query, true_artist)
+    index_artist(query, artist_id)
 
-        log.info('Found {} hits on page: {}'.format(len(hits), next_page))
+    return artist_id
 
-        for hit in hits:
+def page_song_ids(hits, artist_id):
+    """
+    Pulls the song ids out of one page of artist songs
+    """
+    log = logging.getLogger(str(os.getpid()))
+    song_ids = []
 
-            song_id = hit.get('id', None)
+    for hit in hits:
 
-            if song_id is not None:
-                song_ids.add(song_id)
-                log.info('Found song id: {} for artist: {}'.format(song_id, artist_id))
-                continue
+        song_id = hit.get('id', None)
 
-            song_api_path = hit.get('api_path', None)
+        if song_id is not None:
+            song_ids.append(song_id)
+            log.info('Found song id: {} for artist: {}'.format(song_id, artist_id))
+            continue
+
+        song_api_path = hit.get('api_path', None)
+
+        if song_api_path is None:
+            log.info('No ID found for this hit, continuing')
+            continue
 
-            if song_api_path is None:
-                log.info('No ID found for this hit, continuing')
-                continue
+        song_id = song_api_path.split('/')[-1]
 
-            song_id = song_api_path.split('/')[-1]
+        if song_id.isdigit():
+            song_ids.append(int(song_id))
+            log.info('Found song id: {} for artist: {}'.format(song_id, artist_id))
 
-            if song_id.isdigit():
-                song_ids.add(int(song_id))
-                log.info('Found song id: {} for artist: {}'.format(song_id, artist_id))
+    return song_ids
 
-        next_page = response.get('next_page', None)
-        log.info('Turning the page to: {}'.format(next_page))
+def store_song_ids(artist_id, song_ids):
 
+    log = logging.getLogger(str(os.getpid()))
     log.info('Found {} songs for artist: {}'.format(len(song_ids), artist_id))
     log.info('Attempting to write to update database..')
 
@@ -262,23 +421,126 @@ def get_songs(artist_id):
 
     if success:
         log.info('Successfully updated database record for artist: {}'.format(artist_id))
+        journal_event('artist_paged', artist_id, song_ids)
         return song_ids
 
     else:
         log.info('Failed to update database record for artist: {}'.format(artist_id))
         return None
 
-def get_album_date(album_id):
-    
+def journal_event(event, *args):
+    """
+    Checkpoint progress when the crawl is keeping a journal
+    """
+    journal = RUNTIME_ARGS.get('journal', None)
+
+    if journal is not None:
+        getattr(journal, event)(*args)
+
+def journal_flushed(collection, genius_ids):
+    # Buffered songs only count as done once they're in the database
+    if collection is database.Song:
+        metrics.inc('songs_stored_total', len(genius_ids))
+        journal_event('songs_done', genius_ids)
+
+def read_song_page(artist_id, page, response, last_page):
+    """
+    Song ids on one page of artist songs and the last page as far as we
+    know now. An empty page means the one before it was the last, no
+    next_page means this is. A page that didn't come back raises, cutting
+    the paging short there would store a partial song list as complete
+    """
     log = logging.getLogger(str(os.getpid()))
-    log.info('POSTing album request to genius')
+    hits = response.get('songs', None) if response is not None else None
 
-    album = get_album(album_id).get('album', None)
+    if hits is None:
+        raise RuntimeError('No response for page {} of artist {}'.format(
+            page, artist_id))
 
-    if album is None:
-        log.info('No album information found!')
+    if not hits:
+        log.info('No songs on page: {}'.format(page))
+        end = page - 1
+
+    else:
+        log.info('Found {} hits on page: {}'.format(len(hits), page))
+        end = None if response.get('next_page', None) else page
+
+    if end is not None and (last_page is None or end < last_page):
+        last_page = end
+
+    return page_song_ids(hits, artist_id), last_page
+
+def iter_song_pages(artist_id, prefetch=None):
+    """
+    Pages through an artist's songs with up to `prefetch` page requests
+    in flight. They still all take their turn on the rate limiter, the
+    speculation only stops us from waiting on one response before
+    asking for the next. Yields (page, song ids) as soon as each page
+    arrives, which isn't necessarily in page order. Once the last page
+    shows up nothing past it is asked for, and anything past it that
+    was already asked for is dropped. A page that fails raises
+    """
+    prefetch = max(1, prefetch or RUNTIME_ARGS.get('prefetch', PREFETCH_PAGES))
+
+    last_page = None
+    next_page = 1
+    pending = {}
+
+    pool = ThreadPoolExecutor(prefetch)
+
+    try:
+        while True:
+
+            while len(pending) < prefetch and \
+                (last_page is None or next_page <= last_page):
+
+                pending[pool.submit(get_artist_songs, artist_id, str(next_page))] = next_page
+                next_page += 1
+
+            if not pending:
+                break
+
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+
+            for future in sorted(done, key=pending.get):
+
+                page = pending.pop(future)
+
+                if last_page is not None and page > last_page:
+                    continue
+
+                song_ids, last_page = read_song_page(
+                    artist_id, page, future.result(), last_page)
+
+                if song_ids:
+                    yield page, song_ids
+
+    finally:
+        for future in pending: future.cancel()
+        pool.shutdown(wait=False)
+
+def get_songs(artist_id, prefetch=None):
+
+    log = logging.getLogger(str(os.getpid()))
+    log.info('Attempting to get song info for artist: {}'.format(artist_id))
+
+    song_ids = set()
+
+    for _, page_ids in iter_song_pages(artist_id, prefetch):
+        song_ids.update(page_ids)
+
+    if not song_ids:
+        log.info('No songs found!')
         return None
 
+    return store_song_ids(artist_id, song_ids)
+
+def album_release_date(album):
+    """
+    Parses the release date out of an album response, falling back
+    on the date components when the string won't parse
+    """
+    log = logging.getLogger(str(os.getpid()))
     date_string = album.get('release_date', None)
     date_obj = None
 
@@ -294,19 +556,54 @@ def get_album_date(album_id):
 
         date_obj = datetime(**date_parts)
 
-    
-    success = db_update(
+    return date_obj
+
+def store_album_date(album_id, date_obj):
+
+    # Upsert, the album record usually doesn't exist yet
+    writer = RUNTIME_ARGS.get('writer', None)
+
+    if writer is not None:
+        return writer.add(
+            database.Album,
+            genius_id=album_id,
+            release_date=date_obj
+        )
+
+    success = db_insert(
         str(os.getpid()),
         database.Album,
-        album_id,
+        genius_id=album_id,
         release_date=date_obj
     )
 
-    return date_obj
-
-def get_date_info(song):
+    return success
 
+def get_album_date(album_id):
+    
     log = logging.getLogger(str(os.getpid()))
+    log.info('POSTing album request to genius')
+
+    album = get_album(album_id).get('album', None)
+
+    if album is None:
+        log.info('No album information found!')
+        return None
+
+    date_obj = album_release_date(album)
+
+    if date_obj is None:
+        return None
+
+    store_album_date(album_id, date_obj)
+
+    return date_obj
+
+def song_date(song):
+    """
+    Returns the date stated on the song itself along with the album id
+    to fall back on when there isn't one
+    """
     date_string = song.get('release_date', None)
     date_obj = None
 
@@ -317,78 +614,138 @@ def get_date_info(song):
     if album_info is None:
         album_info = {}
 
-    album_id = album_info.get('id', None)
+    return date_obj, album_info.get('id', None)
 
-    # Query the database to see if we can get an album date
-    if not date_obj:
+def song_artist_id(song):
 
-        if album_id:
+    artist_info = song.get('primary_artist', {})
+    if artist_info is None:
+        artist_info = {}
+
+    return artist_info.get('id', None)
+
+_MISSING = object()
+def stored_album_date(album_id):
+    """
+    Looks up the album date we have on hand. Returns _MISSING when the
+    genius API has to be asked
+    """
+    log = logging.getLogger(str(os.getpid()))
+    log.info('No date object, querying databse for album_id')
+
+    results = db_find(
+        str(os.getpid()),
+        database.Album,
+        fields=('release_date',),
+        limit=2,
+        genius_id=album_id
+    )
 
-            log.info('No date object, querying databse for album_id')
+    if not len(results):
+        log.info('Did not have album date information on hand, querying...')
+        return _MISSING
 
-            results = db_query(
-                str(os.getpid()),
-                database.Album,
-                genius_id=album_id
-            )
+    elif len(results) == 1:
 
-            if not len(results):
-                log.info('Did not have album date information on hand, querying...')
-                date_obj = get_album_date(album_id)
+        release_date = results[0].get('release_date', None)
+        if release_date:
+            log.info('Have album release date locally stored!')
+            return release_date
+        else:
+            log.info('Do not have date information stored')
+            return _MISSING
+
+    else:
+        log.info('This should never happen, genius_ids are supposed to be unique!')
+        return None
+
+def unknown_date_ttl(date_obj):
+    # Known dates never change, known unknowns get asked about again later
+    return None if date_obj else UNKNOWN_DATE_TTL
+
+def album_date(album_id):
+    """
+    Memoized database/API album date lookup, every track on an album
+    after the first is answered from memory
+    """
+    def lookup():
+
+        date_obj = stored_album_date(album_id)
+
+        if date_obj is _MISSING:
+            date_obj = get_album_date(album_id)
 
-            elif len(results) == 1:
+        return date_obj
 
-                doc = list(results)[0]
-                if doc.release_date:
-                    date_obj = doc.release_date
-                    log.info('Have album release date locally stored!')
-                else:
-                    log.info('Do not have date information stored')
-                    date_obj = get_album_date(album_id)
+    return ALBUM_DATES.get_or_compute(album_id, lookup, unknown_date_ttl)
 
-            else:
-                log.info('This should never happen, genius_ids are supposed to be unique!')
-                return None
+def get_date_info(song):
+
+    log = logging.getLogger(str(os.getpid()))
+    date_obj, album_id = song_date(song)
+
+    # Query the database to see if we can get an album date
+    if not date_obj:
+
+        if album_id:
+            date_obj = album_date(album_id)
 
         else:
-            if not album_info:
-                log.info('Failed to get date from song AND album information')
-                return None
+            log.info('Failed to get date from song AND album information')
+            return None
 
     return date_obj
 
-def get_song_info(song_id):
-
+def have_song(song_id):
 
     log = logging.getLogger(str(os.getpid()))
 
     log.info('Checking to see if we have downloaded this song')
 
-    q_results = db_query(
+    exists = db_exists(
         str(os.getpid()),
         database.Song,
         genius_id=song_id
     )
 
-    if list(q_results):
+    if exists:
         log.info('Already have information for song: {}'.format(song_id))
-        return
+        journal_event('song_done', song_id)
+        return True
 
-    log.info('POSTing song request to genius')
+    return False
 
-    song = get_song(song_id).get('song', None)
+def store_song(song_id, date_obj, album_id, lyrics, artist_id=None):
 
-    if song is None:
-        log.info('No data returned from genius')
-        return None
+    log = logging.getLogger(str(os.getpid()))
+    writer = RUNTIME_ARGS.get('writer', None)
+    lyrics_hash = hash_lyrics(lyrics)
+
+    if writer is not None:
+
+        # Lyrics that changed need scoring again, the same lyrics don't
+        success = writer.add(
+            database.Song,
+            unset=('scorer_version',),
+            changed='lyrics_hash',
+            genius_id=song_id,
+            release_date=date_obj,
+            album_id=album_id,
+            artist_id=artist_id,
+            lyrics=lyrics,
+            lyrics_hash=lyrics_hash
+        )
 
-    date_obj = get_date_info(song)
-    album_info = song.get('album', {})
-    if album_info is None:
-        album_info = {}
+        if success:
+            log.info('Queued song: {} for the next bulk write'.format(song_id))
+            return success
 
-    album_id = album_info.get('id', None)
-    lyrics = extract_lyrics(song)
+        log.info('Failed queueing song: {} for bulk write'.format(song_id))
+        return None
+
+    # Has to see the old hash, so before the insert overwrites it
+    db_unset_changed(str(os.getpid()), database.Song, song_id,
+        'lyrics_hash', lyrics_hash, ('scorer_version',))
 
     success = db_insert(
         str(os.getpid()),
@@ -396,66 +753,85 @@ def get_song_info(song_id):
         genius_id=song_id,
         release_date=date_obj,
         album_id=album_id,
-        lyrics=lyrics
+        artist_id=artist_id,
+        lyrics=lyrics,
+        lyrics_hash=lyrics_hash
     )
 
     if success:
         log.info('Successfully added found song:'
             ' {} information to database'.format(song_id))
+        metrics.inc('songs_stored_total')
+        journal_event('song_done', song_id)
         return success
     else:
         log.info('Failed adding information for'
             ' song: {} to database'.format(song_id))
         return None
 
-meta_matcher = re.compile(r'(\[.*?\])*')
-def extract_lyrics(song):
+def get_song_info(song_id):
 
     log = logging.getLogger(str(os.getpid()))
-    tail_link = song.get('path', None)
-    content = None
-    song_id = song.get('id', -1)
 
-    if tail_link is None:
-        log.info('Missing web url, could not extract lyrics')
+    if have_song(song_id):
+        return
 
-    else:
-        log.info('Posting web request to genius...')
+    log.info('POSTing song request to genius')
 
-        content = get_web_link(urljoin(GENIUS_WEB_BASE, tail_link))
+    song = get_song(song_id).get('song', None)
 
-        if content is None:
-            log.info('Could not get information for song: {}'.format(song_id))
-            return ''
+    if song is None:
+        log.info('No data returned from genius')
+        return None
+
+    date_obj = get_date_info(song)
+    _, album_id = song_date(song)
+    lyrics = extract_lyrics(song)
 
+    return store_song(song_id, date_obj, album_id, lyrics, song_artist_id(song))
+
+def parse_lyrics(content, song_id=-1):
+
+    log = logging.getLogger(str(os.getpid()))
     log.info('Parsing lyric information...')
-    root = l_html.fromstring(content)
 
-    results = list(root.xpath(lyrics_xpath))
+    text = extract_lyrics_text(content)
 
-    if not results:
+    if text is None:
         log.info('There is no lyrics for song: {}'.format(song_id))
-        return 'NO LYRICS'
+        return NO_LYRICS
 
-    final = []
-    final.extend(replace_space(lyr) for lyr in results)
+    log.info('Found lyrics for song: {}'.format(song_id))
 
-    log.info('Found {} lyric instances for song: {}'.format(
-        len(final),
-        song_id
-    ))
+    return clean_lyrics(text)
 
-    for i in range(len(final)):
+def fetch_lyrics_page(song):
 
-        final[i] = meta_matcher.sub('', final[i])
-        final[i] = '\n'.join(
-            filter(
-                lambda string: bool(string.strip()),
-                final[i].split('\n')
-            )
-        )
+    log = logging.getLogger(str(os.getpid()))
+    tail_link = song.get('path', None)
+    song_id = song.get('id', -1)
+
+    if tail_link is None:
+        log.info('Missing web url, could not extract lyrics')
+        return None
+
+    log.info('Posting web request to genius...')
+
+    content = get_web_link(urljoin(GENIUS_WEB_BASE, tail_link))
+
+    if content is None:
+        log.info('Could not get information for song: {}'.format(song_id))
+
+    return content
+
+def extract_lyrics(song):
+
+    content = fetch_lyrics_page(song)
 
-    return '\n\n'.join(final)
+    if content is None:
+        return ''
+
+    return parse_lyrics(content, song.get('id', -1))
 
 def run_genius_workflow(artist):
     
@@ -481,13 +857,482 @@ def run_genius_workflow(artist):
     else:
         return True
 
-def execute(token_path, work_queue, log_queue):
+def run_work_item(item):
+    """
+    Work items are planned by CrawlJournal, either a whole artist or
+    just the songs an artist still has left
+    """
+    if isinstance(item, str):
+        return run_genius_workflow(item)
 
-    # Set up the logging (Man I did this the hard way before!)
-    # This is so much easier!
-    logger = logging.getLogger(str(os.getpid()))
-    logger.setLevel(logging.DEBUG)
-    
+    if item[0] == 'artist':
+        return run_genius_workflow(item[1])
+
+    _, name, artist_id, song_ids = item
+
+    try:
+        for song in song_ids:
+            get_song_info(song)
+
+    except:
+        log = logging.getLogger(str(os.getpid()))
+        log.exception("ERROR!")
+        return False
+
+    else:
+        return True
+
+def song_tasks(song_ids, batch=SONG_BATCH):
+    """
+    Songs cut into ('song', [ids]) scheduler tasks
+    """
+    song_ids = list(song_ids)
+
+    return [
+        ('song', song_ids[i:i + batch]) for i in range(0, len(song_ids), batch)
+    ]
+
+def plan_tasks(work):
+    """
+    Work items as scheduler tasks, the songs left over from a journaled
+    artist are split up right away instead of going out as one item
+    """
+    tasks = []
+
+    for item in work:
+
+        if not isinstance(item, str) and item[0] == 'songs':
+            tasks.extend(song_tasks(item[3]))
+        else:
+            tasks.append(item)
+
+    return tasks
+
+def run_task(task, spawn):
+    """
+    Handles one WorkStealingScheduler task. An artist (a name or
+    ('artist', name)) gets resolved and paged, and its songs are
+    spawned as ('song', [ids]) tasks page by page, where any idle
+    worker can steal them
+    """
+    log = logging.getLogger(str(os.getpid()))
+
+    if not isinstance(task, str) and task[0] == 'song':
+
+        for song_id in task[1]:
+            get_song_info(song_id)
+
+        return
+
+    artist = task if isinstance(task, str) else task[1]
+    artist_id = consensus_artist(artist)
+
+    if artist_id is None:
+        log.error('Failed: {}'.format(artist))
+        return
+
+    log.info('Attempting to get song info for artist: {}'.format(artist_id))
+
+    song_ids = set()
+
+    for _, page_ids in iter_song_pages(artist_id):
+
+        new_ids = [song_id for song_id in page_ids if song_id not in song_ids]
+        song_ids.update(new_ids)
+        spawn(song_tasks(new_ids))
+
+    if song_ids:
+        store_song_ids(artist_id, song_ids)
+
+# Stage name -> (threads, queue size). The network stages are mostly
+# waiting on the rate limiter so they get the most threads
+PIPELINE_STAGES = OrderedDict([
+    ('resolve', (1, 4)),
+    ('page', (2, 8)),
+    ('metadata', (4, 64)),
+    ('lyrics_fetch', (4, 64)),
+    ('lyrics_parse', (1, 16)),
+    ('write', (1, 64)),
+])
+
+def resolve_stage(item, emit):
+
+    if isinstance(item, str):
+        item = ('artist', item)
+
+    # Resumed from the journal, the paging is already done
+    if item[0] == 'songs':
+        emit((item[2], item[3]))
+        return
+
+    artist = item[1]
+    artist_id = consensus_artist(artist)
+
+    if artist_id is None:
+        log = logging.getLogger(str(os.getpid()))
+        log.error('Failed: {}'.format(artist))
+        return
+
+    emit((artist_id, None))
+
+def page_stage(item, emit):
+    """
+    Song ids go downstream page by page instead of after the whole
+    catalog has been paged
+    """
+    log = logging.getLogger(str(os.getpid()))
+    artist_id, known_songs = item
+
+    if known_songs is not None:
+        for song_id in known_songs: emit(song_id)
+        return
+
+    log.info('Attempting to get song info for artist: {}'.format(artist_id))
+
+    song_ids = set()
+
+    for _, page_ids in iter_song_pages(artist_id):
+
+        for song_id in page_ids:
+
+            if song_id not in song_ids:
+                song_ids.add(song_id)
+                emit(song_id)
+
+    if song_ids:
+        store_song_ids(artist_id, song_ids)
+
+def metadata_stage(song_id, emit):
+
+    log = logging.getLogger(str(os.getpid()))
+
+    if have_song(song_id):
+        return
+
+    log.info('POSTing song request to genius')
+
+    song = get_song(song_id).get('song', None)
+
+    if song is None:
+        log.info('No data returned from genius')
+        return
+
+    date_obj = get_date_info(song)
+    _, album_id = song_date(song)
+
+    emit((song_id, song, date_obj, album_id))
+
+def lyrics_fetch_stage(record, emit):
+    emit((record, fetch_lyrics_page(record[1])))
+
+def lyrics_parse_stage(item, emit):
+
+    (song_id, song, date_obj, album_id), content = item
+
+    if content is None:
+        lyrics = ''
+    else:
+        lyrics = parse_lyrics(content, song_id)
+
+    emit((song_id, date_obj, album_id, lyrics, song_artist_id(song)))
+
+def write_stage(item, emit):
+    store_song(*item)
+
+def genius_pipeline(stage_sizes=None):
+    """
+    artist -> artist id -> song ids -> song metadata -> lyrics page ->
+    lyrics -> database, every arrow a bounded queue. `stage_sizes`
+    overrides entries of PIPELINE_STAGES
+    """
+    sizes = OrderedDict(PIPELINE_STAGES)
+    sizes.update(stage_sizes or {})
+
+    funcs = {
+        'resolve': resolve_stage,
+        'page': page_stage,
+        'metadata': metadata_stage,
+        'lyrics_fetch': lyrics_fetch_stage,
+        'lyrics_parse': lyrics_parse_stage,
+        'write': write_stage,
+    }
+
+    pipeline = Pipeline()
+
+    for name, (workers, queue_size) in sizes.items():
+        pipeline.add(name, funcs[name], workers, queue_size)
+
+    return pipeline
+
+async def async_get_date_info(client, song, run_db):
+
+    log = logging.getLogger(str(os.getpid()))
+    date_obj, album_id = song_date(song)
+
+    if date_obj:
+        return date_obj
+
+    if not album_id:
+        log.info('Failed to get date from song AND album information')
+        return None
+
+    date_obj = ALBUM_DATES.get(album_id, _MISSING)
+
+    if date_obj is not _MISSING:
+        return date_obj
+
+    # An album's tracks are gathered together, so they all miss the
+    # cache at once. Only the first one looks the album up, the rest
+    # wait on its result
+    lookup = _ALBUM_LOOKUPS.get(album_id, None)
+
+    if lookup is None:
+        lookup = asyncio.ensure_future(
+            async_lookup_album_date(client, album_id, run_db))
+        _ALBUM_LOOKUPS[album_id] = lookup
+        lookup.add_done_callback(lambda _: _ALBUM_LOOKUPS.pop(album_id, None))
+
+    return await asyncio.shield(lookup)
+
+async def async_lookup_album_date(client, album_id, run_db):
+
+    log = logging.getLogger(str(os.getpid()))
+    date_obj = await run_db(stored_album_date, album_id)
+
+    if date_obj is not _MISSING:
+        ALBUM_DATES.set(album_id, date_obj, unknown_date_ttl(date_obj))
+        return date_obj
+
+    log.info('POSTing album request to genius')
+    album = (await client.get_album(album_id)).get('album', None)
+
+    if album is not None:
+        date_obj = album_release_date(album)
+    else:
+        log.info('No album information found!')
+        date_obj = None
+
+    ALBUM_DATES.set(album_id, date_obj, unknown_date_ttl(date_obj))
+
+    if date_obj is None:
+        return None
+
+    await run_db(store_album_date, album_id, date_obj)
+
+    return date_obj
+
+async def async_extract_lyrics(client, song):
+
+    log = logging.getLogger(str(os.getpid()))
+    tail_link = song.get('path', None)
+    content = None
+    song_id = song.get('id', -1)
+
+    if tail_link is None:
+        log.info('Missing web url, could not extract lyrics')
+
+    else:
+        log.info('Posting web request to genius...')
+
+        content = await client.get_web_link(urljoin(client.web_base, tail_link))
+
+        if content is None:
+            log.info('Could not get information for song: {}'.format(song_id))
+            return ''
+
+    # lxml parsing is CPU bound, keep it off of the event loop
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, parse_lyrics, content, song_id)
+
+async def async_get_song_info(client, song_id, run_db):
+
+    log = logging.getLogger(str(os.getpid()))
+
+    if await run_db(have_song, song_id):
+        return
+
+    log.info('POSTing song request to genius')
+
+    song = (await client.get_song(song_id)).get('song', None)
+
+    if song is None:
+        log.info('No data returned from genius')
+        return None
+
+    date_obj = await async_get_date_info(client, song, run_db)
+    _, album_id = song_date(song)
+    lyrics = await async_extract_lyrics(client, song)
+
+    return await run_db(store_song, song_id, date_obj, album_id, lyrics,
+        song_artist_id(song))
+
+async def async_iter_song_pages(client, artist_id, prefetch=None):
+    """
+    iter_song_pages on the event loop, the in flight pages are tasks
+    """
+    prefetch = max(1, prefetch or RUNTIME_ARGS.get('prefetch', PREFETCH_PAGES))
+
+    last_page = None
+    next_page = 1
+    pending = {}
+
+    try:
+        while True:
+
+            while len(pending) < prefetch and \
+                (last_page is None or next_page <= last_page):
+
+                task = asyncio.ensure_future(
+                    client.get_artist_songs(artist_id, str(next_page)))
+                pending[task] = next_page
+                next_page += 1
+
+            if not pending:
+                break
+
+            done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+
+            for task in sorted(done, key=pending.get):
+
+                page = pending.pop(task)
+
+                if last_page is not None and page > last_page:
+                    continue
+
+                song_ids, last_page = read_song_page(
+                    artist_id, page, task.result(), last_page)
+
+                if song_ids:
+                    yield page, song_ids
+
+    finally:
+        for task in pending: task.cancel()
+
+async def async_run_genius_workflow(client, artist, run_db):
+    """
+    Same steps as run_genius_workflow, but every song for the artist is
+    requested concurrently through the client's connection pool
+    """
+    log = logging.getLogger(str(os.getpid()))
+
+    try:
+        artist_id = indexed_artist(artist)
+
+        if artist_id is None:
+            log.info('POSTing search query to genius...')
+            response = await client.get_search(artist)
+            true_artist = pick_artist(response, artist)
+
+            if true_artist is None:
+                return False
+
+            artist_id = await run_db(store_artist, artist, true_artist)
+            index_artist(artist, artist_id)
+
+        if artist_id is None:
+            return False
+
+        log.info('Attempting to get song info for artist: {}'.format(artist_id))
+        song_ids = set()
+
+        async for _, page_ids in async_iter_song_pages(client, artist_id):
+            song_ids.update(page_ids)
+
+        if not song_ids:
+            log.info('No songs found!')
+            return False
+
+        all_songs = await run_db(store_song_ids, artist_id, song_ids)
+
+        if all_songs is None:
+            return False
+
+        await asyncio.gather(*(
+            async_get_song_info(client, song, run_db) for song in all_songs
+        ))
+
+    except:
+        log.exception("ERROR!")
+        return False
+
+    else:
+        return True
+
+async def async_run_work_item(client, item, run_db):
+
+    if isinstance(item, str):
+        item = ('artist', item)
+
+    if item[0] == 'artist':
+        return await async_run_genius_workflow(client, item[1], run_db)
+
+    _, name, artist_id, song_ids = item
+
+    try:
+        await asyncio.gather(*(
+            async_get_song_info(client, song, run_db) for song in song_ids
+        ))
+
+    except:
+        log = logging.getLogger(str(os.getpid()))
+        log.exception("ERROR!")
+        return False
+
+    else:
+        return True
+
+async def async_execute(token_path, work, max_connections=DEFAULT_CONNECTIONS,
+    limiter=None, journal_path=None, index_path=None):
+
+    logger = logging.getLogger(str(os.getpid()))
+
+    set_globals(token_path)
+
+    initialize_alias('default')
+    initialize_alias(str(os.getpid()))
+
+    if journal_path is not None:
+        RUNTIME_ARGS['journal'] = CrawlJournal(journal_path)
+
+    RUNTIME_ARGS['artists'] = ArtistIndex(index_path).load(str(os.getpid()))
+
+    RUNTIME_ARGS['writer'] = BulkWriter(
+        str(os.getpid()), on_flush=journal_flushed)
+
+    # The database layer serializes switch_db itself, the single
+    # thread just keeps the blocking calls off the event loop
+    loop = asyncio.get_running_loop()
+    db_executor = ThreadPoolExecutor(max_workers=1)
+    run_db = partial(loop.run_in_executor, db_executor)
+
+    try:
+        async with GeniusClient(RUNTIME_ARGS['token'], base=GENIUS_BASE,
+            web_base=GENIUS_WEB_BASE, max_connections=max_connections,
+            limiter=limiter, cache=get_cache()) as client:
+
+            results = await asyncio.gather(*(
+                async_run_work_item(client, item, run_db) for item in work
+            ))
+
+    finally:
+        await run_db(RUNTIME_ARGS['writer'].close)
+        db_executor.shutdown()
+
+    for item, success in zip(work, results):
+
+        if not success:
+            logger.error('Failed: {}'.format(item))
+
+def execute(token_path, work_queue, log_queue, limiter=None, album_dates=None,
+    pipelined=False, stage_sizes=None, journal_path=None,
+    prefetch_pages=PREFETCH_PAGES, index_path=None, scheduler=None,
+    worker_index=0, metrics_queue=None):
+
+    # Set up the logging (Man I did this the hard way before!)
+    # This is so much easier!
+    logger = logging.getLogger(str(os.getpid()))
+    logger.setLevel(logging.DEBUG)
+    
     handler = logging.handlers.QueueHandler(log_queue)
     handler.setLevel(logging.DEBUG)
 
@@ -501,17 +1346,44 @@ def execute(token_path, work_queue, log_queue):
     logger.addHandler(handler)
 
     set_globals(token_path)
+    RUNTIME_ARGS['limiter'] = limiter
+    RUNTIME_ARGS['prefetch'] = prefetch_pages
+    ALBUM_DATES.shared = album_dates
 
     # Create a connection for this alias
     initialize_alias('default')
     initialize_alias(str(os.getpid()))
 
-    for artist in iter(work_queue.get, None):
+    if journal_path is not None:
+        RUNTIME_ARGS['journal'] = CrawlJournal(journal_path)
 
-        success = run_genius_workflow(artist)
+    RUNTIME_ARGS['artists'] = ArtistIndex(index_path).load(str(os.getpid()))
 
-        if not success:
-            logger.error('Failed: {}'.format(artist))
+    if metrics_queue is not None:
+        metrics.ship_to(metrics_queue)
+
+    try:
+        with BulkWriter(str(os.getpid()), on_flush=journal_flushed) as writer:
+            RUNTIME_ARGS['writer'] = writer
+
+            if scheduler is not None:
+                scheduler.run(worker_index, run_task)
+                return
+
+            if pipelined:
+                genius_pipeline(stage_sizes).run(iter(work_queue.get, None))
+                return
+
+            for item in iter(work_queue.get, None):
+
+                success = run_work_item(item)
+
+                if not success:
+                    logger.error('Failed: {}'.format(item))
+
+    finally:
+        # After the writer's last flush so the tail gets counted
+        metrics.stop_shipping()
 
 
 # def testing(artist='Kanye West'):
@@ -528,15 +1400,7 @@ def execute(token_path, work_queue, log_queue):
 #     initialize_alias(str(os.getpid()))
 #     print(run_genius_workflow(artist))
 
-def main(out_path, artists_name_file, access_token_path):
-
-    # Make sure the database is live
-    initialize_mongo_db()
-
-    cpus = cpu_count()-1
-
-    work_queue = Queue()
-    log_queue = Queue()
+def log_handlers(out_path):
 
     log_file_name = os.path.join(out_path, 'genius_scraper.log')
 
@@ -552,24 +1416,126 @@ def main(out_path, artists_name_file, access_token_path):
         h.setLevel(logging.DEBUG)
         h.setFormatter(formatter)
 
+    return file_handler, stream_handler
 
-    children = [
-        Process(
-            target=execute, 
-            args=(access_token_path, work_queue, log_queue)
-        ) for _ in range(cpus)
-    ]
+def load_artists(artists_name_file):
 
     with open(artists_name_file, 'r') as f:
         all_artists = json.load(f)
 
-    for artist in set(all_artists):
+    return [
+        artist for artist in set(all_artists)
+        if 'artist' not in artist.lower()
+    ]
+
+def unique_artists(artists, index):
+    """
+    Drops the names that are just another spelling of an artist earlier
+    in the list, either by normalized name or by the genius id the
+    index already has for them
+    """
+    seen = set()
+    unique = []
+
+    for artist in artists:
+
+        artist_id = index.lookup(artist)
+        name = normalize_name(artist)
+
+        if artist_id is not None:
+            key = ('id', artist_id)
+        elif name:
+            key = ('name', name)
+        else:
+            # Nothing to compare on, never merge it with anything
+            key = ('raw', artist)
+
+        if key not in seen:
+            seen.add(key)
+            unique.append(artist)
+
+    return unique
+
+def plan_work(artists_name_file, journal_path, index_path=None):
+    """
+    Everything left to do according to the journal, one pass instead
+    of re-paging every artist and probing the database song by song
+    """
+    index = ArtistIndex(index_path).load()
+    artists = unique_artists(load_artists(artists_name_file), index)
+    known, missing = index.resolve(artists)
+    work = CrawlJournal(journal_path).replay().plan(artists)
+
+    logger = logging.getLogger(str(os.getpid()))
+    logger.info('{} artists, {} already in the name index, {} to search for'.format(
+        len(artists), len(known), len(missing)))
+    logger.info('Planned {} work items for {} artists from the journal'.format(
+        len(work), len(artists)))
+
+    return work
+
+def main(out_path, artists_name_file, access_token_path, rate=DEFAULT_RATE,
+    burst=DEFAULT_BURST, pipelined=False, stage_sizes=None,
+    share_album_dates=False, journal_path=None, prefetch_pages=PREFETCH_PAGES,
+    index_path=None, stealing=True, metrics_port=metrics.DEFAULT_PORT):
+
+    # Make sure the database is live
+    initialize_mongo_db()
+
+    cpus = max(1, cpu_count()-1)
+
+    work_queue = Queue()
+    log_queue = Queue()
+    metrics_queue = Queue()
 
-        if 'artist' not in artist.lower():
-            work_queue.put(artist)
+    file_handler, stream_handler = log_handlers(out_path)
 
-    for _ in range(cpus*2):
-        work_queue.put(None)
+    # Every child draws from this one bucket
+    limiter = TokenBucket(rate=rate, burst=burst)
+
+    # Optionally let the children share what they learn about albums
+    album_dates = Manager().dict() if share_album_dates else None
+
+    if journal_path is None:
+        journal_path = os.path.join(out_path, JOURNAL_NAME)
+
+    if index_path is None:
+        index_path = os.path.join(out_path, INDEX_NAME)
+
+    work = plan_work(artists_name_file, journal_path, index_path)
+
+    # Song sized tasks on per worker queues, idle workers steal instead
+    # of waiting on whoever drew the biggest artist
+    scheduler = None
+
+    if stealing and not pipelined:
+        scheduler = WorkStealingScheduler(cpus)
+        scheduler.seed(plan_tasks(work))
+
+    else:
+        for item in work:
+            work_queue.put(item)
+
+        for _ in range(cpus*2):
+            work_queue.put(None)
+
+    children = [
+        Process(
+            target=execute, 
+            args=(access_token_path, work_queue, log_queue, limiter,
+                album_dates),
+            kwargs={
+                'pipelined': pipelined,
+                'stage_sizes': stage_sizes,
+                'journal_path': journal_path,
+                'prefetch_pages': prefetch_pages,
+                'index_path': index_path,
+                'scheduler': scheduler,
+                'worker_index': i,
+                'metrics_queue': metrics_queue
+            }
+        ) for i in range(cpus)
+    ]
 
 
     for proc in children: proc.daemon=True
@@ -584,12 +1550,60 @@ def main(out_path, artists_name_file, access_token_path):
 
     queue_listener.start()
 
-    for proc in children: proc.join()
+    # Only once the children are forked, so they don't inherit its
+    # socket and threads
+    metrics_server = MetricsServer(
+        metrics_queue,
+        port=metrics_port,
+        snapshot_path=os.path.join(out_path, SNAPSHOT_NAME)
+    ).start()
+
+    if scheduler is not None:
+        scheduler.join(children)
+    else:
+        for proc in children: proc.join()
 
     time.sleep(10)
 
+    metrics_server.stop()
     queue_listener.stop()
 
+def async_main(out_path, artists_name_file, access_token_path,
+    max_connections=DEFAULT_CONNECTIONS, rate=DEFAULT_RATE, burst=DEFAULT_BURST,
+    journal_path=None, prefetch_pages=PREFETCH_PAGES, index_path=None,
+    metrics_port=metrics.DEFAULT_PORT):
+    """
+    Single process alternative to main. Every artist runs as a task
+    on one event loop sharing one pooled client
+    """
+    initialize_mongo_db()
+
+    logger = logging.getLogger(str(os.getpid()))
+    logger.setLevel(logging.DEBUG)
+
+    for h in log_handlers(out_path):
+        logger.addHandler(h)
+
+    if journal_path is None:
+        journal_path = os.path.join(out_path, JOURNAL_NAME)
+
+    if index_path is None:
+        index_path = os.path.join(out_path, INDEX_NAME)
+
+    RUNTIME_ARGS['prefetch'] = prefetch_pages
+
+    with MetricsServer(port=metrics_port,
+        snapshot_path=os.path.join(out_path, SNAPSHOT_NAME)):
+
+        asyncio.run(async_execute(
+            access_token_path,
+            plan_work(artists_name_file, journal_path, index_path),
+            max_connections=max_connections,
+            limiter=TokenBucket(rate=rate, burst=burst),
+            journal_path=journal_path,
+            index_path=index_path
+        ))
+
 if __name__ == '__main__':
 
     retval = 0
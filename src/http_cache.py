@@ -0,0 +1,456 @@
+#############################################################################
+#
+# Author: Milan Patel
+# Purpose: On-disk HTTP response cache shared by the wikipedia and genius
+#          fetchers so re-runs replay from disk instead of the network
+# Date: 06/05/2018
+#
+#############################################################################
+
+import os
+import time
+import zlib
+import sqlite3
+import hashlib
+import tempfile
+import threading
+from collections import namedtuple
+from urllib.parse import urlencode, urlsplit
+
+import metrics
+
+_DEFAULT_CACHE_DIR = os.path.join(os.getcwd(), 'data_path', 'http_cache')
+DEFAULT_TTL = 7 * 24 * 60 * 60
+DEFAULT_MAX_BYTES = 2 * 1024 ** 3
+_COMPRESS_LEVEL = 6
+
+CacheEntry = namedtuple(
+    'CacheEntry',
+    ['body', 'content_type', 'etag', 'last_modified', 'fresh']
+)
+
+_SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS entries ('
+    ' key TEXT PRIMARY KEY,'
+    ' url TEXT,'
+    ' digest TEXT NOT NULL,'
+    ' content_type TEXT,'
+    ' etag TEXT,'
+    ' last_modified TEXT,'
+    ' expires REAL,'
+    ' accessed REAL)',
+    'CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed)',
+    'CREATE INDEX IF NOT EXISTS entries_digest ON entries (digest)',
+    'CREATE TABLE IF NOT EXISTS blobs ('
+    ' digest TEXT PRIMARY KEY,'
+    ' size INTEGER NOT NULL)',
+    # Running total of the blob sizes, so checking it doesn't scan blobs
+    'CREATE TABLE IF NOT EXISTS totals ('
+    ' id INTEGER PRIMARY KEY CHECK (id = 0),'
+    ' size INTEGER NOT NULL)',
+    'CREATE TRIGGER IF NOT EXISTS blobs_added AFTER INSERT ON blobs'
+    ' BEGIN UPDATE totals SET size = size + NEW.size WHERE id = 0; END',
+    'CREATE TRIGGER IF NOT EXISTS blobs_removed AFTER DELETE ON blobs'
+    ' BEGIN UPDATE totals SET size = size - OLD.size WHERE id = 0; END',
+    # Only does anything the first time, for caches made before totals
+    'INSERT OR IGNORE INTO totals (id, size)'
+    ' SELECT 0, COALESCE(SUM(size), 0) FROM blobs',
+)
+
+def request_key(url, params=None):
+    """
+    Cache key for a GET, the params are sorted so that dict ordering
+    doesn't matter
+    """
+    if params:
+        query = urlencode(sorted((str(k), str(v)) for k, v in params.items()))
+        url = '{}?{}'.format(url, query)
+
+    return hashlib.sha256(url.encode('utf-8')).hexdigest()
+
+class ResponseCache(object):
+    """
+    Bodies are stored zlib compressed under the sha256 of their content,
+    so identical responses for different requests share one file. A
+    small sqlite index maps request keys to bodies along with the
+    validators needed for conditional requests, and evicts the least
+    recently used entries once the bodies pass `max_bytes`.
+
+    Safe to share across processes, every process opens its own
+    connection to the index.
+    """
+
+    def __init__(self, directory=_DEFAULT_CACHE_DIR, ttl=DEFAULT_TTL,
+        max_bytes=DEFAULT_MAX_BYTES):
+
+        self.directory = directory
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._objects = os.path.join(directory, 'objects')
+        self._index_path = os.path.join(directory, 'index.sqlite')
+
+        if not os.path.exists(self._objects):
+            os.makedirs(self._objects)
+
+        self._conn = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _db(self):
+
+        # Connections don't survive a fork
+        if self._conn is None or self._pid != os.getpid():
+            self._conn = sqlite3.connect(
+                self._index_path,
+                timeout=60,
+                check_same_thread=False,
+                isolation_level=None
+            )
+            self._conn.execute('PRAGMA journal_mode=WAL')
+
+            for statement in _SCHEMA:
+                self._conn.execute(statement)
+
+            self._pid = os.getpid()
+
+        return self._conn
+
+    def _blob_path(self, digest):
+        return os.path.join(self._objects, digest[:2], digest[2:])
+
+    def _read_blob(self, digest):
+
+        try:
+            with open(self._blob_path(digest), 'rb') as f:
+                return zlib.decompress(f.read())
+
+        except (OSError, zlib.error):
+            return None
+
+    def _write_blob(self, digest, body):
+
+        path = self._blob_path(digest)
+
+        if os.path.exists(path):
+            return
+
+        directory = os.path.dirname(path)
+
+        if not os.path.exists(directory):
+            os.makedirs(directory, exist_ok=True)
+
+        # Write then rename so readers never see a partial body
+        fd, tmp_path = tempfile.mkstemp(dir=directory)
+
+        with os.fdopen(fd, 'wb') as f:
+            f.write(zlib.compress(body, _COMPRESS_LEVEL))
+
+        os.replace(tmp_path, path)
+
+    def lookup(self, url, params=None):
+
+        key = request_key(url, params)
+        now = time.time()
+
+        with self._lock:
+            db = self._db()
+            row = db.execute(
+                'SELECT digest, content_type, etag, last_modified, expires'
+                ' FROM entries WHERE key = ?', (key,)
+            ).fetchone()
+
+            if row is None:
+                return None
+
+            db.execute('UPDATE entries SET accessed = ? WHERE key = ?', (now, key))
+
+        digest, content_type, etag, last_modified, expires = row
+        body = self._read_blob(digest)
+
+        if body is None:
+            self.invalidate(url, params)
+            return None
+
+        return CacheEntry(
+            body,
+            content_type,
+            etag,
+            last_modified,
+            expires is None or expires > now
+        )
+
+    def store(self, url, params, body, headers=None, ttl=None):
+
+        headers = headers or {}
+        ttl = self.ttl if ttl is None else ttl
+        digest = hashlib.sha256(body).hexdigest()
+        now = time.time()
+
+        self._write_blob(digest, body)
+
+        with self._lock:
+            db = self._db()
+            db.execute(
+                'INSERT OR IGNORE INTO blobs (digest, size) VALUES (?, ?)',
+                (digest, os.path.getsize(self._blob_path(digest)))
+            )
+            db.execute(
+                'INSERT OR REPLACE INTO entries (key, url, digest, content_type,'
+                ' etag, last_modified, expires, accessed)'
+                ' VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (
+                    request_key(url, params),
+                    url,
+                    digest,
+                    headers.get('Content-Type', None),
+                    headers.get('ETag', None),
+                    headers.get('Last-Modified', None),
+                    now + ttl if ttl else None,
+                    now
+                )
+            )
+
+        self.evict()
+
+    def revalidate(self, url, params=None, ttl=None):
+        """
+        The server answered 304, the body we have is good for another ttl
+        """
+        ttl = self.ttl if ttl is None else ttl
+        now = time.time()
+
+        with self._lock:
+            self._db().execute(
+                'UPDATE entries SET expires = ?, accessed = ? WHERE key = ?',
+                (now + ttl if ttl else None, now, request_key(url, params))
+            )
+
+    def invalidate(self, url, params=None):
+
+        with self._lock:
+            self._db().execute(
+                'DELETE FROM entries WHERE key = ?',
+                (request_key(url, params),)
+            )
+
+    def size(self):
+
+        with self._lock:
+            row = self._db().execute(
+                'SELECT size FROM totals WHERE id = 0').fetchone()
+
+        return row[0] if row is not None else 0
+
+    def evict(self):
+        """
+        Drops least recently used entries until the stored bodies fit in
+        90% of max_bytes, then removes bodies nothing points at anymore
+        """
+        if not self.max_bytes or self.size() <= self.max_bytes:
+            return
+
+        target = int(self.max_bytes * 0.9)
+
+        with self._lock:
+            db = self._db()
+            total = db.execute(
+                'SELECT size FROM totals WHERE id = 0').fetchone()[0]
+            rows = db.execute(
+                'SELECT e.key, e.digest, b.size FROM entries e'
+                ' JOIN blobs b ON b.digest = e.digest ORDER BY e.accessed'
+            ).fetchall()
+
+            db.execute('BEGIN IMMEDIATE')
+
+            try:
+                for key, digest, size in rows:
+
+                    if total <= target:
+                        break
+
+                    db.execute('DELETE FROM entries WHERE key = ?', (key,))
+                    shared = db.execute(
+                        'SELECT 1 FROM entries WHERE digest = ? LIMIT 1',
+                        (digest,)
+                    ).fetchone()
+
+                    if shared is None:
+                        total -= size
+
+                orphans = [d for (d,) in db.execute(
+                    'SELECT digest FROM blobs WHERE digest NOT IN'
+                    ' (SELECT digest FROM entries)'
+                )]
+
+                db.executemany(
+                    'DELETE FROM blobs WHERE digest = ?',
+                    [(d,) for d in orphans]
+                )
+
+                db.execute('COMMIT')
+
+            except:
+                db.execute('ROLLBACK')
+                raise
+
+        for digest in orphans:
+            try:
+                os.remove(self._blob_path(digest))
+            except OSError:
+                pass
+
+def conditional_headers(entry):
+
+    headers = {}
+
+    if entry is None:
+        return headers
+
+    if entry.etag:
+        headers['If-None-Match'] = entry.etag
+
+    if entry.last_modified:
+        headers['If-Modified-Since'] = entry.last_modified
+
+    return headers
+
+class CachedResponse(object):
+    """
+    The parts of a requests.Response that the fetchers use
+    """
+
+    def __init__(self, status_code, content, headers=None, from_cache=False):
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers or {}
+        self.from_cache = from_cache
+
+    @property
+    def text(self):
+
+        charset = 'utf-8'
+        content_type = self.headers.get('Content-Type', None) or ''
+
+        for part in content_type.split(';'):
+            part = part.strip()
+
+            if part.lower().startswith('charset='):
+                charset = part.split('=', 1)[1].strip('"\'')
+
+        try:
+            return self.content.decode(charset, errors='replace')
+
+        except LookupError:
+            return self.content.decode('utf-8', errors='replace')
+
+def fetch(session, url, params=None, headers=None, cache=None, ttl=None,
+    before_request=None):
+    """
+    GET through the cache. `session` is anything with a requests style
+    get, the requests module itself works too. `before_request` is
+    called right before going out on the network (throttling), it is
+    skipped entirely when the cache answers
+    """
+    if cache is None:
+        cache = get_cache()
+
+    entry = cache.lookup(url, params) if cache is not None else None
+
+    if entry is not None and entry.fresh:
+        metrics.inc('http_cache_total', result='hit')
+        return _recorded(url, params, CachedResponse(
+            200,
+            entry.body,
+            {'Content-Type': entry.content_type},
+            True
+        ))
+
+    request_headers = dict(headers or {})
+    request_headers.update(conditional_headers(entry))
+
+    if before_request is not None:
+        before_request()
+
+    with metrics.timed('http_request_seconds', host=urlsplit(url).netloc):
+        r = session.get(url, params=params, headers=request_headers)
+
+    if r.status_code == 304 and entry is not None:
+        metrics.inc('http_cache_total', result='revalidated')
+        cache.revalidate(url, params, ttl)
+
+        return _recorded(url, params, CachedResponse(
+            200,
+            entry.body,
+            {'Content-Type': entry.content_type},
+            True
+        ))
+
+    metrics.inc('http_cache_total', result='miss' if cache is not None else 'off')
+
+    if r.status_code == 200 and cache is not None:
+        cache.store(url, params, r.content, r.headers, ttl)
+
+    return _recorded(url, params,
+        CachedResponse(r.status_code, r.content, r.headers, False))
+
+def _recorded(url, params, response):
+
+    recorder = get_recorder()
+
+    if recorder is not None:
+        recorder.record(url, params, response.status_code,
+            response.headers.get('Content-Type', None), response.content)
+
+    return response
+
+_UNSET = object()
+_CACHE = _UNSET
+_RECORDER = _UNSET
+
+def get_cache():
+    """
+    The process wide cache, created in the default location on first
+    use unless set_cache was called
+    """
+    global _CACHE
+
+    if _CACHE is _UNSET:
+        _CACHE = ResponseCache()
+
+    return _CACHE
+
+def set_cache(cache):
+    """
+    Swap in a different cache, None turns caching off
+    """
+    global _CACHE
+    _CACHE = cache
+
+def get_recorder():
+    """
+    The process wide replay.Recorder, if responses are being recorded.
+    Either set with set_recorder or started on first use when the
+    REPLAY_RECORD_DIR environment variable names a directory
+    """
+    global _RECORDER
+
+    if _RECORDER is _UNSET:
+
+        directory = os.environ.get('REPLAY_RECORD_DIR', None)
+
+        if directory:
+            # replay imports us, so only pull it in when it's wanted
+            from replay import Recorder
+            _RECORDER = Recorder(directory)
+
+        else:
+            _RECORDER = None
+
+    return _RECORDER
+
+def set_recorder(recorder):
+    """
+    Start (or with None, stop) recording every response fetched
+    """
+    global _RECORDER
+    _RECORDER = recorder
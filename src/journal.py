@@ -0,0 +1,159 @@
+#############################################################################
+#
+# Author: Milan Patel
+# Purpose: Append-only checkpoint journal so a crashed crawl can pick up
+#          where it left off
+# Date: 06/05/2018
+#
+#############################################################################
+
+import os
+import json
+import threading
+
+# Record types
+ARTIST = 'artist'
+SONGS = 'songs'
+SONG = 'song'
+
+class CrawlJournal(object):
+    """
+    One JSON record per line, appended with a single write() on an
+    O_APPEND descriptor so every worker process can share the file
+    without interleaving lines. A crash can at worst leave a torn last
+    line, which replay skips.
+
+        {"t": "artist", "name": "Kanye West", "id": 72}
+        {"t": "songs", "id": 72, "songs": [1, 2, 3]}
+        {"t": "song", "id": 1}
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._fd = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _append(self, record):
+
+        line = (json.dumps(record, separators=(',', ':')) + '\n').encode('utf-8')
+
+        with self._lock:
+
+            if self._fd is None or self._pid != os.getpid():
+                self._fd = os.open(
+                    self.path,
+                    os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+                    0o644
+                )
+                self._pid = os.getpid()
+
+                # Don't glue our first record onto a torn line
+                if not _ends_with_newline(self.path):
+                    line = b'\n' + line
+
+            os.write(self._fd, line)
+
+    def artist_resolved(self, name, artist_id):
+        self._append({'t': ARTIST, 'name': name, 'id': int(artist_id)})
+
+    def artist_paged(self, artist_id, song_ids):
+        self._append({
+            't': SONGS,
+            'id': int(artist_id),
+            'songs': sorted(int(s) for s in song_ids)
+        })
+
+    def songs_done(self, song_ids):
+
+        for song_id in song_ids:
+            self._append({'t': SONG, 'id': int(song_id)})
+
+    def song_done(self, song_id):
+        self.songs_done([song_id])
+
+    def close(self):
+
+        with self._lock:
+
+            if self._fd is not None and self._pid == os.getpid():
+                os.close(self._fd)
+
+            self._fd = None
+
+    def replay(self):
+
+        state = JournalState()
+
+        if not os.path.exists(self.path):
+            return state
+
+        with open(self.path, 'rb') as f:
+            for line in f:
+
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+
+                state.apply(record)
+
+        return state
+
+class JournalState(object):
+
+    def __init__(self):
+        self.resolved = {}
+        self.paged = {}
+        self.songs = set()
+
+    def apply(self, record):
+
+        kind = record.get('t', None)
+
+        if kind == SONG:
+            self.songs.add(record['id'])
+
+        elif kind == SONGS:
+            self.paged[record['id']] = record['songs']
+
+        elif kind == ARTIST:
+            self.resolved[record['name']] = record['id']
+
+    def plan(self, artists):
+        """
+        Turns the artist list into work items in one pass over the
+        journal state:
+
+            ('artist', name)                        start from scratch
+            ('songs', name, artist_id, song_ids)    only the songs left
+
+        Artists whose songs are all finished are dropped
+        """
+        work = []
+
+        for name in artists:
+
+            artist_id = self.resolved.get(name, None)
+
+            if artist_id is None or artist_id not in self.paged:
+                work.append(('artist', name))
+                continue
+
+            remaining = [s for s in self.paged[artist_id] if s not in self.songs]
+
+            if remaining:
+                work.append(('songs', name, artist_id, remaining))
+
+        return work
+
+def _ends_with_newline(path):
+
+    with open(path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+
+        if not f.tell():
+            return True
+
+        f.seek(-1, os.SEEK_END)
+        return f.read(1) == b'\n'
@@ -0,0 +1,84 @@
+#############################################################################
+#
+# Author: Milan Patel
+# Purpose: Incremental lyrics extraction for genius song pages
+# Date: 06/05/2018
+#
+#############################################################################
+
+import re
+from lxml import etree
+
+import metrics
+
+_LYRICS_CLASS = 'lyrics'
+_CHUNK_SIZE = 16 * 1024
+
+meta_matcher = re.compile(r'\[[^\]\n]*\]')
+
+@metrics.timed('parse_seconds', kind='lyrics')
+def extract_lyrics_text(content, chunk_size=_CHUNK_SIZE):
+    """
+    Finds the text of the lyrics container in a song page. The page is
+    fed to a pull parser a chunk at a time and parsing stops as soon as
+    the container closes, so the scripts and markup after it are never
+    touched. Everything that closes before the container is cleared as
+    we go to keep the partial tree small.
+
+    Returns None when the page has no lyrics container
+    """
+    if isinstance(content, str):
+        content = content.encode('utf-8')
+
+    parser = etree.HTMLPullParser(events=('start', 'end'))
+    target = None
+
+    for offset in range(0, len(content), chunk_size):
+
+        parser.feed(content[offset:offset + chunk_size])
+
+        for event, element in parser.read_events():
+
+            if target is None:
+
+                if event == 'start' and element.get('class') == _LYRICS_CLASS:
+                    target = element
+
+                elif event == 'end':
+                    element.clear()
+
+            elif event == 'end' and element is target:
+                return _element_text(target)
+
+    # Truncated page, take whatever made it into the container
+    if target is not None:
+        return _element_text(target)
+
+    return None
+
+def _element_text(element):
+    text = etree.tostring(
+        element,
+        method='text',
+        encoding='unicode',
+        with_tail=False
+    )
+
+    return text.replace(u'\xa0', u' ')
+
+def clean_lyrics(text):
+    """
+    Strips the [Verse]/[Hook] style annotations and drops blank lines
+    in a single walk over the lines
+    """
+    lines = []
+
+    for line in text.split('\n'):
+
+        if '[' in line:
+            line = meta_matcher.sub('', line)
+
+        if line.strip():
+            lines.append(line)
+
+    return '\n'.join(lines)
@@ -12,8 +12,8 @@
 import os
 import sys
 import logging
-from .parse_html import parse_wikipedia
-from .genius_scaper import extract_lyrics
+from database import initialize_alias
+from sentiment import Lexicon, score_corpus, score_parallel
 
 _LOG_FILE_DIR = os.path.join(os.getcwd(), 'logs')
 
@@ -37,21 +37,38 @@ def set_up_logging(
 
 	for h in [stream_handler, file_handler]:
 		h.setFormatter(formatter)
-		logger.setHandler(h)
+		logger.addHandler(h)
 
-def main():
+def main(lexicon_path, processes=1):
 
-	pass
+	set_up_logging()
+	initialize_alias('default')
+	initialize_alias(str(os.getpid()))
+
+	if processes > 1:
+		scored, seconds = score_parallel(
+			str(os.getpid()),
+			lexicon_path,
+			processes=processes
+		)
+
+	else:
+		lexicon = Lexicon.load(lexicon_path)
+		logging.info('Loaded {} lexicon words'.format(len(lexicon)))
+
+		scored, seconds = score_corpus(str(os.getpid()), lexicon)
+
+	logging.info('Scored {} songs in {:.1f}s'.format(scored, seconds))
 
 if __name__ == '__main__':
 
 	ret_val = 0
 
 	try:
-		main()
+		main(sys.argv[1], *map(int, sys.argv[2:3]))
 
 	except:
-		logging.logException('There was an error in running this analyis')
+		logging.exception('There was an error in running this analyis')
 		ret_val = 1
 
 	sys.exit(ret_val)
\ No newline at end of file
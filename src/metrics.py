@@ -0,0 +1,412 @@
+#############################################################################
+#
+# Author: Milan Patel
+# Purpose: Counters and latency histograms collected across the worker
+#          processes, served in the Prometheus text format
+# Date: 06/05/2018
+#
+#############################################################################
+
+import os
+import re
+import json
+import time
+import bisect
+import logging
+import threading
+from queue import Empty
+from functools import wraps
+from urllib.parse import urlsplit
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_PORT = 9108
+DEFAULT_INTERVAL = 10.
+SNAPSHOT_NAME = 'metrics.json'
+
+# Seconds, good for everything from a cache hit to a slow API call
+BUCKETS = (
+    .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1., 2.5, 5., 10., 30.
+)
+
+_id_matcher = re.compile(r'/[0-9]+(?=/|$)')
+
+def endpoint(url):
+    """
+    Label for an API url with the ids taken out, artists/{id}/songs
+    """
+    return _id_matcher.sub('/{id}', '/' + urlsplit(url).path.lstrip('/'))
+
+def _key(name, labels):
+    return (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+
+class Registry(object):
+    """
+    Counters and histograms keyed on (name, labels). Histograms are
+    kept as per bucket counts (the last bucket is +Inf) plus the sum,
+    so two registries merge by adding everything up
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = defaultdict(float)
+        self.histograms = {}
+
+    def inc(self, name, value=1, **labels):
+
+        with self._lock:
+            self.counters[_key(name, labels)] += value
+
+    def observe(self, name, value, **labels):
+
+        key = _key(name, labels)
+        bucket = bisect.bisect_left(BUCKETS, value)
+
+        with self._lock:
+            counts = self.histograms.get(key, None)
+
+            if counts is None:
+                counts = self.histograms[key] = [0] * (len(BUCKETS) + 1) + [0.]
+
+            counts[bucket] += 1
+            counts[-1] += value
+
+    def drain(self):
+        """
+        Hands back everything collected since the last drain and starts
+        over, this is what the workers ship to the parent
+        """
+        with self._lock:
+            counters, self.counters = dict(self.counters), defaultdict(float)
+            histograms, self.histograms = self.histograms, {}
+
+        return counters, histograms
+
+    def merge(self, counters, histograms):
+
+        with self._lock:
+
+            for key, value in counters.items():
+                self.counters[key] += value
+
+            for key, counts in histograms.items():
+
+                mine = self.histograms.get(key, None)
+
+                if mine is None:
+                    self.histograms[key] = list(counts)
+                else:
+                    for i, count in enumerate(counts):
+                        mine[i] += count
+
+    def copy(self):
+
+        with self._lock:
+            return (
+                dict(self.counters),
+                {key: list(counts) for key, counts in self.histograms.items()}
+            )
+
+    def render(self):
+        """
+        Prometheus text exposition format
+        """
+        counters, histograms = self.copy()
+        lines = []
+
+        for name in sorted(set(name for name, _ in counters)):
+
+            lines.append('# TYPE {} counter'.format(name))
+
+            for (key_name, labels), value in sorted(counters.items()):
+                if key_name == name:
+                    lines.append('{}{} {}'.format(name, _labels(labels), _number(value)))
+
+        for name in sorted(set(name for name, _ in histograms)):
+
+            lines.append('# TYPE {} histogram'.format(name))
+
+            for (key_name, labels), counts in sorted(histograms.items()):
+
+                if key_name != name:
+                    continue
+
+                cumulative = 0
+
+                for bound, count in zip(BUCKETS + ('+Inf',), counts[:-1]):
+                    cumulative += count
+                    lines.append('{}_bucket{} {}'.format(
+                        name, _labels(labels + (('le', str(bound)),)), cumulative))
+
+                lines.append('{}_sum{} {}'.format(name, _labels(labels), _number(counts[-1])))
+                lines.append('{}_count{} {}'.format(name, _labels(labels), cumulative))
+
+        return '\n'.join(lines) + '\n'
+
+def _labels(labels):
+
+    if not labels:
+        return ''
+
+    return '{' + ','.join(
+        '{}="{}"'.format(k, v.replace('\\', '\\\\').replace('"', '\\"'))
+        for k, v in labels
+    ) + '}'
+
+def _number(value):
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+# Everything in this process records here
+REGISTRY = Registry()
+
+def inc(name, value=1, **labels):
+    REGISTRY.inc(name, value, **labels)
+
+def observe(name, value, **labels):
+    REGISTRY.observe(name, value, **labels)
+
+class timed(object):
+    """
+    Records how long a block or a function call took into a histogram
+
+        with timed('db_seconds', op='find'): ...
+
+        @timed('parse_seconds', kind='lyrics')
+        def parse(...): ...
+    """
+
+    def __init__(self, name, **labels):
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        observe(self.name, time.perf_counter() - self._start, **self.labels)
+
+    def __call__(self, f):
+
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+
+            start = time.perf_counter()
+
+            try:
+                return f(*args, **kwargs)
+            finally:
+                observe(self.name, time.perf_counter() - start, **self.labels)
+
+        return wrapper
+
+_SHIPPER = {}
+
+def ship_to(queue, interval=DEFAULT_INTERVAL):
+    """
+    Worker side, every `interval` seconds what this process recorded is
+    sent to the parent's MetricsServer over `queue`. Call flush() before
+    the process exits to send the tail
+    """
+    # Anything inherited over a fork was the parent's to report
+    REGISTRY.drain()
+
+    _SHIPPER['queue'] = queue
+    _SHIPPER['pid'] = os.getpid()
+    stop = _SHIPPER['stop'] = threading.Event()
+
+    def ship():
+        while not stop.wait(interval):
+            flush()
+
+    thread = threading.Thread(target=ship, name='metrics-shipper', daemon=True)
+    thread.start()
+
+def flush():
+
+    queue = _SHIPPER.get('queue', None)
+
+    if queue is None or _SHIPPER.get('pid', None) != os.getpid():
+        return
+
+    counters, histograms = REGISTRY.drain()
+
+    if counters or histograms:
+        queue.put((os.getpid(), counters, histograms))
+
+def stop_shipping():
+
+    stop = _SHIPPER.get('stop', None)
+
+    if stop is not None:
+        stop.set()
+
+    flush()
+
+class MetricsServer(object):
+    """
+    Parent side. Folds whatever the workers ship over `queue` into this
+    process's registry, serves it at http://127.0.0.1:<port>/metrics
+    and every `interval` seconds writes a JSON snapshot (with per second
+    rates of the counters since the last one) to `snapshot_path`.
+    Pass port=None to skip the HTTP side, or 0 for any free port. A
+    port that's taken only costs the endpoint, never the caller
+    """
+
+    def __init__(self, queue=None, port=DEFAULT_PORT, snapshot_path=None,
+        interval=DEFAULT_INTERVAL):
+
+        self.queue = queue
+        self.port = port
+        self.snapshot_path = snapshot_path
+        self.interval = interval
+
+        self._stop = threading.Event()
+        self._threads = []
+        self._httpd = None
+        self._last = (time.time(), {})
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def start(self):
+
+        log = logging.getLogger(str(os.getpid()))
+
+        if self.queue is not None:
+            self._spawn(self._collect, 'metrics-collector')
+
+        if self.snapshot_path is not None:
+            self._spawn(self._snapshots, 'metrics-snapshots')
+
+        if self.port is not None:
+
+            try:
+                self._httpd = ThreadingHTTPServer(('127.0.0.1', self.port), _MetricsHandler)
+
+            except OSError as e:
+                log.warning('Could not serve metrics on port {} ({}), carrying on '
+                    'without the endpoint'.format(self.port, e))
+                self.port = None
+                return self
+
+            self._httpd.daemon_threads = True
+            self.port = self._httpd.server_address[1]
+            self._spawn(self._httpd.serve_forever, 'metrics-http')
+
+            log.info('Serving metrics at http://127.0.0.1:{}/metrics'.format(self.port))
+
+        return self
+
+    def _spawn(self, target, name):
+
+        thread = threading.Thread(target=target, name=name, daemon=True)
+        thread.start()
+        self._threads.append(thread)
+
+    def _drain_queue(self, timeout=None):
+
+        try:
+            _, counters, histograms = self.queue.get(timeout=timeout)
+        except Empty:
+            return False
+
+        REGISTRY.merge(counters, histograms)
+        return True
+
+    def _collect(self):
+
+        while not self._stop.is_set():
+            self._drain_queue(timeout=.5)
+
+    def _snapshots(self):
+
+        while not self._stop.wait(self.interval):
+            self.snapshot()
+
+    def snapshot(self):
+        """
+        Writes the current totals to the snapshot file, returns them
+        """
+        now = time.time()
+        counters, histograms = REGISTRY.copy()
+        last_time, last_counters = self._last
+        elapsed = max(now - last_time, 1e-6)
+        self._last = (now, counters)
+
+        snapshot = {
+            'time': now,
+            'counters': [
+                {
+                    'name': name,
+                    'labels': dict(labels),
+                    'value': value,
+                    'rate': (value - last_counters.get((name, labels), 0.)) / elapsed
+                } for (name, labels), value in sorted(counters.items())
+            ],
+            'histograms': [
+                {
+                    'name': name,
+                    'labels': dict(labels),
+                    'count': sum(counts[:-1]),
+                    'sum': counts[-1],
+                    'mean': counts[-1] / max(sum(counts[:-1]), 1),
+                    'buckets': dict(zip([str(b) for b in BUCKETS] + ['+Inf'], counts[:-1]))
+                } for (name, labels), counts in sorted(histograms.items())
+            ]
+        }
+
+        if self.snapshot_path is not None:
+
+            tmp_path = '{}.{}.tmp'.format(self.snapshot_path, os.getpid())
+
+            with open(tmp_path, 'w') as f:
+                json.dump(snapshot, f, indent=1)
+
+            os.replace(tmp_path, self.snapshot_path)
+
+        return snapshot
+
+    def stop(self):
+        """
+        Picks up whatever the workers sent last, writes a final snapshot
+        and shuts the endpoint down
+        """
+        self._stop.set()
+
+        for thread in self._threads:
+            if thread.name != 'metrics-http':
+                thread.join()
+
+        if self.queue is not None:
+            while self._drain_queue(timeout=.1):
+                pass
+
+        if self.snapshot_path is not None:
+            self.snapshot()
+
+        if self._httpd is not None:
+            self._httpd.shutdown()
+            self._httpd.server_close()
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+
+        body = REGISTRY.render().encode('utf-8')
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
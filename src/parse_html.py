@@ -13,27 +13,67 @@ import json
 import time
 import logging
 import requests
+import threading
 import traceback
 from tqdm import *
 import lxml.html as l_html
-from functools import partial
+from functools import partial, lru_cache
 from urllib.parse import urljoin
-from collections import defaultdict
-from multiprocessing import Pool, Queue, Lock
+from requests.adapters import HTTPAdapter
+from concurrent.futures import (
+    ThreadPoolExecutor,
+    ProcessPoolExecutor,
+    as_completed
+)
 
 from tools import (
     get_nonjson
 )
 
-_base_url = 'http://en.wikipedia.org/'
-_parse_url = 'https://en.wikipedia.org/wiki/List_of_years_in_hip_hop_music'
+from http_cache import (
+    fetch
+)
+
+from rate_limit import (
+    RETRY_STATUSES
+)
+
+from artifacts import (
+    ArtifactStore
+)
+
+import metrics
+
+# Overridable from the environment, say to point at a replay server
+_base_url = os.environ.get('WIKI_BASE', 'http://en.wikipedia.org/')
+_parse_url = os.environ.get(
+    'WIKI_PARSE_URL',
+    'https://en.wikipedia.org/wiki/List_of_years_in_hip_hop_music'
+)
 _year_link_parser = re.compile(r'([0-9]{4})_in_hip_hop_music')
 _data_dir = os.path.join(os.getcwd(), 'data_path')
 _THREADS = 8
+_PARSE_PROCESSES = 2
+_WIKI_TTL = 30 * 24 * 60 * 60
+
+_SESSION = {}
+_EMPTY = object()
+_SESSION_LOCK = threading.Lock()
 
 if not os.path.exists(_data_dir):
     os.makedirs(_data_dir)
 
+def set_bases(base_url=None, parse_url=None):
+
+    global _base_url, _parse_url
+
+    if base_url is not None:
+        _base_url = base_url
+        wiki_url.cache_clear()
+
+    if parse_url is not None:
+        _parse_url = parse_url
+
 def replace_quotes(string):
     return string.replace('"', '').replace("'", "")
 
@@ -51,16 +91,45 @@ def extract_links_match_obj(links, matcher):
 
     return to_return
 
+def get_session(pool_size=_THREADS):
+    """
+    One requests.Session per process, shared by all of the fetch
+    threads. The connection pool is grown to `pool_size` so none of
+    them wait on a connection
+    """
+    with _SESSION_LOCK:
+
+        if _SESSION.get('pid', None) != os.getpid():
+            _SESSION.clear()
+            _SESSION['pid'] = os.getpid()
+            _SESSION['session'] = requests.Session()
+            _SESSION['pool_size'] = 0
+
+        if pool_size > _SESSION['pool_size']:
+            adapter = HTTPAdapter(pool_maxsize=pool_size)
+            _SESSION['session'].mount('http://', adapter)
+            _SESSION['session'].mount('https://', adapter)
+            _SESSION['pool_size'] = pool_size
+
+        return _SESSION['session']
+
 def check_html_link(link):
-    r = requests.get(link)
+    r = get_session().get(link)
     return r.status_code == 200
 
 def get_link_html(link):
-    r = requests.get(link)
+    """
+    The page's html, None if it isn't there (404 and the like). Statuses
+    that might go away on their own raise so the page gets retried
+    """
+    r = fetch(get_session(), link, ttl=_WIKI_TTL)
 
     if r.status_code == 200:
         return r.text
 
+    if r.status_code in RETRY_STATUSES:
+        raise RuntimeError('Got status {} for: {}'.format(r.status_code, link))
+
 link_xpath = '//a/@href'
 def get_wiki_links(link):
     html = get_link_html(link)
@@ -86,188 +155,399 @@ table_header_xpath = './/th'
 table_row_xpath = './/tr'
 table_data_xpath = './/td'
 descendant_xpath = 'descendant::*'
-def get_tables(link, table_xpath=None, prefer_text=False):
+def parse_tables(html, table_xpath=wikitable_xpath, prefer_text=False):
 
-    tables_here = []
-    html = get_link_html(link)
     root = l_html.fromstring(html)
 
-    for table in root.xpath(table_xpath):
-        tables_here.append(parse_table(table, prefer_text))
+    return [parse_table(table, prefer_text) for table in root.xpath(table_xpath)]
+
+def get_tables(link, table_xpath=wikitable_xpath, prefer_text=False):
+
+    html = get_link_html(link)
+
+    if html is None:
+        return []
+
+    return parse_tables(html, table_xpath, prefer_text)
+
+def _timed_parse(parse, html):
+    # Runs in the parsing processes, the timing goes back with the result
+    start = time.perf_counter()
+    result = parse(html)
+
+    return result, time.perf_counter() - start
+
+def iter_pages(links, parse, threads=_THREADS, processes=_PARSE_PROCESSES,
+    progress=True):
+    """
+    Fetches many pages at once and runs parse(html) on each, yielding
+    (index into links, result) as pages finish, in no particular order.
+    The fetching is I/O bound so it happens on `threads` threads
+    sharing one session, and each page is handed to a pool of
+    `processes` processes for the lxml work as soon as it arrives
+    (`parse` has to pickle). With processes=0 the parsing happens right
+    here, which is plenty for a handful of pages. Pages that don't exist
+    come back as (i, None), pages that fail are logged and skipped
+    """
+    log = logging.getLogger(str(os.getpid()))
+    links = list(links)
+
+    def parsed(future, i):
+
+        try:
+            result, seconds = future.result()
+        except Exception:
+            log.exception('Failed parsing: {}'.format(links[i]))
+            return None
+
+        metrics.observe('parse_seconds', seconds, kind='page')
+        return result
+
+    # Size the pool before any of the threads get to it
+    get_session(threads)
+    parser = ProcessPoolExecutor(processes) if processes else None
+
+    try:
+        parsing = {}
+
+        with ThreadPoolExecutor(threads) as fetcher:
+
+            fetching = {
+                fetcher.submit(get_link_html, link): i for i, link in enumerate(links)
+            }
+
+            for future in tqdm(as_completed(fetching), total=len(links),
+                desc='Fetching', disable=not progress):
+
+                i = fetching[future]
+
+                try:
+                    html = future.result()
+                except Exception:
+                    log.exception('Failed fetching: {}'.format(links[i]))
+                    continue
+
+                if html is None:
+                    log.warning('No page for: {}'.format(links[i]))
+                    yield i, None
+
+                elif parser is None:
+
+                    try:
+                        result, seconds = _timed_parse(parse, html)
+                    except Exception:
+                        log.exception('Failed parsing: {}'.format(links[i]))
+                        continue
+
+                    metrics.observe('parse_seconds', seconds, kind='page')
+                    yield i, result
+
+                else:
+                    parsing[parser.submit(_timed_parse, parse, html)] = i
 
-    return tables_here
+                # Hand back whatever got parsed in the meantime
+                for done in [f for f in parsing if f.done()]:
 
-def dict_to_list(dict_table):
-    for i, row in sorted(dict_table.items()):
-        cols = []
+                    j = parsing.pop(done)
+                    result = parsed(done, j)
 
-        for j, col in sorted(row.items()):
-            cols.append(col)
+                    if result is not None:
+                        yield j, result
 
-        yield cols
+        for future in as_completed(parsing):
+
+            i = parsing[future]
+            result = parsed(future, i)
+
+            if result is not None:
+                yield i, result
+
+    finally:
+        if parser is not None:
+            parser.shutdown()
+
+def crawl_pages(links, parse, threads=_THREADS, processes=_PARSE_PROCESSES,
+    progress=True):
+    """
+    iter_pages collected into link order, [] for the pages that failed
+    """
+    links = list(links)
+    results = [[] for _ in links]
+
+    for i, result in iter_pages(links, parse, threads, processes, progress):
+
+        if result is not None:
+            results[i] = result
+
+    return results
+
+def crawl_tables(links, table_xpath=wikitable_xpath, prefer_text=False,
+    threads=_THREADS, processes=_PARSE_PROCESSES, progress=True):
+    """
+    get_tables for many pages at once, see crawl_pages
+    """
+    return crawl_pages(
+        links,
+        partial(parse_tables, table_xpath=table_xpath, prefer_text=prefer_text),
+        threads,
+        processes,
+        progress
+    )
+
+def _span(cell, attr):
+
+    try:
+        return int(cell.get(attr, 1))
+    except ValueError:
+        return 1
+
+@lru_cache(maxsize=65536)
+def wiki_url(href):
+    # The same few links show up in cell after cell
+    return urljoin(_base_url, href)
+
+def cell_links(cell):
+    """
+    Absolute wiki links anywhere underneath a table cell
+    """
+    return [
+        wiki_url(element.get('href'))
+        for element in cell.iterdescendants()
+        if 'wiki' in (element.get('href') or '')
+    ]
+
+def cell_value(cell, prefer_text):
+    """
+    The text of a cell, or with `prefer_text` off its wiki link (or
+    list of links) when it has any
+    """
+    if not prefer_text:
+        links = cell_links(cell)
+
+        if len(links) == 1:
+            return links[0]
+
+        elif links:
+            return links
+
+    return replace_space(cell)
 
 def parse_table(etable, prefer_text):
+    """
+    Lays the table out on a row-major grid with rowspan/colspan cells
+    copied into every slot they cover, and returns the rows with the
+    empty slots dropped. Unless `prefer_text` is set, a cell holding
+    wiki links comes back as the link (or list of links) instead of
+    its text
+    """
+    rows = []
+    height = 0
+
+    # Size the grid up front from the spans
+    for row_i, row in enumerate(etable.iter('tr')):
+
+        cells = [
+            (cell, _span(cell, 'rowspan'), _span(cell, 'colspan'))
+            for cell in row.iter('td', 'th')
+        ]
+
+        for _, row_span, _ in cells:
+            height = max(height, row_i + row_span)
+
+        rows.append(cells)
 
-    dict_table = defaultdict(lambda: defaultdict(str))
-    for row_i, row in enumerate(etable.xpath(table_row_xpath)):
+    height = max(height, len(rows))
+    width = max([sum(max(c, 0) for _, _, c in cells) for cells in rows] or [0])
+    grid = [[_EMPTY] * width for _ in range(height)]
 
-        for col_i, col in enumerate(row.xpath('{}|{}'.format(
-            table_data_xpath, table_header_xpath))):
+    for row_i, cells in enumerate(rows):
 
-            col_span = int(col.get('colspan', 1))
-            row_span = int(col.get('rowspan',1))
-            links = []
-            text = replace_space(col)
-            for info in col.xpath(descendant_xpath):
-                if 'href' in info.attrib:
-                    links.append(info.get('href'))
+        line = grid[row_i]
 
-            links = [l for l in links if 'wiki' in l]
-            links = list(map(lambda tail: urljoin(_base_url, tail), links))
+        for col_i, (cell, row_span, col_span) in enumerate(cells):
 
-            while row_i in dict_table and col_i in dict_table[row_i]:
+            while col_i < len(line) and line[col_i] is not _EMPTY:
                 col_i += 1
 
+            if row_span < 1 or col_span < 1:
+                continue
+
+            value = cell_value(cell, prefer_text)
+            end = col_i + col_span
+
             for i in range(row_i, row_i + row_span):
-                for j in range(col_i, col_i + col_span):
 
-                    if prefer_text:
-                        dict_table[i][j] = text
-                    
-                    elif len(links) == 1:
-                        dict_table[i][j] = links[0]
-                    
-                    elif len(links):
-                        dict_table[i][j] = links
-                    
-                    else:
-                        dict_table[i][j] = text
+                target = grid[i]
 
-    return list(dict_to_list(dict_table))
+                if end > len(target):
+                    target.extend([_EMPTY] * (end - len(target)))
 
-def get_table_col(tables, attr):
+                target[col_i:end] = [value] * col_span
 
-    items = set()
+    table = []
 
-    for table in tables:
-        
-        if not table:
-            continue
+    for line in grid:
 
-        index = -1
-        for i, row in enumerate(table):
-            lower = list(map(str.lower, row))
-            
-            if attr in lower:
-                index = i
-                break
+        values = [value for value in line if value is not _EMPTY]
 
-        if index == -1:
-            continue
+        if values:
+            table.append(values)
 
-        attr_index = lower.index(attr)
+    return table
 
-        for row in table[index:]:
+def iter_row_slots(etable):
+    """
+    Walks a table one row at a time and yields {column: cell} for every
+    slot covered in that row, the same layout parse_table builds. Only
+    the cells still held open by a rowspan are carried from one row to
+    the next, so nothing else about the table is kept around
+    """
+    carry = {}
 
-            if attr_index >= len(row):
-                continue
+    for row in etable.iter('tr'):
 
-            if isinstance(row[attr_index], list):
-                items.add(frozenset(row[attr_index]))
-            else:
-                items.add(row[attr_index])
+        slots = {col: cell for col, (_, cell) in carry.items()}
+        carry = {
+            col: (left - 1, cell)
+            for col, (left, cell) in carry.items() if left > 1
+        }
 
-    final_list = []
-    for i in items:
+        for col_i, cell in enumerate(row.iter('td', 'th')):
 
-        if isinstance(i, frozenset):
-            final_list.append(list(i))
-        else:
-            final_list.append(i)
+            row_span = _span(cell, 'rowspan')
+            col_span = _span(cell, 'colspan')
 
-    return final_list
+            while col_i in slots:
+                col_i += 1
 
+            if row_span < 1 or col_span < 1:
+                continue
 
+            for j in range(col_i, col_i + col_span):
 
-def execute(f, out_file, *args, **kwargs):
+                slots[j] = cell
 
-    if os.path.exists(out_file):
-        print('Already processed!')
+                if row_span > 1:
+                    carry[j] = (row_span - 1, cell)
 
-        with open(out_file, 'r') as f:
-            data = json.load(f)
+        yield slots
 
-        return data
+def iter_table_column(etable, attr, prefer_text=True):
+    """
+    Streams the values under the header `attr` (case insensitive)
+    straight off of the table element. The header is looked for once,
+    in the first row that has it, and only the cells of that column get
+    their text/links pulled out. Yields nothing when no row has the
+    header
+    """
+    attr = attr.lower()
+    column = None
+    last_cell = last_value = None
 
-    tqdm.write('Processing')
-    to_dump = f(*args, **kwargs)
+    for slots in iter_row_slots(etable):
 
-    with open(out_file, 'w') as out_f:
-        json.dump(to_dump, out_f)
+        if column is None:
 
-def multi_target(f):
+            for col, cell in sorted(slots.items()):
 
-    if callable(f):
+                if replace_space(cell).strip().lower() == attr:
+                    column = col
+                    break
 
-        lock.acquire()
-        try:
-            print('PID: {} working'.format(os.getpid()))
+            continue
+
+        cell = slots.get(column, None)
 
-        finally:
-            lock.release()
+        if cell is None:
+            continue
 
-        return f()
-    
-    return None
+        # Rowspans hand back the same cell row after row
+        if cell is not last_cell:
+            last_cell, last_value = cell, cell_value(cell, prefer_text)
 
-def lock_init(l):
-    global lock
-    lock = l
+        yield last_value
 
-def multi_exec(f, threads, target_arglist, *f_args, **f_kwargs):
+def unique_values(value_lists):
+    """
+    Single pass dedupe in first seen order, multi link lists included
+    """
+    seen = set()
+    unique = []
 
-    if not isinstance(threads, int):
-        raise RuntimeError('Threads must be int type, got: {}'
-            ' instead'.format(type(threads)))
+    for values in value_lists:
+        for value in values:
 
-    funcs = [partial(f, a, *f_args, **f_kwargs) for a in target_arglist]
+            key = tuple(value) if isinstance(value, list) else value
 
-    l = Lock()
-    with Pool(processes=threads, initializer=lock_init, initargs=(l,)) as p:
-        results = p.map(multi_target, funcs)
-    
-    return results
+            if key not in seen:
+                seen.add(key)
+                unique.append(value)
 
-def parse_wikipedia(dl_link=_parse_url):
+    return unique
 
-    wikilinks_file = os.path.join(_data_dir, 'wiki_links.json')
+def get_column(etables, attr, prefer_text=True):
+    """
+    Distinct values of the `attr` column across tables
+    """
+    return unique_values(
+        iter_table_column(table, attr, prefer_text) for table in etables
+    )
 
-    wiki_links_data = execute(
-        get_year_links,
-        wikilinks_file,
-        _parse_url
+def page_column(html, attr, table_xpath=wikitable_xpath, prefer_text=True):
+    """
+    get_column over the tables of a page, for crawl_pages
+    """
+    root = l_html.fromstring(html)
+    return get_column(root.xpath(table_xpath), attr, prefer_text)
+
+def parse_wikipedia(dl_link=None, threads=_THREADS,
+    processes=_PARSE_PROCESSES, store=None):
+    """
+    Year pages -> artist names. Each stage is kept in the artifact
+    store and only rebuilt when what it was built from changes. The
+    column stage keeps every page as it's parsed, so pages that failed
+    (or a crash) only cost a re-run of the pages still missing
+    """
+    dl_link = dl_link or _parse_url
+    store = store or ArtifactStore()
+
+    wiki_links = store.stage(
+        'wiki_links',
+        [dl_link],
+        lambda done: ({'link': link} for link in get_year_links(dl_link))
     )
+    links = [record['link'] for record in wiki_links]
 
-    artists_table = os.path.join(_data_dir, 'artists.json')
+    parse = partial(page_column, attr='artist', table_xpath=wikitable_xpath)
 
-    artists_tables = execute(
-        multi_exec,
-        artists_table,
-        get_tables,
-        _THREADS,
-        wiki_links_data,
-        table_xpath=wikitable_xpath,
-        prefer_text=True
-    )
+    def produce_columns(done):
 
-    all_artists = os.path.join(_data_dir, 'artists_names.json')
+        finished = set(record['link'] for record in done)
+        remaining = [link for link in links if link not in finished]
+        produced = 0
 
-    results = []
-    for tables in artists_tables:
+        # Only the artist column of every page comes back from the workers.
+        # A page that isn't there is done with, it just has no artists
+        for i, values in iter_pages(remaining, parse, threads, processes):
+            produced += 1
+            yield {'link': remaining[i], 'values': values or []}
 
-        results.extend(
-            get_table_col(tables, 'artist')
-        )
+        if produced < len(remaining):
+            raise RuntimeError('{} of {} pages failed, run again to retry '
+                'them'.format(len(remaining) - produced, len(remaining)))
+
+    artist_columns = store.stage(
+        'artist_columns',
+        [links, parse],
+        produce_columns,
+        resume=True,
+        checkpoint_every=1
+    )
+
+    results = unique_values(record['values'] for record in artist_columns)
+
+    # The genius scraper reads the names from here
+    all_artists = os.path.join(_data_dir, 'artists_names.json')
 
     with open(all_artists, 'w') as f:
         json.dump(results, f)
@@ -0,0 +1,99 @@
+#############################################################################
+#
+# Author: Milan Patel
+# Purpose: Threaded producer/consumer stages joined by bounded queues
+# Date: 06/05/2018
+#
+#############################################################################
+
+import os
+import logging
+import threading
+from queue import Queue
+
+_DONE = object()
+
+class Stage(object):
+
+    def __init__(self, name, func, workers=1, queue_size=None):
+
+        if workers < 1:
+            raise RuntimeError('Stage {} needs at least one worker'.format(name))
+
+        self.name = name
+        self.func = func
+        self.workers = workers
+        self.queue_size = queue_size if queue_size else workers * 4
+
+class Pipeline(object):
+    """
+    Every stage gets its own pool of threads reading from a bounded
+    queue. A stage function is called as func(item, emit) and calls
+    emit(result) for every item it hands downstream, zero or many
+    times. emit blocks when the next queue is full, so a slow stage
+    pushes back on the ones before it instead of piling up memory.
+
+    Network bound stages can be given lots of threads while the CPU
+    bound ones (lxml releases the GIL while parsing) get a few.
+    """
+
+    def __init__(self):
+        self.stages = []
+
+    def add(self, name, func, workers=1, queue_size=None):
+        self.stages.append(Stage(name, func, workers, queue_size))
+        return self
+
+    def _work(self, stage, in_queue, emit):
+
+        log = logging.getLogger(str(os.getpid()))
+
+        for item in iter(in_queue.get, _DONE):
+
+            try:
+                stage.func(item, emit)
+
+            except:
+                log.exception('Stage {} failed on: {}'.format(stage.name, item))
+
+    def run(self, items):
+        """
+        Pushes every item through and returns once the last stage has
+        drained
+        """
+        if not self.stages:
+            raise RuntimeError('Pipeline has no stages!')
+
+        queues = [Queue(maxsize=stage.queue_size) for stage in self.stages]
+        threads = []
+
+        for i, stage in enumerate(self.stages):
+
+            if i + 1 < len(queues):
+                emit = queues[i + 1].put
+            else:
+                emit = lambda item: None
+
+            threads.append([
+                threading.Thread(
+                    target=self._work,
+                    args=(stage, queues[i], emit),
+                    name='{}-{}'.format(stage.name, j),
+                    daemon=True
+                ) for j in range(stage.workers)
+            ])
+
+        for stage_threads in threads:
+            for t in stage_threads: t.start()
+
+        for item in items:
+            queues[0].put(item)
+
+        # Shut down in order, a stage only stops once everything
+        # upstream of it has finished emitting
+        for i, stage in enumerate(self.stages):
+
+            for _ in range(stage.workers):
+                queues[i].put(_DONE)
+
+            for t in threads[i]: t.join()
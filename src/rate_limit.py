@@ -0,0 +1,149 @@
+#############################################################################
+#
+# Author: Milan Patel
+# Purpose: Token bucket rate limiter shared by every worker process so the
+#          combined request rate tracks the API quota
+# Date: 06/05/2018
+#
+#############################################################################
+
+import time
+import asyncio
+from multiprocessing import Array, Lock
+
+DEFAULT_RATE = 5.0
+DEFAULT_BURST = 10
+RETRY_STATUSES = frozenset([429, 500, 502, 503, 504])
+
+# Slots of the shared state array
+_TOKENS = 0
+_LAST = 1
+_RATE = 2
+_BLOCKED_UNTIL = 3
+
+class TokenBucket(object):
+    """
+    The bucket state lives in shared memory, so create it in the parent
+    and hand it to the children through the Process args. Every worker
+    then draws from the same budget.
+
+    Backoff is AIMD: a 429/5xx response multiplies the rate by `backoff`
+    and blocks everybody for the Retry-After period, while each success
+    adds `recovery` requests/sec back until `rate` is reached again.
+    """
+
+    def __init__(self, rate=DEFAULT_RATE, burst=DEFAULT_BURST, min_rate=None,
+        backoff=0.5, recovery=None):
+
+        if rate <= 0:
+            raise RuntimeError('Rate must be positive, got: {}'.format(rate))
+
+        if burst < 1:
+            raise RuntimeError('Burst must be at least 1, got: {}'.format(burst))
+
+        self.max_rate = float(rate)
+        self.burst = float(burst)
+        self.min_rate = float(min_rate) if min_rate else self.max_rate / 20.
+        self.backoff = backoff
+        self.recovery = recovery if recovery else self.max_rate / 50.
+
+        self._lock = Lock()
+        self._state = Array(
+            'd',
+            [self.burst, time.monotonic(), self.max_rate, 0.],
+            lock=False
+        )
+
+    @property
+    def rate(self):
+        return self._state[_RATE]
+
+    def _refill(self, now):
+        state = self._state
+        elapsed = max(0., now - state[_LAST])
+        state[_TOKENS] = min(self.burst, state[_TOKENS] + elapsed * state[_RATE])
+        state[_LAST] = now
+
+    def _take(self):
+        """
+        Returns 0 when a token was taken, otherwise how long to wait
+        before trying again
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            state = self._state
+
+            if now < state[_BLOCKED_UNTIL]:
+                return state[_BLOCKED_UNTIL] - now
+
+            if state[_TOKENS] >= 1.:
+                state[_TOKENS] -= 1.
+                return 0.
+
+            return (1. - state[_TOKENS]) / state[_RATE]
+
+    def acquire(self):
+
+        wait = self._take()
+
+        while wait:
+            time.sleep(wait)
+            wait = self._take()
+
+    async def async_acquire(self):
+
+        wait = self._take()
+
+        while wait:
+            await asyncio.sleep(wait)
+            wait = self._take()
+
+    def penalize(self, retry_after=None):
+
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            state = self._state
+
+            state[_RATE] = max(self.min_rate, state[_RATE] * self.backoff)
+            state[_TOKENS] = 0.
+
+            pause = retry_after if retry_after else 1. / state[_RATE]
+            state[_BLOCKED_UNTIL] = max(state[_BLOCKED_UNTIL], now + pause)
+
+    def reward(self):
+
+        # Cheap check first, no need to take the lock at full speed
+        if self._state[_RATE] >= self.max_rate:
+            return
+
+        with self._lock:
+            self._state[_RATE] = min(
+                self.max_rate,
+                self._state[_RATE] + self.recovery
+            )
+
+    def update(self, status, retry_after=None):
+        """
+        Feed every response status back in. Returns True when the
+        request should be retried
+        """
+        if status in RETRY_STATUSES:
+            self.penalize(parse_retry_after(retry_after))
+            return True
+
+        self.reward()
+        return False
+
+def parse_retry_after(value):
+
+    if not value:
+        return None
+
+    try:
+        return max(0., float(value))
+
+    except (TypeError, ValueError):
+        # HTTP dates are valid too, but genius only sends seconds
+        return None
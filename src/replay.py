@@ -0,0 +1,525 @@
+#############################################################################
+#
+# Author: Milan Patel
+# Purpose: Records what the scraper gets back from Genius/Wikipedia and
+#          replays it from local stand-in servers, so the crawl can be
+#          timed offline under a chosen latency and rate limiting
+# Date: 06/05/2018
+#
+# Usage: REPLAY_RECORD_DIR=<dir> python ...     record a real run
+#        python replay.py serve <dir>
+#        python replay.py wikipedia <dir>
+#        python replay.py genius <dir> <artists names file>
+#
+#############################################################################
+
+import os
+import sys
+import json
+import time
+import glob
+import base64
+import random
+import logging
+import argparse
+import tempfile
+import threading
+from urllib.parse import (
+    urlsplit,
+    urlunsplit,
+    parse_qsl,
+    urlencode,
+    unquote
+)
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Never part of what identifies a response
+_IGNORED_PARAMS = frozenset(['access_token'])
+
+# Not worth replaying, the servers make their own 429s
+_SKIPPED_STATUSES = frozenset([429, 500, 502, 503, 504])
+
+_TEXT_TYPES = ('text/', 'json', 'xml', 'javascript')
+
+def request_key(url, params=None):
+    """
+    (netloc, path?sorted query) of a request, with the query string of
+    the url and `params` merged so both spellings land on one key
+    """
+    parts = urlsplit(url)
+    query = parse_qsl(parts.query, keep_blank_values=True)
+
+    if params:
+        items = params.items() if isinstance(params, dict) else params
+        query.extend((k, str(v)) for k, v in items)
+
+    query = sorted((k, v) for k, v in query if k not in _IGNORED_PARAMS)
+    path = unquote(parts.path) or '/'
+
+    return parts.netloc, path + ('?' + urlencode(query) if query else '')
+
+def _is_text(content_type):
+    return any(kind in (content_type or '') for kind in _TEXT_TYPES)
+
+class Recorder(object):
+    """
+    Appends every response http_cache.fetch and GeniusClient hand back
+    to a JSON lines file in `directory`, one file per process written
+    through an O_APPEND descriptor so forked workers can all record:
+
+        {"netloc": ..., "key": ..., "status": 200, "content_type": ...,
+         "text": ...}                     (or "base64" for binary bodies)
+
+    Each request is only written once per process
+    """
+
+    def __init__(self, directory):
+
+        self.directory = directory
+
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+        self._fd = None
+        self._pid = None
+        self._seen = set()
+        self._lock = threading.Lock()
+
+    def record(self, url, params, status, content_type, body):
+
+        if status in _SKIPPED_STATUSES:
+            return
+
+        netloc, key = request_key(url, params)
+
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+
+        record = {
+            'netloc': netloc,
+            'key': key,
+            'status': status,
+            'content_type': content_type
+        }
+
+        try:
+            record['text'] = body.decode('utf-8')
+        except UnicodeDecodeError:
+            record['base64'] = base64.b64encode(body).decode('ascii')
+
+        line = (json.dumps(record, separators=(',', ':')) + '\n').encode('utf-8')
+
+        with self._lock:
+
+            if self._pid != os.getpid():
+                self._fd = os.open(
+                    os.path.join(self.directory, 'responses.{}.jsonl'.format(os.getpid())),
+                    os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+                    0o644
+                )
+                self._pid = os.getpid()
+                self._seen = set()
+
+            if (netloc, key) in self._seen:
+                return
+
+            self._seen.add((netloc, key))
+            os.write(self._fd, line)
+
+    def close(self):
+
+        with self._lock:
+
+            if self._fd is not None and self._pid == os.getpid():
+                os.close(self._fd)
+
+            self._fd = None
+            self._pid = None
+
+def load_recording(directory):
+    """
+    netloc -> {key: (status, content type, body bytes)} from every
+    recording file in `directory`, later records win
+    """
+    responses = {}
+
+    for path in sorted(glob.glob(os.path.join(directory, '*.jsonl'))):
+        with open(path, 'rb') as f:
+            for line in f:
+
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+
+                if 'text' in record:
+                    body = record['text'].encode('utf-8')
+                else:
+                    body = base64.b64decode(record['base64'])
+
+                responses.setdefault(record['netloc'], {})[record['key']] = (
+                    record['status'], record['content_type'], body)
+
+    return responses
+
+class ReplayServer(ThreadingHTTPServer):
+    """
+    Stand-in for one recorded origin. Every request waits `latency`
+    seconds, give or take up to `jitter`, and a `throttle_rate` fraction
+    of them get a 429 with a Retry-After instead of the answer.
+    Anything that wasn't recorded is a 404
+    """
+
+    daemon_threads = True
+
+    def __init__(self, netloc, responses, latency=0., jitter=0.,
+        throttle_rate=0., retry_after=1, rng=None):
+
+        super(ReplayServer, self).__init__(('127.0.0.1', 0), _ReplayHandler)
+
+        self.netloc = netloc
+        self.responses = responses
+        self.latency = latency
+        self.jitter = jitter
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.stats = Counter()
+
+        self._rng = rng or random.Random()
+        self._rng_lock = threading.Lock()
+
+    @property
+    def base(self):
+        return 'http://127.0.0.1:{}'.format(self.server_address[1])
+
+    def draw(self):
+        """
+        (delay, throttled) for the next request
+        """
+        with self._rng_lock:
+            delay = self.latency + self._rng.uniform(-self.jitter, self.jitter)
+            throttled = self._rng.random() < self.throttle_rate
+
+        return max(delay, 0.), throttled
+
+class _ReplayHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+
+        server = self.server
+        delay, throttled = server.draw()
+        time.sleep(delay)
+
+        if throttled:
+            server.stats['throttled'] += 1
+            self.send_response(429)
+            self.send_header('Retry-After', str(server.retry_after))
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        _, key = request_key(self.path)
+        response = server.responses.get(key, None)
+
+        if response is None:
+            server.stats['missing'] += 1
+            self.send_error(404, 'Not recorded: {}'.format(key))
+            return
+
+        server.stats['served'] += 1
+        status, content_type, body = response
+
+        self.send_response(status)
+
+        if content_type:
+            self.send_header('Content-Type', content_type)
+
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+class ReplayHarness(object):
+    """
+    One ReplayServer per origin in a recording. configure() points the
+    scraper and the wikipedia parser at them (module globals for this
+    process, the environment for any worker that re-imports them) and
+    turns the response cache off so every page really goes over HTTP.
+    Absolute links to a recorded origin inside the bodies are rewritten
+    to the matching local server.
+
+        with ReplayHarness('data_path/replay', latency=.05).configure():
+            parse_wikipedia()
+    """
+
+    def __init__(self, directory, latency=0., jitter=0., throttle_rate=0.,
+        retry_after=1, seed=None):
+
+        self.directory = directory
+        self.latency = latency
+        self.jitter = jitter
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.seed = seed
+        self.servers = {}
+        self._threads = []
+        self._environ = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def start(self):
+
+        log = logging.getLogger(str(os.getpid()))
+        recording = load_recording(self.directory)
+
+        if not recording:
+            raise RuntimeError('Nothing recorded in: {}'.format(self.directory))
+
+        rng = random.Random(self.seed)
+
+        for netloc, responses in sorted(recording.items()):
+            self.servers[netloc] = ReplayServer(
+                netloc,
+                responses,
+                self.latency,
+                self.jitter,
+                self.throttle_rate,
+                self.retry_after,
+                random.Random(rng.random())
+            )
+
+        # Only now are all of the local ports known
+        for server in self.servers.values():
+            server.responses = {
+                key: (status, content_type,
+                    self._rewrite_body(body) if _is_text(content_type) else body)
+                for key, (status, content_type, body) in server.responses.items()
+            }
+
+            thread = threading.Thread(target=server.serve_forever,
+                name='replay-{}'.format(server.netloc), daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+            log.info('Replaying {} responses of {} at {}'.format(
+                len(server.responses), server.netloc, server.base))
+
+        self._point_at_servers()
+
+        return self
+
+    def _rewrite_body(self, body):
+
+        for netloc, server in self.servers.items():
+
+            local = server.base.encode('ascii')
+            remote = netloc.encode('ascii')
+
+            body = body.replace(b'https://' + remote, local)
+            body = body.replace(b'http://' + remote, local)
+            body = body.replace(b'//' + remote, b'//' + local.split(b'//', 1)[1])
+
+        return body
+
+    def rewrite(self, url):
+        """
+        The local equivalent of a url on a recorded origin
+        """
+        parts = urlsplit(url)
+        server = self.servers.get(parts.netloc, None)
+
+        if server is None:
+            return url
+
+        local = urlsplit(server.base)
+        return urlunsplit(('http', local.netloc, parts.path, parts.query, parts.fragment))
+
+    def _local(self, url):
+
+        if urlsplit(url).netloc not in self.servers:
+            return None
+
+        return self.rewrite(url)
+
+    def environ(self):
+        """
+        Environment variables that point a fresh process at the servers
+        """
+        return dict(self._environ)
+
+    def _point_at_servers(self):
+
+        # Worked out from the live origins before configure() moves them
+        import genius_scraper
+        import parse_html
+
+        urls = {
+            'GENIUS_BASE': self._local(genius_scraper.GENIUS_BASE),
+            'GENIUS_WEB_BASE': self._local(genius_scraper.GENIUS_WEB_BASE),
+            'WIKI_BASE': self._local(parse_html._base_url),
+            'WIKI_PARSE_URL': self._local(parse_html._parse_url)
+        }
+
+        self._environ = {name: url for name, url in urls.items() if url is not None}
+
+    def configure(self, cache=False):
+
+        import http_cache
+        import genius_scraper
+        import parse_html
+
+        if not self.servers:
+            self.start()
+
+        environ = self.environ()
+        os.environ.update(environ)
+
+        genius_scraper.set_bases(
+            api=environ.get('GENIUS_BASE', None),
+            web=environ.get('GENIUS_WEB_BASE', None)
+        )
+        parse_html.set_bases(
+            base_url=environ.get('WIKI_BASE', None),
+            parse_url=environ.get('WIKI_PARSE_URL', None)
+        )
+
+        if not cache:
+            http_cache.set_cache(None)
+
+        return self
+
+    def stats(self):
+        return {netloc: dict(server.stats) for netloc, server in self.servers.items()}
+
+    def stop(self):
+
+        for server in self.servers.values():
+            server.shutdown()
+            server.server_close()
+
+        for thread in self._threads:
+            thread.join()
+
+        self._threads = []
+
+def _report(harness, elapsed):
+
+    print('Finished in {:.2f}s'.format(elapsed))
+
+    for netloc, stats in sorted(harness.stats().items()):
+        print('  {}: {}'.format(netloc, ', '.join(
+            '{} {}'.format(count, name) for name, count in sorted(stats.items()))))
+
+def _run_wikipedia(harness, args):
+
+    from parse_html import parse_wikipedia
+    from artifacts import ArtifactStore
+
+    # A scratch store, or the stages would come back up to date
+    with tempfile.TemporaryDirectory() as directory:
+
+        start = time.time()
+        artists = parse_wikipedia(threads=args.threads, processes=args.processes,
+            store=ArtifactStore(directory))
+
+    print('{} artists'.format(len(artists)))
+    _report(harness, time.time() - start)
+
+def _run_genius(harness, args):
+
+    import database
+    from genius_scraper import main
+
+    # A scratch database, or songs stored by the last run get skipped
+    # and the replay writes into the real one. The workers fork after
+    # this so they pick it up too
+    database.set_db_name('replay_{}'.format(os.getpid()))
+
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+
+            # The token is never checked, main just needs one to read
+            token_path = os.path.join(directory, 'access_token.txt')
+
+            with open(token_path, 'w') as f:
+                f.write('replay')
+
+            start = time.time()
+            main(directory, args.artists_file, token_path, metrics_port=None)
+
+        _report(harness, time.time() - start)
+
+    finally:
+        database.initialize_alias('replay')
+        database.drop_database('replay')
+
+def _arguments():
+
+    parser = argparse.ArgumentParser(description='Offline replay of a recorded crawl')
+    parser.add_argument('--latency', type=float, default=0.,
+        help='seconds added to every response')
+    parser.add_argument('--jitter', type=float, default=0.,
+        help='up to this many seconds more or less latency')
+    parser.add_argument('--throttle-rate', type=float, default=0.,
+        help='fraction of requests answered with a 429')
+    parser.add_argument('--retry-after', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=None)
+
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    serve = commands.add_parser('serve', help='serve a recording until interrupted')
+    serve.add_argument('directory')
+
+    wikipedia = commands.add_parser('wikipedia', help='time parse_wikipedia')
+    wikipedia.add_argument('directory')
+    wikipedia.add_argument('--threads', type=int, default=8)
+    wikipedia.add_argument('--processes', type=int, default=2)
+
+    genius = commands.add_parser('genius', help='time genius_scraper.main')
+    genius.add_argument('directory')
+    genius.add_argument('artists_file')
+
+    return parser.parse_args()
+
+if __name__ == '__main__':
+
+    logging.basicConfig(level=logging.INFO)
+    args = _arguments()
+
+    harness = ReplayHarness(
+        args.directory,
+        latency=args.latency,
+        jitter=args.jitter,
+        throttle_rate=args.throttle_rate,
+        retry_after=args.retry_after,
+        seed=args.seed
+    )
+
+    with harness.configure():
+
+        if args.command == 'serve':
+
+            for name, url in sorted(harness.environ().items()):
+                print('{}={}'.format(name, url))
+
+            try:
+                while True:
+                    time.sleep(1)
+            except KeyboardInterrupt:
+                pass
+
+        elif args.command == 'wikipedia':
+            _run_wikipedia(harness, args)
+
+        else:
+            _run_genius(harness, args)
+
+    sys.exit(0)
@@ -0,0 +1,205 @@
+#############################################################################
+#
+# Author: Milan Patel
+# Purpose: Materialized per year/artist/album sentiment rollups
+# Date: 06/05/2018
+#
+#############################################################################
+
+import os
+import math
+import logging
+from collections import defaultdict
+
+from pymongo import (
+    UpdateOne,
+    UpdateMany
+)
+
+import database
+
+from database import (
+    get_collection,
+    db_aggregate,
+    UNKNOWN_DATE
+)
+
+ROLLUPS = {
+    'year': database.YearRollup,
+    'artist': database.ArtistRollup,
+    'album': database.AlbumRollup,
+}
+
+# Song fields the deltas need to see, pass them to the scoring cursor
+SONG_FIELDS = ('sentiment', 'release_date', 'artist_id', 'album_id')
+
+def song_keys(doc):
+    """
+    Which rollup each song counts toward, kind -> key
+    """
+    keys = {}
+    release_date = doc.get('release_date', None)
+
+    if release_date is not None and release_date > UNKNOWN_DATE:
+        keys['year'] = release_date.year
+
+    for kind, field in [('artist', 'artist_id'), ('album', 'album_id')]:
+
+        if doc.get(field, None) is not None:
+            keys[kind] = doc[field]
+
+    return keys
+
+class RollupDeltas(object):
+    """
+    Collects the change every newly scored song makes to the rollups.
+    The rollups always reflect Song.sentiment, so a rescored song swaps
+    its old score out for the new one and a first time score adds one
+    to the count.
+    """
+
+    def __init__(self):
+        self._deltas = defaultdict(lambda: [0, 0., 0.])
+
+    def __len__(self):
+        return len(self._deltas)
+
+    def add(self, doc, score):
+
+        old = doc.get('sentiment', None)
+
+        if old is None:
+            change = (1, score, score * score)
+        else:
+            change = (0, score - old, score * score - old * old)
+
+        for kind, key in song_keys(doc).items():
+
+            delta = self._deltas[(kind, key)]
+            delta[0] += change[0]
+            delta[1] += change[1]
+            delta[2] += change[2]
+
+    def flush(self, identity):
+        """
+        One unordered bulk of $inc upserts per rollup collection
+        """
+        by_kind = defaultdict(list)
+
+        for (kind, key), (count, total, total_sq) in self._deltas.items():
+            by_kind[kind].append(UpdateOne(
+                {'key': key},
+                {'$inc': {'count': count, 'total': total, 'total_sq': total_sq}},
+                upsert=True
+            ))
+
+        for kind, requests in by_kind.items():
+            get_collection(identity, ROLLUPS[kind]).bulk_write(
+                requests, ordered=False)
+
+        self._deltas.clear()
+
+def backfill_artist_ids(identity):
+    """
+    Songs scraped before Song.artist_id existed only show up in the
+    Artist.song_ids lists
+    """
+    artists = get_collection(identity, database.Artist).find(
+        {'song_ids.0': {'$exists': True}},
+        {'_id': 0, 'genius_id': 1, 'song_ids': 1}
+    )
+
+    requests = [
+        UpdateMany(
+            {'genius_id': {'$in': artist['song_ids']}, 'artist_id': None},
+            {'$set': {'artist_id': artist['genius_id']}}
+        ) for artist in artists if artist.get('genius_id', None) is not None
+    ]
+
+    if requests:
+        get_collection(identity, database.Song).bulk_write(
+            requests, ordered=False)
+
+    return len(requests)
+
+def _rollup_pipeline(kind):
+
+    match = {'sentiment': {'$ne': None}}
+
+    if kind == 'year':
+        match['release_date'] = {'$gt': UNKNOWN_DATE}
+        group_key = {'$year': '$release_date'}
+    else:
+        field = '{}_id'.format(kind)
+        match[field] = {'$ne': None}
+        group_key = '$' + field
+
+    return [
+        {'$match': match},
+        {'$group': {
+            '_id': group_key,
+            'count': {'$sum': 1},
+            'total': {'$sum': '$sentiment'},
+            'total_sq': {'$sum': {'$multiply': ['$sentiment', '$sentiment']}},
+        }},
+        {'$project': {
+            '_id': 0,
+            'key': '$_id',
+            'count': 1,
+            'total': 1,
+            'total_sq': 1,
+        }},
+    ]
+
+def rebuild_rollups(identity):
+    """
+    Recomputes every rollup from the songs on the server. Run it once
+    to seed the rollups, and again whenever songs get their dates or
+    artists changed since the incremental deltas only follow scores
+    """
+    log = logging.getLogger(str(os.getpid()))
+    log.info('Backfilled artist ids from {} artists'.format(
+        backfill_artist_ids(identity)))
+
+    for kind, rollup in ROLLUPS.items():
+
+        # Make sure the collection and its key index exist before $out
+        # swaps the contents
+        name = get_collection(identity, rollup).name
+
+        db_aggregate(
+            identity,
+            database.Song,
+            _rollup_pipeline(kind) + [{'$out': name}]
+        )
+        log.info('Rebuilt {} rollups'.format(kind))
+
+def sentiment_by(identity, kind, keys=None):
+    """
+    Mean/std sentiment per year, artist or album straight out of the
+    rollup collection. Returns [{key, count, mean, std}] sorted by key
+    """
+    query = {'count': {'$gt': 0}}
+
+    if keys is not None:
+        query['key'] = {'$in': list(keys)}
+
+    results = []
+    cursor = get_collection(identity, ROLLUPS[kind]).find(
+        query,
+        {'_id': 0, 'key': 1, 'count': 1, 'total': 1, 'total_sq': 1}
+    ).sort('key', 1)
+
+    for doc in cursor:
+
+        mean = doc['total'] / doc['count']
+        variance = max(0., doc['total_sq'] / doc['count'] - mean * mean)
+
+        results.append({
+            'key': doc['key'],
+            'count': doc['count'],
+            'mean': mean,
+            'std': math.sqrt(variance)
+        })
+
+    return results
@@ -0,0 +1,183 @@
+#############################################################################
+#
+# Author: Milan Patel
+# Purpose: Work stealing task scheduler for the scraper worker processes
+# Date: 06/05/2018
+#
+#############################################################################
+
+import os
+import time
+import random
+import logging
+from queue import Empty
+from multiprocessing import Queue, Value
+from multiprocessing.connection import wait
+
+_POLL = 0.05
+
+class WorkStealingScheduler(object):
+    """
+    Every worker process gets its own task queue. A worker takes from
+    its own queue first, and only once that's empty goes looking
+    through the others for something to steal, so a worker stuck with
+    a huge artist gets its songs taken off its hands by everybody who
+    ran out of work.
+
+    Tasks can spawn more tasks (an artist spawns its songs), they land
+    on the spawning worker's queue. A shared counter of tasks that are
+    queued or running is what tells the workers they're done: it's
+    bumped before a task is queued and dropped after it finishes, so it
+    can only hit zero once there's nothing left anywhere.
+
+    A worker that dies mid-task never drops the counter, so the parent
+    waits on the workers with join(), which stops the rest instead of
+    leaving them polling for work that can't finish.
+
+    Create it in the parent, seed() it, and hand it to the processes
+    along with their index, which then call run(index, handle).
+    """
+
+    def __init__(self, workers):
+
+        if workers < 1:
+            raise RuntimeError('The scheduler needs at least one worker')
+
+        self.workers = workers
+        self.queues = [Queue() for _ in range(workers)]
+        self.outstanding = Value('l', 0)
+        self.steals = Value('l', 0)
+        self.stopped = Value('b', 0)
+
+    def push(self, index, tasks):
+        """
+        Queues tasks for worker `index`
+        """
+        tasks = list(tasks)
+
+        if not tasks:
+            return
+
+        with self.outstanding.get_lock():
+            self.outstanding.value += len(tasks)
+
+        for task in tasks:
+            self.queues[index].put(task)
+
+    def seed(self, tasks):
+        """
+        Deals the initial tasks out round robin
+        """
+        dealt = [[] for _ in range(self.workers)]
+
+        for i, task in enumerate(tasks):
+            dealt[i % self.workers].append(task)
+
+        for index, tasks in enumerate(dealt):
+            self.push(index, tasks)
+
+    def _steal(self, index):
+
+        victims = [i for i in range(self.workers) if i != index]
+        random.shuffle(victims)
+
+        for victim in victims:
+
+            try:
+                task = self.queues[victim].get_nowait()
+            except Empty:
+                continue
+
+            with self.steals.get_lock():
+                self.steals.value += 1
+
+            return task
+
+        return None
+
+    def next_task(self, index):
+        """
+        The next task for worker `index`, None once every queue has
+        drained and nothing is running that could add more
+        """
+        own = self.queues[index]
+
+        while not self.stopped.value:
+
+            try:
+                return own.get_nowait()
+            except Empty:
+                pass
+
+            task = self._steal(index)
+
+            if task is not None:
+                return task
+
+            if not self.outstanding.value:
+                return None
+
+            # Somebody's still working and may spawn more
+            try:
+                return own.get(timeout=_POLL)
+            except Empty:
+                pass
+
+        return None
+
+    def done(self):
+
+        with self.outstanding.get_lock():
+            self.outstanding.value -= 1
+
+    def stop(self):
+        """
+        Has every worker finish its current task and leave
+        """
+        self.stopped.value = 1
+
+    def join(self, processes):
+        """
+        Waits for the worker processes to exit. If one dies (killed,
+        crashed) the tasks it held are never done, so the others are
+        stopped rather than left waiting on them
+        """
+        log = logging.getLogger(str(os.getpid()))
+        running = {proc.sentinel: proc for proc in processes}
+
+        while running:
+
+            for sentinel in wait(list(running)):
+                proc = running.pop(sentinel)
+                proc.join()
+
+                if proc.exitcode and not self.stopped.value:
+                    log.error('Worker {} died with exit code {} and {} tasks '
+                        'left, stopping the rest'.format(
+                            proc.pid, proc.exitcode, self.outstanding.value))
+                    self.stop()
+
+    def run(self, index, handle):
+        """
+        Worker loop, calls handle(task, spawn) for every task this
+        worker gets. spawn(tasks) queues more work on this worker
+        """
+        log = logging.getLogger(str(os.getpid()))
+        spawn = lambda tasks: self.push(index, tasks)
+        handled = 0
+        start = time.time()
+
+        for task in iter(lambda: self.next_task(index), None):
+
+            try:
+                handle(task, spawn)
+
+            except:
+                log.exception('Task failed: {}'.format(task))
+
+            finally:
+                self.done()
+                handled += 1
+
+        log.info('Worker {} ran {} tasks in {:.1f}s, {} steals overall'.format(
+            index, handled, time.time() - start, self.steals.value))
@@ -0,0 +1,409 @@
+#############################################################################
+#
+# Author: Milan Patel
+# Purpose: Batch lexicon based sentiment scoring of the stored lyrics
+# Date: 06/05/2018
+#
+#############################################################################
+
+import os
+import re
+import time
+import hashlib
+import logging
+import numpy as np
+from multiprocessing import Process, Queue, cpu_count
+
+import database
+import metrics
+
+from database import (
+    BulkWriter,
+    get_collection,
+    db_aggregate,
+    initialize_alias
+)
+
+from rollups import (
+    RollupDeltas,
+    SONG_FIELDS
+)
+
+from tools import (
+    NO_LYRICS,
+    hash_lyrics
+)
+
+SCORER_VERSION = '1'
+DEFAULT_CHUNK_SIZE = 2000
+
+_token_matcher = re.compile(r"[a-z]+(?:'[a-z]+)*")
+
+class Lexicon(object):
+    """
+    Word -> score lexicon laid out for vectorized lookups. Every word
+    gets an integer id and `scores[id]` is its score. Id 0 is reserved
+    for words that aren't in the lexicon and scores 0.
+    """
+
+    def __init__(self, word_scores):
+
+        words = sorted(word_scores)
+
+        self.index = {word: i + 1 for i, word in enumerate(words)}
+        self.scores = np.zeros(len(words) + 1, dtype=np.float64)
+        self.scores[1:] = [word_scores[word] for word in words]
+
+        # Changes whenever a word or a score does
+        self.digest = hashlib.sha1('\n'.join(
+            '{}\t{!r}'.format(word, float(word_scores[word])) for word in words
+        ).encode('utf-8')).hexdigest()[:12]
+
+    def __len__(self):
+        return len(self.index)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Reads an AFINN style file, one `word<TAB>score` per line. Multi
+        word phrases can't match single tokens so they're skipped
+        """
+        word_scores = {}
+
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+
+                line = line.strip()
+
+                if not line or line.startswith('#'):
+                    continue
+
+                word, _, score = line.rpartition('\t')
+
+                if not word or ' ' in word:
+                    continue
+
+                word_scores[word.lower()] = float(score)
+
+        return cls(word_scores)
+
+    def ids(self, words):
+        """
+        Lexicon ids for an array of distinct words
+        """
+        get = self.index.get
+        return np.fromiter((get(w, 0) for w in words), dtype=np.int64, count=len(words))
+
+def scorer_version(lexicon):
+    """
+    What gets stamped on every scored song, bump SCORER_VERSION when the
+    tokenizing/scoring changes. Lexicon edits change it on their own
+    """
+    return '{}:{}'.format(SCORER_VERSION, lexicon.digest)
+
+def stale_query(version, query=None):
+    """
+    Songs that need (re)scoring, never scored, scored by another
+    version, or with lyrics stored since. Goes through the
+    scorer_version index instead of scanning the collection
+    """
+    stale = dict(query or {})
+    stale['scorer_version'] = {'$ne': version}
+
+    return stale
+
+def tokenize(text):
+
+    if not text or text == NO_LYRICS:
+        return []
+
+    return _token_matcher.findall(text.lower())
+
+def score_texts(lexicon, texts):
+    """
+    Scores a batch of lyrics at once. All of the tokens in the batch are
+    flattened into one array, the distinct words are looked up in the
+    lexicon once, and the per token scores are summed back into their
+    documents with bincount. Returns a dict of per document arrays.
+    """
+    n = len(texts)
+    tokens = [tokenize(text) for text in texts]
+    counts = np.fromiter((len(t) for t in tokens), dtype=np.int64, count=n)
+    total = int(counts.sum())
+
+    if not total:
+        zeros = np.zeros(n, dtype=np.float64)
+        return {
+            'score': zeros,
+            'comparative': zeros.copy(),
+            'hits': np.zeros(n, dtype=np.int64),
+            'tokens': counts
+        }
+
+    flat = np.empty(total, dtype=object)
+    flat[:] = [token for doc in tokens for token in doc]
+
+    words, inverse = np.unique(flat, return_inverse=True)
+    token_ids = lexicon.ids(words)[inverse]
+    token_scores = lexicon.scores[token_ids]
+    doc_index = np.repeat(np.arange(n), counts)
+
+    score = np.bincount(doc_index, weights=token_scores, minlength=n)
+    hits = np.bincount(doc_index, weights=token_ids > 0, minlength=n)
+
+    return {
+        'score': score,
+        'comparative': score / np.maximum(counts, 1),
+        'hits': hits.astype(np.int64),
+        'tokens': counts
+    }
+
+def iter_song_chunks(identity, chunk_size=DEFAULT_CHUNK_SIZE, query=None,
+    fields=()):
+    """
+    Streams lists of raw song dicts straight off of a cursor, only
+    genius_id, lyrics and `fields` come over the wire
+    """
+    projection = {'_id': 0, 'genius_id': 1, 'lyrics': 1}
+    projection.update((field, 1) for field in fields)
+
+    cursor = get_collection(identity, database.Song).find(
+        query or {},
+        projection
+    ).batch_size(chunk_size)
+
+    chunk = []
+
+    for doc in cursor:
+
+        chunk.append(doc)
+
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+
+    if chunk:
+        yield chunk
+
+def iter_lyrics(identity, chunk_size=DEFAULT_CHUNK_SIZE, query=None):
+    """
+    (genius_ids, lyrics) chunks
+    """
+    for chunk in iter_song_chunks(identity, chunk_size, query):
+        yield (
+            [doc['genius_id'] for doc in chunk],
+            [doc.get('lyrics', None) or '' for doc in chunk]
+        )
+
+def write_scores(writer, ids, texts, scores, version):
+
+    for i, genius_id in enumerate(ids):
+        writer.add(
+            database.Song,
+            genius_id=genius_id,
+            sentiment=float(scores['score'][i]),
+            sentiment_comparative=float(scores['comparative'][i]),
+            sentiment_hits=int(scores['hits'][i]),
+            token_count=int(scores['tokens'][i]),
+            lyrics_hash=hash_lyrics(texts[i]),
+            scorer_version=version
+        )
+
+def score_corpus(identity, lexicon, chunk_size=DEFAULT_CHUNK_SIZE, query=None,
+    incremental=True):
+    """
+    Scores every song matching `query` and writes the results back in
+    bulk. With `incremental` only the songs that are stale for this
+    lexicon get touched. The rollups are updated as the scores are
+    written, and only for the songs whose write went through. Returns
+    (songs scored, seconds taken)
+    """
+    log = logging.getLogger(str(os.getpid()))
+    start = time.time()
+    scored = 0
+    version = scorer_version(lexicon)
+
+    if incremental:
+        query = stale_query(version, query)
+
+    deltas = RollupDeltas()
+    pending = {}
+
+    def scores_written(collection, genius_ids):
+
+        # Keep the year/artist/album rollups in step with what's stored.
+        # A timed flush can land halfway through a chunk, so only the
+        # ids written here come off pending. What didn't make it stays
+        # stale and gets scored again next run
+        for genius_id in genius_ids:
+            deltas.add(*pending.pop(genius_id))
+
+        deltas.flush(identity)
+
+    with BulkWriter(identity, batch_size=chunk_size,
+        on_flush=scores_written) as writer:
+
+        for chunk in iter_song_chunks(identity, chunk_size, query, SONG_FIELDS):
+
+            ids = [doc['genius_id'] for doc in chunk]
+            texts = [doc.get('lyrics', None) or '' for doc in chunk]
+            scores = score_texts(lexicon, texts)
+
+            for doc, score in zip(chunk, scores['score']):
+                pending[doc['genius_id']] = (doc, float(score))
+
+            write_scores(writer, ids, texts, scores, version)
+            scored += len(ids)
+            metrics.inc('songs_scored_total', len(ids))
+
+            log.info('Scored {} songs, {:.1f} songs/sec'.format(
+                scored,
+                scored / max(time.time() - start, 1e-6)
+            ))
+
+    return scored, time.time() - start
+
+def score_export(corpus, lexicon, chunk_size=DEFAULT_CHUNK_SIZE, start=0,
+    stop=None):
+    """
+    Scores the songs of an exported corpus.Corpus without going near
+    the database, returns the score_texts arrays lined up with
+    corpus.ids[start:stop]
+    """
+    parts = [
+        score_texts(lexicon, texts)
+        for _, texts in corpus.chunks(chunk_size, start, stop)
+    ]
+
+    if not parts:
+        return score_texts(lexicon, [])
+
+    return {key: np.concatenate([part[key] for part in parts]) for key in parts[0]}
+
+def shard_ranges(identity, shards, query=None):
+    """
+    Splits the songs into `shards` genius_id ranges holding about the
+    same number of documents each, the server does the bucketing.
+    Returns [(low, high)] with low inclusive, high exclusive and None
+    for an open ended last shard
+    """
+    pipeline = []
+
+    if query:
+        pipeline.append({'$match': query})
+
+    pipeline.append({
+        '$bucketAuto': {'groupBy': '$genius_id', 'buckets': shards}
+    })
+
+    buckets = db_aggregate(identity, database.Song, pipeline)
+    ranges = []
+
+    for i, bucket in enumerate(buckets):
+
+        low = bucket['_id']['min']
+        high = None if i == len(buckets) - 1 else bucket['_id']['max']
+        ranges.append((low, high))
+
+    return ranges
+
+def shard_query(low, high, query=None):
+
+    id_range = {'$gte': low}
+
+    if high is not None:
+        id_range['$lt'] = high
+
+    shard = dict(query or {})
+    shard['genius_id'] = id_range
+
+    return shard
+
+def score_shards(lexicon_path, shard_queue, result_queue, chunk_size,
+    query=None):
+
+    identity = str(os.getpid())
+
+    initialize_alias('default')
+    initialize_alias(identity)
+
+    lexicon = Lexicon.load(lexicon_path)
+
+    for index, low, high in iter(shard_queue.get, None):
+
+        try:
+            scored, seconds = score_corpus(
+                identity,
+                lexicon,
+                chunk_size,
+                shard_query(low, high, query),
+                incremental=False
+            )
+
+        except:
+            log = logging.getLogger(identity)
+            log.exception('Failed scoring shard {}: [{}, {})'.format(index, low, high))
+            scored, seconds = -1, 0.
+
+        result_queue.put((index, low, high, scored, seconds))
+
+def score_parallel(identity, lexicon_path, processes=None, shards=None,
+    chunk_size=DEFAULT_CHUNK_SIZE, query=None, incremental=True):
+    """
+    Same process model as genius_scraper.main: the Song collection is
+    cut into genius_id ranges that go on a queue and every worker opens
+    its own alias and scores whole ranges. Several shards per worker
+    keeps everybody busy until the end. Returns (songs scored, seconds)
+    """
+    log = logging.getLogger(str(os.getpid()))
+    processes = processes or max(1, cpu_count() - 1)
+    shards = shards or processes * 4
+
+    start = time.time()
+
+    # Workers get the stale filter baked into their shard queries
+    if incremental:
+        query = stale_query(scorer_version(Lexicon.load(lexicon_path)), query)
+
+    ranges = shard_ranges(identity, shards, query)
+
+    shard_queue = Queue()
+    result_queue = Queue()
+
+    for index, (low, high) in enumerate(ranges):
+        shard_queue.put((index, low, high))
+
+    for _ in range(processes):
+        shard_queue.put(None)
+
+    children = [
+        Process(
+            target=score_shards,
+            args=(lexicon_path, shard_queue, result_queue, chunk_size, query)
+        ) for _ in range(processes)
+    ]
+
+    for proc in children: proc.daemon = True
+    for proc in children: proc.start()
+
+    total = 0
+
+    for _ in range(len(ranges)):
+
+        index, low, high, scored, seconds = result_queue.get()
+
+        if scored < 0:
+            log.error('Shard {} [{}, {}) failed'.format(index, low, high))
+            continue
+
+        total += scored
+        log.info('Shard {} [{}, {}): {} songs in {:.1f}s, {:.1f} songs/sec'.format(
+            index, low, high, scored, seconds, scored / max(seconds, 1e-6)))
+
+    for proc in children: proc.join()
+
+    seconds = time.time() - start
+    log.info('Scored {} songs over {} shards in {:.1f}s, {:.1f} songs/sec'.format(
+        total, len(ranges), seconds, total / max(seconds, 1e-6)))
+
+    return total, seconds
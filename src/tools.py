@@ -9,8 +9,12 @@
 import os
 import re
 import sys
+import time
+import hashlib
+import threading
 import subprocess as sp
 from datetime import datetime
+from collections import OrderedDict
 
 wikitable_xpath ='//table[@class="wikitable"]'
 wiki_tracklist_xpath = '//table[@class="tracklist"]'
@@ -20,6 +24,7 @@ table_data_xpath = './/td'
 descendant_xpath = 'descendant::*'
 link_xpath = '//a/@href'
 lyrics_xpath = '//*[@class="lyrics"]'
+NO_LYRICS = 'NO LYRICS'
 
 
 def counter(l):
@@ -56,6 +61,123 @@ def parse_datetime(string):
 
     return
 
+_MISS = object()
+
+class TTLCache(object):
+    """
+    Thread safe LRU cache where every entry can carry its own time to
+    live (None means forever). Cached Nones are real entries, use
+    get(key, default) with a sentinel to tell them apart from misses.
+
+    `shared` can be any mapping visible to other processes (say a
+    multiprocessing.Manager().dict()). Local misses fall through to it
+    and every set is written through, so workers learn from each other.
+    """
+
+    def __init__(self, max_size=4096, ttl=None, shared=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.shared = shared
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._key_locks = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _local_get(self, key, now):
+
+        with self._lock:
+            entry = self._entries.get(key, None)
+
+            if entry is None:
+                return _MISS
+
+            value, expires = entry
+
+            if expires is not None and expires <= now:
+                del self._entries[key]
+                return _MISS
+
+            self._entries.move_to_end(key)
+            return value
+
+    def _local_set(self, key, value, expires):
+
+        with self._lock:
+            self._entries[key] = (value, expires)
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def get(self, key, default=None):
+
+        now = time.time()
+        value = self._local_get(key, now)
+
+        if value is not _MISS:
+            return value
+
+        if self.shared is not None:
+            entry = self.shared.get(key, None)
+
+            if entry is not None:
+                value, expires = entry
+
+                if expires is None or expires > now:
+                    self._local_set(key, value, expires)
+                    return value
+
+        return default
+
+    def set(self, key, value, ttl=_MISS):
+
+        ttl = self.ttl if ttl is _MISS else ttl
+        expires = time.time() + ttl if ttl is not None else None
+
+        self._local_set(key, value, expires)
+
+        if self.shared is not None:
+            self.shared[key] = (value, expires)
+
+    def get_or_compute(self, key, compute, ttl=_MISS):
+        """
+        Returns the cached value or computes it. Concurrent callers for
+        the same key wait on the first one instead of all computing.
+        `ttl` may be a callable taking the computed value
+        """
+        value = self.get(key, _MISS)
+
+        if value is not _MISS:
+            return value
+
+        with self._lock:
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+
+        try:
+            with key_lock:
+                value = self.get(key, _MISS)
+
+                if value is _MISS:
+                    value = compute()
+                    self.set(key, value, ttl(value) if callable(ttl) else ttl)
+
+        finally:
+            # Even when compute() raised, or every failed key leaks a lock
+            with self._lock:
+                self._key_locks.pop(key, None)
+
+        return value
+
+    def clear(self):
+
+        with self._lock:
+            self._entries.clear()
+
+def hash_lyrics(lyrics):
+    return hashlib.sha1((lyrics or '').encode('utf-8')).hexdigest()
+
 def get_nonjson(obj):
 
     if isinstance(obj, set):
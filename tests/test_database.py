@@ -0,0 +1,51 @@
+import os
+import sys
+
+from pymongo.errors import BulkWriteError
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+import database
+
+class FakeCollection(object):
+
+    def __init__(self, fail_guards=False):
+        self.fail_guards = fail_guards
+        self.writes = []
+
+    def bulk_write(self, requests, ordered=True):
+        requests = list(requests)
+        guarded = '$ne' in str(requests[0]._filter)
+        self.writes.append((guarded, requests))
+
+        if guarded and self.fail_guards:
+            raise BulkWriteError({
+                'writeErrors': [],
+                'writeConcernErrors': [{'errmsg': 'waiting for replication timed out'}]
+            })
+
+def test_failed_guards_still_send_upserts(monkeypatch):
+
+    songs = FakeCollection(fail_guards=True)
+    flushed = []
+
+    monkeypatch.setattr(database, 'get_collection', lambda identity, collection: songs)
+    monkeypatch.setattr(database, 'mark_collection', lambda *args: None)
+
+    writer = database.BulkWriter('test',
+        on_flush=lambda collection, ids: flushed.extend(ids))
+
+    writer.add(database.Song, genius_id=1, lyrics='a')
+    writer.add(database.Song, genius_id=2, lyrics='b')
+    writer.add(database.Song, unset=('scorer_version',), changed='lyrics_hash',
+        genius_id=3, lyrics='c', lyrics_hash='h')
+
+    assert writer.flush() == 0
+    assert [guarded for guarded, _ in songs.writes] == [True, False]
+
+    upserts = songs.writes[1][1]
+    assert [request._filter['genius_id'] for request in upserts] == [1, 2, 3]
+
+    # The guard never landed, so the rescore is forced outright
+    assert upserts[2]._doc['$unset'] == {'scorer_version': ''}
+    assert sorted(flushed) == [1, 2, 3]
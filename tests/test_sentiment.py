@@ -0,0 +1,72 @@
+import os
+import sys
+from functools import partial
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+import database
+import rollups
+import sentiment
+
+class FakeCollection(object):
+
+    def __init__(self, docs=()):
+        self.docs = list(docs)
+        self.writes = []
+
+    def find(self, *args, **kwargs):
+        return self
+
+    def batch_size(self, size):
+        return iter(self.docs)
+
+    def bulk_write(self, requests, ordered=True):
+        self.writes.append(list(requests))
+
+def fake_scores(lexicon, texts):
+
+    n = len(texts)
+
+    return {
+        'score': np.ones(n),
+        'comparative': np.ones(n),
+        'hits': np.ones(n, dtype=np.int64),
+        'tokens': np.ones(n, dtype=np.int64)
+    }
+
+def test_timed_flush_partway_through_a_chunk(monkeypatch):
+
+    songs = FakeCollection(
+        {'genius_id': i, 'lyrics': 'words', 'artist_id': 7} for i in range(1, 6))
+    collections = {'Song': songs}
+
+    def get_collection(identity, collection):
+        name = getattr(collection, '__name__', collection)
+        return collections.setdefault(name, FakeCollection())
+
+    for module in (database, rollups, sentiment):
+        monkeypatch.setattr(module, 'get_collection', get_collection)
+
+    monkeypatch.setattr(database, 'mark_collection', lambda *args: None)
+    monkeypatch.setattr(sentiment, 'scorer_version', lambda lexicon: 'v')
+    monkeypatch.setattr(sentiment, 'score_texts', fake_scores)
+
+    # Every add is past the interval, so the writer flushes mid chunk
+    monkeypatch.setattr(sentiment, 'BulkWriter',
+        partial(database.BulkWriter, flush_interval=0))
+
+    scored, _ = sentiment.score_corpus('test', None, chunk_size=3,
+        incremental=False)
+
+    assert scored == 5
+    assert len(songs.writes) == 5
+
+    counted = sum(
+        request._doc['$inc']['count']
+        for requests in collections['ArtistRollup'].writes
+        for request in requests
+    )
+
+    assert counted == 5